@@ -0,0 +1,55 @@
+import json
+import os
+import shutil
+import tempfile
+
+# Reference results of the regression benchmarks (load_test.py, benchmark_train.py).
+# They have to outlive the build that recorded them, so by default they are kept in the
+# workspace default datastore ("datastore:<path>"); any other location is a local file.
+# Baselines are timings of the machine they were measured on: record them from the
+# build agent with --update_baseline, not from a workstation.
+
+DATASTORE_SCHEME = 'datastore:'
+
+
+def _datastore():
+    from azureml.core import Workspace
+    return Workspace.from_config().get_default_datastore()
+
+
+def load_baseline(location):
+    # The stored results, or None when nothing was recorded at that location yet
+    if not location.startswith(DATASTORE_SCHEME):
+        if not os.path.exists(location):
+            return None
+        with open(location) as f:
+            return json.load(f)
+    path = location[len(DATASTORE_SCHEME):]
+    directory = tempfile.mkdtemp()
+    try:
+        _datastore().download(directory, prefix=path, show_progress=False)
+        localPath = os.path.join(directory, path)
+        if not os.path.exists(localPath):
+            return None
+        with open(localPath) as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def save_baseline(location, results):
+    if not location.startswith(DATASTORE_SCHEME):
+        os.makedirs(os.path.dirname(os.path.abspath(location)), exist_ok=True)
+        with open(location, "w") as f:
+            json.dump(results, f, indent=2)
+        return
+    path = location[len(DATASTORE_SCHEME):]
+    directory = tempfile.mkdtemp()
+    try:
+        localPath = os.path.join(directory, os.path.basename(path))
+        with open(localPath, "w") as f:
+            json.dump(results, f, indent=2)
+        _datastore().upload_files([localPath], target_path=os.path.dirname(path), overwrite=True,
+                                  show_progress=False)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,117 @@
+import queue
+import threading
+import time
+import numpy as np
+
+# Micro-batching layer in front of a predict function.
+# Concurrent callers hand in their rows and block; a single worker thread merges
+# whatever arrived within max_wait_ms (up to max_batch_size rows) into one batched
+# predict call and hands each caller back its own slice of the results.
+# Rows are validated before they are queued, so a malformed request fails on its own;
+# if a merged call still fails, every request of the batch is retried alone and only
+# the ones that fail by themselves get the error.
+
+
+class _Pending(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BatchCoalescer(object):
+
+    def __init__(self, predict, max_batch_size=256, max_wait_ms=2.0, n_features=None):
+        self.predict = predict
+        self.n_features = n_features
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.batches = 0
+        self.rows = 0
+        self._queue = queue.Queue()
+        self._carry = None
+        self._worker = threading.Thread(target=self._loop, name="batch-coalescer")
+        self._worker.daemon = True
+        self._worker.start()
+
+    def submit(self, rows):
+        pending = _Pending(self._check_rows(rows))
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _check_rows(self, rows):
+        # Same checks (and messages) as the forest engine, raised in the caller's thread
+        rows = np.asarray(rows, dtype=np.float32)
+        if rows.ndim == 1:
+            rows = rows.reshape(1, -1)
+        if rows.ndim != 2:
+            raise ValueError("Expected a 2D array of rows, got %d dimensions" % rows.ndim)
+        if self.n_features is not None and rows.shape[1] != self.n_features:
+            raise ValueError("X has %d features, but the model is expecting %d features as input"
+                             % (rows.shape[1], self.n_features))
+        if not np.isfinite(rows).all():
+            raise ValueError("Input contains NaN, infinity or a value too large for dtype('float32').")
+        return rows
+
+    def _next(self, timeout=None):
+        if self._carry is not None:
+            pending, self._carry = self._carry, None
+            return pending
+        if timeout is None:
+            return self._queue.get()
+        return self._queue.get(timeout=timeout)
+
+    def _collect(self):
+        # Block for the first request, then gather more until the batch is full
+        # or the deadline of the first request has passed
+        first = self._next()
+        batch = [first]
+        size = len(first.rows)
+        deadline = time.time() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                pending = self._next(timeout=remaining)
+            except queue.Empty:
+                break
+            if size + len(pending.rows) > self.max_batch_size:
+                # Keep whole requests together; this one opens the next batch
+                self._carry = pending
+                break
+            batch.append(pending)
+            size += len(pending.rows)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            try:
+                if len(batch) == 1:
+                    results = self.predict(batch[0].rows)
+                else:
+                    results = self.predict(np.concatenate([pending.rows for pending in batch]))
+                start = 0
+                for pending in batch:
+                    pending.result = results[start:start + len(pending.rows)]
+                    start += len(pending.rows)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0].error = e
+                else:
+                    # Keep one bad request from failing the others merged with it
+                    for pending in batch:
+                        try:
+                            pending.result = self.predict(pending.rows)
+                        except Exception as single:
+                            pending.error = single
+            self.batches += 1
+            self.rows += sum(len(pending.rows) for pending in batch)
+            for pending in batch:
+                pending.done.set()
@@ -0,0 +1,151 @@
+import argparse
+import collections
+import os
+import pickle
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+import model_bundle
+from forest_engine import ForestEngine
+from lookup_table import LookupTable
+from preprocessing import Preprocessor
+
+# Offline batch scoring of framingham-schema CSV or Parquet files.
+# The input is streamed in chunks through a generator, chunks are scored by a pool of
+# worker processes that each load the model once, and predictions are appended to the
+# output in input order. At most `max_in_flight` chunks are held in memory at any time.
+
+
+def read_chunks(path, columns, chunk_size):
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    else:
+        for chunk in pd.read_csv(path, usecols=columns, chunksize=chunk_size):
+            yield chunk
+
+
+class PredictionWriter(object):
+
+    def __init__(self, path, id_column=None):
+        self.path = path
+        self.id_column = id_column
+        self.rows = 0
+        self._parquet = None
+        self._header = True
+
+    def write(self, ids, predictions):
+        frame = pd.DataFrame({"prediction": predictions})
+        if self.id_column:
+            frame.insert(0, self.id_column, ids)
+        if self.path.endswith('.parquet'):
+            import pyarrow
+            import pyarrow.parquet as pq
+            table = pyarrow.Table.from_pandas(frame, preserve_index=False)
+            if self._parquet is None:
+                self._parquet = pq.ParquetWriter(self.path, table.schema)
+            self._parquet.write_table(table)
+        else:
+            frame.to_csv(self.path, mode='w' if self._header else 'a', header=self._header, index=False)
+            self._header = False
+        self.rows += len(frame)
+
+    def close(self):
+        if self._parquet is not None:
+            self._parquet.close()
+
+
+# Per worker process model state, loaded once by the pool initializer
+_worker = {}
+
+
+def _init_worker(model_path):
+    if model_bundle.component_path(model_path, model_bundle.FOREST_MANIFEST):
+        _worker["engine"] = ForestEngine.load(model_path)
+    else:
+        _worker["engine"] = ForestEngine.from_model(pickle.load(open(model_bundle.model_file(model_path), 'rb')))
+    # Large chunks go to the fitted model, trained with n_jobs=-1: one thread per worker
+    # process, the pool already uses every core
+    _worker["engine"].n_jobs = 1
+    preprocessingPath = model_bundle.component_path(model_path, model_bundle.PREPROCESSING_FILE)
+    _worker["preprocessor"] = Preprocessor.load(preprocessingPath) if preprocessingPath else None
+    lookupPath = model_bundle.component_path(model_path, model_bundle.LOOKUP_TABLE_FILE)
+    _worker["lookup"] = LookupTable.load(model_path) if lookupPath else None
+
+
+def _score_chunk(X):
+    if _worker["preprocessor"] is not None:
+        X = _worker["preprocessor"].transform(X)
+    if _worker["lookup"] is not None:
+        return _worker["lookup"].predict(X, _worker["engine"].predict)
+    return _worker["engine"].predict(X)
+
+
+def model_features(model_path, features=None):
+    if features:
+        return features.split(',')
+    preprocessingPath = model_bundle.component_path(model_path, model_bundle.PREPROCESSING_FILE)
+    if preprocessingPath is None:
+        raise ValueError("The model has no preprocessing.json; pass --features")
+    return Preprocessor.load(preprocessingPath).columns
+
+
+if __name__ == '__main__':
+    print("*********************************************")
+    print("INSIDE batch_score.py")
+    print("*********************************************")
+
+    print("1. Parse arguments")
+    print('.............................................')
+    parser = argparse.ArgumentParser("batch_score")
+    parser.add_argument("--model_path", type=str, help="registered model folder or pickle", dest="model_path", required=True)
+    parser.add_argument("--input", type=str, help="framingham-schema csv or parquet file", dest="input", required=True)
+    parser.add_argument("--output", type=str, help="predictions csv or parquet file", dest="output", required=True)
+    parser.add_argument("--features", type=str, help="comma separated model features (default: from the model)",
+                        dest="features", default=None)
+    parser.add_argument("--id_column", type=str, help="input column copied next to each prediction", dest="id_column",
+                        default=None)
+    parser.add_argument("--chunk_size", type=int, help="rows per chunk", dest="chunk_size", default=50000)
+    parser.add_argument("--workers", type=int, help="scoring processes", dest="workers", default=os.cpu_count())
+    parser.add_argument("--max_in_flight", type=int, help="chunks queued or being scored at once (default: 2 per worker)",
+                        dest="max_in_flight", default=None)
+    args = parser.parse_args()
+    print(vars(args))
+    print('..1. completed')
+    print('')
+    print('')
+
+    print("2. Score input in chunks")
+    print('.............................................')
+    features = model_features(args.model_path, args.features)
+    columns = features + ([args.id_column] if args.id_column and args.id_column not in features else [])
+    maxInFlight = args.max_in_flight or 2 * args.workers
+    writer = PredictionWriter(args.output, args.id_column)
+    start = time.time()
+    with Pool(processes=args.workers, initializer=_init_worker, initargs=(args.model_path,)) as pool:
+        inFlight = collections.deque()
+        for chunk in read_chunks(args.input, columns, args.chunk_size):
+            ids = chunk[args.id_column].values if args.id_column else None
+            X = chunk[features].values.astype(np.float32)
+            inFlight.append((ids, pool.apply_async(_score_chunk, (X,))))
+            # Write finished chunks in input order and keep memory bounded
+            while len(inFlight) >= maxInFlight or (inFlight and inFlight[0][1].ready()):
+                ids, pending = inFlight.popleft()
+                writer.write(ids, pending.get())
+        while inFlight:
+            ids, pending = inFlight.popleft()
+            writer.write(ids, pending.get())
+    writer.close()
+    elapsed = time.time() - start
+    print("Scored %d rows in %.1f s (%.0f rows/s)" % (writer.rows, elapsed, writer.rows / max(elapsed, 1e-9)))
+    print('..2. completed')
+    print('')
+    print('')
+
+    print("*********************************************")
+    print("EXITING batch_score.py")
+    print("*********************************************")
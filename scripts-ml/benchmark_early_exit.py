@@ -0,0 +1,126 @@
+import argparse
+import json
+import os
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import train_test_split
+
+import model_bundle
+from forest_engine import ForestEngine
+from preprocessing import Preprocessor
+
+# Benchmarks the early-exit predict mode against exhaustive prediction on framingham.csv:
+# agreement with RandomForestClassifier.predict, trees used per row and latency for a
+# range of confidence settings ("exact" = only stop when the vote cannot flip).
+
+print("*********************************************")
+print("INSIDE benchmark_early_exit.py")
+print("*********************************************")
+
+print("1. Parse arguments")
+print('.............................................')
+parser = argparse.ArgumentParser("benchmark_early_exit")
+parser.add_argument("--data", type=str, help="framingham csv path or url", dest="data",
+                    default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'framingham.csv'))
+parser.add_argument("--model_path", type=str, help="registered model folder or pickle; trains one if omitted",
+                    dest="model_path", default=None)
+parser.add_argument("--n_estimators", type=int, help="trees to train when no model is given", dest="n_estimators",
+                    default=10000)
+parser.add_argument("--features", type=str, help="comma separated model features", dest="features",
+                    default="age,prevalentHyp,sysBP,glucose")
+parser.add_argument("--confidence", type=str, help="comma separated z values, 'exact' for the exact bound",
+                    dest="confidence", default="exact,4,3,2")
+parser.add_argument("--block_size", type=int, help="trees evaluated per block", dest="block_size", default=100)
+parser.add_argument("--repeat", type=int, help="timing repetitions, best is kept", dest="repeat", default=3)
+parser.add_argument("--output", type=str, help="json results file", dest="output", default=None)
+args = parser.parse_args()
+print(vars(args))
+print('..1. completed')
+print('')
+print('')
+
+print("2. Load data and model")
+print('.............................................')
+df = pd.read_csv(args.data)
+features = args.features.split(',')
+df[features] = Preprocessor.fit(df, features).transform(df[features].values)
+X_train, X_test, y_train, y_test = train_test_split(df[features].values, df.iloc[:, -1].values,
+                                                    test_size=0.2, random_state=14)
+if args.model_path:
+    if model_bundle.component_path(args.model_path, model_bundle.FOREST_MANIFEST):
+        clfModel = None
+        engine = ForestEngine.load(args.model_path)
+    else:
+        clfModel = pickle.load(open(model_bundle.model_file(args.model_path), 'rb'))
+        engine = ForestEngine.from_model(clfModel)
+else:
+    clfModel = RandomForestClassifier(n_estimators=args.n_estimators, random_state=0, n_jobs=-1)
+    clfModel.fit(X_train, y_train)
+    engine = ForestEngine.from_model(clfModel)
+X = np.asarray(X_test, dtype=np.float32)
+print("Trees: %d, rows scored: %d" % (engine.n_trees, len(X)))
+print('..2. completed')
+print('')
+print('')
+
+
+def best_time(function):
+    best = None
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+print("3. Exhaustive baselines")
+print('.............................................')
+results = {"n_trees": engine.n_trees, "n_rows": len(X), "block_size": args.block_size, "runs": []}
+engineSeconds, reference = best_time(lambda: engine.predict(X))
+results["engine_seconds"] = engineSeconds
+print("ForestEngine.predict: %.4f s" % engineSeconds)
+if clfModel is not None:
+    sklearnSeconds, sklearnPredictions = best_time(lambda: clfModel.predict(X))
+    results["sklearn_seconds"] = sklearnSeconds
+    results["engine_agreement_with_sklearn"] = float(np.mean(sklearnPredictions == reference))
+    reference = sklearnPredictions
+    print("RandomForestClassifier.predict: %.4f s" % sklearnSeconds)
+print('..3. completed')
+print('')
+print('')
+
+print("4. Early exit")
+print('.............................................')
+print("%-10s %10s %12s %12s %10s" % ("confidence", "agreement", "mean trees", "seconds", "speedup"))
+for setting in args.confidence.split(','):
+    confidence = None if setting == 'exact' else float(setting)
+    seconds, (predictions, treesUsed) = best_time(
+        lambda: engine.predict_early_exit(X, confidence=confidence, block_size=args.block_size))
+    run = {
+        "confidence": setting,
+        "agreement": float(np.mean(predictions == reference)),
+        "mean_trees_used": float(np.mean(treesUsed)),
+        "p95_trees_used": float(np.percentile(treesUsed, 95)),
+        "seconds": seconds,
+        "speedup_vs_engine": engineSeconds / seconds,
+    }
+    results["runs"].append(run)
+    print("%-10s %10.4f %12.1f %12.4f %9.1fx" % (setting, run["agreement"], run["mean_trees_used"],
+                                                 seconds, run["speedup_vs_engine"]))
+print('..4. completed')
+print('')
+print('')
+
+if args.output:
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(args.output, ' saved')
+
+print("*********************************************")
+print("EXITING benchmark_early_exit.py")
+print("*********************************************")
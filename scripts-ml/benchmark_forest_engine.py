@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+
+import forest_engine
+from forest_engine import ForestEngine
+from preprocessing import Preprocessor
+
+# Benchmarks ForestEngine.predict_proba against RandomForestClassifier.predict_proba on
+# framingham.csv rows for a range of batch sizes, checks the probabilities are
+# identical and exits with status 1 when the engine is slower than scikit-learn by
+# more than --tolerance at any batch size. The numpy traversal alone is timed too, to
+# check the SKLEARN_MIN_ROWS crossover.
+
+print("*********************************************")
+print("INSIDE benchmark_forest_engine.py")
+print("*********************************************")
+
+print("1. Parse arguments")
+print('.............................................')
+parser = argparse.ArgumentParser("benchmark_forest_engine")
+parser.add_argument("--data", type=str, help="framingham csv path or url", dest="data",
+                    default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'framingham.csv'))
+parser.add_argument("--n_estimators", type=str, help="comma separated forest sizes to train", dest="n_estimators",
+                    default="100,1000")
+parser.add_argument("--features", type=str, help="comma separated model features", dest="features",
+                    default="age,prevalentHyp,sysBP,glucose")
+parser.add_argument("--batch_sizes", type=str, help="comma separated rows per call", dest="batch_sizes",
+                    default="1,10,100,1000,4000")
+parser.add_argument("--repeat", type=int, help="timing repetitions, best is kept", dest="repeat", default=9)
+parser.add_argument("--tolerance", type=float, help="allowed slowdown vs scikit-learn, in percent",
+                    dest="tolerance", default=10.0)
+parser.add_argument("--output", type=str, help="json results file", dest="output", default=None)
+args = parser.parse_args()
+print(vars(args))
+print('..1. completed')
+print('')
+print('')
+
+print("2. Load data")
+print('.............................................')
+df = pd.read_csv(args.data)
+features = args.features.split(',')
+df[features] = Preprocessor.fit(df, features).transform(df[features].values)
+X = np.asarray(df[features].values, dtype=np.float32)
+y = df.iloc[:, -1].values
+print("Rows: %d" % len(X))
+print('..2. completed')
+print('')
+print('')
+
+
+def best_time(function):
+    best = None
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def numpy_only(engine, batch):
+    # The vectorized traversal, whatever the batch size
+    crossover = forest_engine.SKLEARN_MIN_ROWS
+    forest_engine.SKLEARN_MIN_ROWS = sys.maxsize
+    try:
+        return engine.predict_proba(batch)
+    finally:
+        forest_engine.SKLEARN_MIN_ROWS = crossover
+
+
+print("3. Time predict_proba")
+print('.............................................')
+results = {"sklearn_min_rows": forest_engine.SKLEARN_MIN_ROWS, "runs": []}
+regressions = []
+print("%7s %7s %12s %12s %12s %9s" % ("trees", "rows", "engine s", "numpy s", "sklearn s", "vs sklearn"))
+for nEstimators in [int(n) for n in args.n_estimators.split(',')]:
+    clfModel = RandomForestClassifier(n_estimators=nEstimators, random_state=0, n_jobs=-1).fit(X, y)
+    engine = ForestEngine.from_model(clfModel)
+    for batchSize in [int(size) for size in args.batch_sizes.split(',')]:
+        batch = X[np.arange(batchSize) % len(X)]
+        engineSeconds, engineProba = best_time(lambda: engine.predict_proba(batch))
+        numpySeconds, numpyProba = best_time(lambda: numpy_only(engine, batch))
+        sklearnSeconds, sklearnProba = best_time(lambda: clfModel.predict_proba(batch))
+        if not (np.array_equal(engineProba, sklearnProba) and np.array_equal(numpyProba, sklearnProba)):
+            regressions.append("%d trees, %d rows: probabilities differ" % (nEstimators, batchSize))
+        change = 100.0 * (engineSeconds - sklearnSeconds) / sklearnSeconds
+        if change > args.tolerance:
+            regressions.append("%d trees, %d rows: %.0f%% slower than scikit-learn" % (nEstimators, batchSize,
+                                                                                      change))
+        results["runs"].append({"n_trees": nEstimators, "rows": batchSize, "engine_seconds": engineSeconds,
+                                "numpy_seconds": numpySeconds, "sklearn_seconds": sklearnSeconds})
+        print("%7d %7d %12.4f %12.4f %12.4f %8.0f%%" % (nEstimators, batchSize, engineSeconds, numpySeconds,
+                                                        sklearnSeconds, change))
+print('..3. completed')
+print('')
+print('')
+
+if args.output:
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(args.output, ' saved')
+
+print("*********************************************")
+print("EXITING benchmark_forest_engine.py")
+print("*********************************************")
+if regressions:
+    print("Regressions: ", regressions)
+    sys.exit(1)
@@ -0,0 +1,109 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from baseline_store import load_baseline, save_baseline
+
+# Regression benchmark for train.py: compares the stage profile written by train.py
+# (outputs/train-profile.json) with a stored baseline, stage by stage, and exits with
+# status 1 when wall time, CPU time or peak RSS of a stage grew by more than the
+# threshold. Stages shorter than --min_seconds in the baseline are reported but not
+# gated on time, since their timings are mostly noise.
+
+print("*********************************************")
+print("INSIDE benchmark_train.py")
+print("*********************************************")
+
+print("1. Parse arguments")
+print('.............................................')
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+parser = argparse.ArgumentParser("benchmark_train")
+parser.add_argument("--profile", type=str, help="stage profile written by train.py", dest="profile",
+                    default='./outputs/train-profile.json')
+parser.add_argument("--baseline", type=str, help="baseline profile: datastore:<path> or a local file", dest="baseline",
+                    default='datastore:baselines/train-profile.json')
+parser.add_argument("--threshold", type=float, help="allowed increase over the baseline, in percent",
+                    dest="threshold", default=20.0)
+parser.add_argument("--min_seconds", type=float, help="baseline wall/cpu seconds below which a stage is not gated",
+                    dest="min_seconds", default=0.5)
+parser.add_argument("--run", type=str, help="run train.py with these arguments first (quoted, space separated)",
+                    dest="run", default=None)
+parser.add_argument("--update_baseline", help="store the profile as the new baseline", dest="update_baseline",
+                    action="store_true")
+args = parser.parse_args()
+print(vars(args))
+print('..1. completed')
+print('')
+print('')
+
+if args.run is not None:
+    print("1.1. Run train.py")
+    print('.............................................')
+    returnCode = subprocess.call([sys.executable, os.path.join(scriptDir, 'train.py')] + args.run.split())
+    if returnCode != 0:
+        print("train.py failed with exit code %d" % returnCode)
+        sys.exit(returnCode)
+    print('..1.1. completed')
+    print('')
+    print('')
+
+print("2. Load profile and baseline")
+print('.............................................')
+with open(args.profile) as f:
+    profile = json.load(f)
+if args.update_baseline:
+    save_baseline(args.baseline, profile)
+    print("Baseline saved: ", args.baseline)
+    print("*********************************************")
+    print("EXITING benchmark_train.py")
+    print("*********************************************")
+    sys.exit(0)
+baseline = load_baseline(args.baseline)
+if baseline is None:
+    # Not a pass: without a baseline nothing was compared
+    print("ERROR: no baseline at %s; record one from a reference build with --update_baseline" % args.baseline)
+    sys.exit(2)
+baselineStages = {stage["stage"]: stage for stage in baseline["stages"]}
+print('..2. completed')
+print('')
+print('')
+
+print("3. Compare stages with the baseline")
+print('.............................................')
+regressions = []
+print("%-24s %-14s %12s %12s %9s" % ("stage", "measure", "baseline", "current", "change"))
+for stage in profile["stages"]:
+    reference = baselineStages.get(stage["stage"])
+    if reference is None:
+        print("%-24s (not in baseline)" % stage["stage"])
+        continue
+    for measure in ("wall_seconds", "cpu_seconds", "peak_rss_mb"):
+        if not reference[measure]:
+            continue
+        change = 100.0 * (stage[measure] - reference[measure]) / reference[measure]
+        gated = measure == "peak_rss_mb" or reference[measure] >= args.min_seconds
+        flag = ''
+        if gated and change > args.threshold:
+            flag = ' REGRESSION'
+            regressions.append({"stage": stage["stage"], "measure": measure, "baseline": reference[measure],
+                                "current": stage[measure], "change_percent": change})
+        print("%-24s %-14s %12.2f %12.2f %8.1f%%%s" % (stage["stage"], measure, reference[measure],
+                                                      stage[measure], change, flag if gated else ' (not gated)'))
+print('..3. completed')
+print('')
+print('')
+
+print("4. Result")
+print('.............................................')
+if regressions:
+    print("%d regression(s) above %.0f%%:" % (len(regressions), args.threshold))
+    for regression in regressions:
+        print("  %(stage)s %(measure)s: %(baseline).2f -> %(current).2f (+%(change_percent).1f%%)" % regression)
+else:
+    print("No regression above %.0f%%" % args.threshold)
+print("*********************************************")
+print("EXITING benchmark_train.py")
+print("*********************************************")
+sys.exit(1 if regressions else 0)
@@ -0,0 +1,258 @@
+import argparse
+import importlib.util
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from azureml.core import Workspace
+from azureml.core.model import Model
+
+import scoring_environment
+from stage_profiler import peak_rss_mb
+
+# Capacity planning for the AKS scoring service. The real score.run, templated with the
+# registered model like in the image, is benchmarked on the build agent for every
+# combination of worker processes, threads per worker and rows per request: requests/s,
+# rows/s per CPU core (CPU time of the workers, not wall time), p50/p99 latency and peak
+# RSS per worker. For a target QPS and p99 SLO the cheapest container meeting the SLO is
+# picked and turned into AksWebservice.deploy_configuration parameters (cpu_cores,
+# memory_gb, replica concurrency and autoscale bounds), written to the capacity plan that
+# deploy-rest-service.py passes through. The build pipeline runs it once the model is
+# registered and publishes outputs/capacity-plan.json with the build artifact.
+# The image of the build runs a single scoring worker, so by default only one worker is
+# benchmarked and the plan applies to every rollout; plans with more --workers need an
+# endpoint version that sets WORKER_COUNT (deploy-rest-service.py --rollout blue_green).
+
+print("*********************************************")
+print("INSIDE capacity_planner.py")
+print("*********************************************")
+
+# Scoring module of a benchmark worker process, loaded by _init_worker
+scoreModule = None
+
+
+def _init_worker(score_file):
+    global scoreModule
+    spec = importlib.util.spec_from_file_location('score', score_file)
+    scoreModule = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(scoreModule)
+    scoreModule.init()
+
+
+def _measure_worker(task):
+    # One worker: `threads` threads call score.run back to back from start_time until
+    # start_time + duration; returns latencies, rows, errors, CPU seconds and peak RSS
+    payloads, batch_size, threads, start_time, duration = task
+    latencies = [[] for _ in range(threads)]
+    errors = [0] * threads
+
+    def loop(index):
+        i = index
+        while time.time() < start_time:
+            time.sleep(0.001)
+        while time.time() < start_time + duration:
+            begin = time.perf_counter()
+            result = scoreModule.run(payloads[i % len(payloads)])
+            latencies[index].append(time.perf_counter() - begin)
+            # score.run reports failures as a string instead of the predictions
+            errors[index] += 1 if isinstance(result, str) and not result.startswith('[') else 0
+            i += threads
+
+    cpuStart = time.process_time()
+    workers = [threading.Thread(target=loop, args=(index,)) for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    allLatencies = [latency for threadLatencies in latencies for latency in threadLatencies]
+    return {"latencies": allLatencies, "rows": len(allLatencies) * batch_size, "errors": sum(errors),
+            "cpu_seconds": time.process_time() - cpuStart, "peak_rss_mb": peak_rss_mb()[0]}
+
+
+def _round_up(value, step):
+    return math.ceil(value / step - 1e-9) * step
+
+
+if __name__ == '__main__':
+    print("1. Parse arguments")
+    print('.............................................')
+    scriptDir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser("capacity_planner")
+    parser.add_argument("--model_name", type=str, help="registered model name", dest="model_name", required=True)
+    parser.add_argument("--model_version", type=int, help="registered model version (default: latest)",
+                        dest="model_version", default=None)
+    parser.add_argument("--data", type=str, help="framingham csv the request rows are drawn from", dest="data",
+                        default=os.path.join(scriptDir, '..', 'framingham.csv'))
+    parser.add_argument("--features", type=str, help="comma separated model features", dest="features",
+                        default="age,prevalentHyp,sysBP,glucose")
+    parser.add_argument("--batch_sizes", type=str, help="comma separated rows per request to benchmark",
+                        dest="batch_sizes", default="1,10,100")
+    parser.add_argument("--workers", type=str, help="comma separated worker process counts to benchmark "
+                        "(default: the one worker of the build image)", dest="workers", default="1")
+    parser.add_argument("--threads", type=str, help="comma separated threads per worker to benchmark",
+                        dest="threads", default="1,2")
+    parser.add_argument("--duration", type=float, help="seconds measured per configuration", dest="duration",
+                        default=3.0)
+    parser.add_argument("--target_qps", type=float, help="requests per second the service has to sustain",
+                        dest="target_qps", required=True)
+    parser.add_argument("--p99_slo_ms", type=float, help="p99 scoring latency objective, in ms", dest="p99_slo_ms",
+                        required=True)
+    parser.add_argument("--request_rows", type=int, help="typical rows per request (closest batch size is used)",
+                        dest="request_rows", default=1)
+    parser.add_argument("--target_utilization", type=float, help="CPU utilization autoscale keeps replicas at",
+                        dest="target_utilization", default=0.7)
+    parser.add_argument("--burst_factor", type=float, help="autoscale max replicas, relative to the min",
+                        dest="burst_factor", default=2.0)
+    parser.add_argument("--memory_headroom", type=float, help="memory limit over the measured worker RSS",
+                        dest="memory_headroom", default=1.5)
+    parser.add_argument("--output", type=str, help="capacity plan json, passed on to deploy-rest-service.py --capacity_plan",
+                        dest="output", required=True)
+    args = parser.parse_args()
+    print(vars(args))
+    print('..1. completed')
+    print('')
+    print('')
+
+    print("2. Prepare the scoring script and requests")
+    print('.............................................')
+    amlWs = Workspace.from_config()
+    # Makes the registered model available where score.init() looks for it
+    modelPath = Model.get_model_path(args.model_name, version=args.model_version, _workspace=amlWs)
+    print('Model path: ', modelPath)
+    scoringDir = tempfile.mkdtemp(prefix='chd-capacity-')
+    for dependency in scoring_environment.SCORING_DEPENDENCIES:
+        shutil.copyfile(os.path.join(scriptDir, dependency), os.path.join(scoringDir, dependency))
+    scoreFile = scoring_environment.write_scoring_script(
+        args.model_name, os.path.join(scriptDir, scoring_environment.SCORING_SCRIPT),
+        os.path.join(scoringDir, scoring_environment.SCORING_SCRIPT_FIXED))
+    sys.path.insert(0, scoringDir)
+    # Request logging would only add noise to the measurement
+    os.environ.setdefault('CHD_LOG_SAMPLE_RATE', '0')
+
+    rows = pd.read_csv(args.data)[args.features.split(',')]
+    rows = rows.astype(object).where(rows.notnull(), None).values.tolist()
+    batchSizes = [int(size) for size in args.batch_sizes.split(',')]
+    payloads = {}
+    for batchSize in batchSizes:
+        payloads[batchSize] = [json.dumps({"data": [rows[(i + j) % len(rows)] for j in range(batchSize)]})
+                               for i in range(0, max(len(rows), batchSize * 50), batchSize)][:500]
+    cpuCount = multiprocessing.cpu_count()
+    print('CPU cores on the build agent: ', cpuCount)
+    print('..2. completed')
+    print('')
+    print('')
+
+    print("3. Benchmark score.run")
+    print('.............................................')
+    results = []
+    print("%7s %7s %6s %10s %12s %14s %9s %9s %8s %7s" % ("workers", "threads", "rows", "req/s", "rows/s",
+                                                          "rows/s/core", "p50 ms", "p99 ms", "RSS MB", "errors"))
+    for workers in [int(count) for count in args.workers.split(',')]:
+        if workers > cpuCount:
+            print("%d workers skipped: only %d cores" % (workers, cpuCount))
+            continue
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(scoreFile,))
+        for threads in [int(count) for count in args.threads.split(',')]:
+            for batchSize in batchSizes:
+                startTime = time.time() + 0.5
+                tasks = [(payloads[batchSize], batchSize, threads, startTime, args.duration)] * workers
+                measured = pool.map(_measure_worker, tasks, chunksize=1)
+                latencies = np.array([latency for m in measured for latency in m["latencies"]])
+                cpuSeconds = sum(m["cpu_seconds"] for m in measured)
+                result = {
+                    "workers": workers,
+                    "threads": threads,
+                    "batch_size": batchSize,
+                    "requests_per_second": len(latencies) / args.duration,
+                    "rows_per_second": sum(m["rows"] for m in measured) / args.duration,
+                    "cpu_cores_used": cpuSeconds / args.duration,
+                    "p50_ms": float(np.percentile(latencies, 50)) * 1000 if len(latencies) else None,
+                    "p99_ms": float(np.percentile(latencies, 99)) * 1000 if len(latencies) else None,
+                    "peak_rss_mb_per_worker": max(m["peak_rss_mb"] for m in measured),
+                    "errors": sum(m["errors"] for m in measured),
+                }
+                result["rows_per_second_per_core"] = result["rows_per_second"] / max(result["cpu_cores_used"], 1e-9)
+                results.append(result)
+                print("%7d %7d %6d %10.1f %12.1f %14.1f %9.2f %9.2f %8.1f %7d" % (
+                    workers, threads, batchSize, result["requests_per_second"], result["rows_per_second"],
+                    result["rows_per_second_per_core"], result["p50_ms"], result["p99_ms"],
+                    result["peak_rss_mb_per_worker"], result["errors"]))
+        pool.terminate()
+        pool.join()
+    print('..3. completed')
+    print('')
+    print('')
+
+    print("4. Derive the deployment configuration")
+    print('.............................................')
+    planBatchSize = min(batchSizes, key=lambda size: abs(size - args.request_rows))
+    candidates = [r for r in results if r["batch_size"] == planBatchSize and not r["errors"]]
+    if not candidates:
+        print("No error-free configuration measured for %d rows per request!" % planBatchSize)
+        sys.exit(1)
+    withinSlo = [r for r in candidates if r["p99_ms"] <= args.p99_slo_ms]
+    sloMet = bool(withinSlo)
+    if sloMet:
+        # Fewest replica cores for the target: highest requests/s per core used
+        chosen = max(withinSlo, key=lambda r: r["requests_per_second"] / max(r["cpu_cores_used"], 1e-9))
+    else:
+        chosen = min(candidates, key=lambda r: r["p99_ms"])
+        print("WARNING: no configuration meets the p99 SLO of %.1f ms, using the lowest p99 (%.1f ms)" % (
+            args.p99_slo_ms, chosen["p99_ms"]))
+
+    cpuCores = max(0.1, _round_up(chosen["cpu_cores_used"], 0.1))
+    memoryGb = max(0.5, _round_up(chosen["workers"] * chosen["peak_rss_mb_per_worker"] * args.memory_headroom / 1024,
+                                  0.1))
+    replicaQps = chosen["requests_per_second"]
+    minReplicas = max(1, int(math.ceil(args.target_qps / (replicaQps * args.target_utilization))))
+    maxReplicas = max(minReplicas, int(math.ceil(minReplicas * args.burst_factor)))
+    deployConfiguration = {
+        "cpu_cores": round(cpuCores, 1),
+        "memory_gb": round(memoryGb, 1),
+        "autoscale_enabled": True,
+        "autoscale_min_replicas": minReplicas,
+        "autoscale_max_replicas": maxReplicas,
+        "autoscale_target_utilization": int(round(args.target_utilization * 100)),
+        "replica_max_concurrent_requests": chosen["workers"] * chosen["threads"],
+    }
+    # What the service gets with the defaults (0.1 core, one request at a time per replica)
+    defaultQps = replicaQps * 0.1 / max(chosen["cpu_cores_used"], 1e-9)
+    print("Chosen container: %d workers x %d threads, %.1f req/s at p99 %.2f ms" % (
+        chosen["workers"], chosen["threads"], replicaQps, chosen["p99_ms"]))
+    print("Deploy configuration: ", deployConfiguration)
+    print("Default configuration would serve ~%.1f req/s per replica, %.1f needed in total" % (
+        defaultQps, args.target_qps))
+
+    plan = {
+        "model_name": args.model_name,
+        "model_version": args.model_version,
+        "target_qps": args.target_qps,
+        "p99_slo_ms": args.p99_slo_ms,
+        "request_rows": planBatchSize,
+        "slo_met": sloMet,
+        "chosen": chosen,
+        "worker_count": chosen["workers"],
+        "deploy_configuration": deployConfiguration,
+        "build_agent_cores": cpuCount,
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(plan, f, indent=2)
+    print('Capacity plan saved! -', args.output)
+    shutil.rmtree(scoringDir, ignore_errors=True)
+    print('..4. completed')
+    print('')
+    print('')
+
+    print("*********************************************")
+    print("EXITING capacity_planner.py")
+    print("*********************************************")
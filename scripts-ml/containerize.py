@@ -1,5 +1,6 @@
 import argparse
 import os, json, sys
+import time
 
 import azureml.core
 from azureml.core import Workspace
@@ -13,6 +14,8 @@ from azureml.core.conda_dependencies import CondaDependencies
 from azureml.core.image import ContainerImage
 from azureml.core import Image
 
+import scoring_environment
+
 print("*********************************************")
 print("INSIDE containerize.py")
 print("*********************************************")
@@ -34,12 +37,15 @@ parser = argparse.ArgumentParser("containerize")
 parser.add_argument("--model_name", type=str, help="model name", dest="model_name", required=True)
 parser.add_argument("--image_name", type=str, help="image name", dest="image_name", required=True)
 parser.add_argument("--output", type=str, help="containerize output directory", dest="output", required=True)
+parser.add_argument("--model_version", type=int, help="registered model version to containerize (default: the newest)",
+                    dest="model_version", default=None)
 
 args = parser.parse_args()
 
 print("Argument 1: %s" % args.model_name)
 print("Argument 2: %s" % args.image_name)
 print("Argument 3: %s" % args.output)
+print("Argument 4: %s" % args.model_version)
 
 os.makedirs(args.output, exist_ok=True)
 containerizeStepFilePath = os.path.join(args.output, logInfoOutputJsonName)
@@ -57,8 +63,12 @@ print('')
 
 print('3.  Get freshly trained model details from model registry')
 print('.............................................')
-modelList = Model.list(amlWs, name = args.model_name)
-currentlyTrainedModelInRegistry = sorted(modelList, reverse=True, key = lambda x: x.created_time)[0]
+if args.model_version is not None:
+    # Train step skipped on a build step cache hit: containerize the model it registered
+    currentlyTrainedModelInRegistry = Model(amlWs, name = args.model_name, version = args.model_version)
+else:
+    modelList = Model.list(amlWs, name = args.model_name)
+    currentlyTrainedModelInRegistry = sorted(modelList, reverse=True, key = lambda x: x.created_time)[0]
 
 if currentlyTrainedModelInRegistry != None:
     print('..Freshly trained model found!')
@@ -72,7 +82,8 @@ if currentlyTrainedModelInRegistry != None:
     currentlyTrainedModelVersion = currentlyTrainedModelInRegistry.version
     print('Currently trained model version: ', currentlyTrainedModelVersion)
 
-    currentlyTrainedModelPath = currentlyTrainedModelInRegistry.get_model_path(currentlyTrainedModelName, _workspace=amlWs)
+    currentlyTrainedModelPath = currentlyTrainedModelInRegistry.get_model_path(currentlyTrainedModelName,
+                                                                           version=currentlyTrainedModelVersion, _workspace=amlWs)
     print('Currently trained model path: ', currentlyTrainedModelPath)
 
     currentlyTrainedModelRunId = currentlyTrainedModelInRegistry.tags.get("run_id")
@@ -173,18 +184,14 @@ print('7.  Deploy model, if applicable')
 print('.............................................')
 
 print('....7.1. Updating scoring file with the correct model name')
-with open('score.py') as f:
-    data = f.read()
-with open('score_fixed.py', "w") as f:
-    f.write(data.replace('MODEL-NAME', args.model_name)) 
-    print('score_fixed.py saved')
+scoringScript = scoring_environment.write_scoring_script(args.model_name)
+print(scoringScript, 'saved')
 print('....7.1. completed')
 print('')
 
 print('....7.2. Creating conda dependencies file')
-condaPackages = ['numpy','scikit-learn']
-pipPackages = ['azureml-sdk', 'azureml-monitoring']
-chdCondaEnv = CondaDependencies.create(conda_packages=condaPackages, pip_packages=pipPackages)
+chdCondaEnv = CondaDependencies.create(conda_packages=scoring_environment.CONDA_PACKAGES,
+                                      pip_packages=scoring_environment.PIP_PACKAGES)
 
 condaDependenciesYamlFile = 'scoring_dependencies.yml'
 with open(condaDependenciesYamlFile, 'w') as f:
@@ -193,26 +200,67 @@ with open(condaDependenciesYamlFile, 'w') as f:
 print('....7.2. completed')
 print('')
 
-print('....7.3. Creating and registering container image in Azure Container Registry')
-containerImageConf = ContainerImage.image_configuration(execution_script = 'score_fixed.py', 
-                                                  runtime = 'python', conda_file = condaDependenciesYamlFile)
+print('....7.3. Looking for an image with the same environment')
+# Everything but the model: conda spec, templated scoring script and helper modules
+environmentHash = scoring_environment.environment_hash(condaDependenciesYamlFile, scoringScript)
+print('Environment hash: ', environmentHash)
+imageCacheInfo = {"environment_hash": environmentHash, "decision": "build", "base_image_id": None}
+baseImage = None
+try:
+    cachedImages = [image for image in Image.list(amlWs, image_name=args.image_name,
+                                                  tags=[['environment_hash', environmentHash]])
+                    if image.creation_state == 'Succeeded']
+    if cachedImages:
+        latestImage = sorted(cachedImages, key=lambda image: image.created_time)[-1]
+        # Always layer on the full build, so model layers don't pile up build after build
+        baseImage = Image(amlWs, id=latestImage.tags.get('environment_base_image', latestImage.id))
+        imageCacheInfo.update(decision="reuse", base_image_id=baseImage.id, reason="environment unchanged")
+        print('Reusing the environment of image: ', baseImage.id)
+    else:
+        imageCacheInfo["reason"] = "no image with this environment"
+        print('No image with this environment, building it')
+except Exception as e:
+    imageCacheInfo["reason"] = "image lookup failed: %s" % e
+    print('Image lookup failed, building the environment: ', e)
+print('....7.3. completed')
+print('')
+
+print('....7.4. Creating and registering container image in Azure Container Registry')
+imageTags = {'environment_hash': environmentHash}
+if baseImage is not None:
+    # The base image already holds the conda environment and scoring files: no conda
+    # file, only the new model is added on top of it
+    imageTags['environment_base_image'] = baseImage.id
+    containerImageConf = ContainerImage.image_configuration(execution_script = scoringScript,
+                                                      runtime = 'python', base_image = baseImage.image_location,
+                                                      dependencies = scoring_environment.SCORING_DEPENDENCIES,
+                                                      tags = imageTags)
+else:
+    containerImageConf = ContainerImage.image_configuration(execution_script = scoringScript, 
+                                                      runtime = 'python', conda_file = condaDependenciesYamlFile,
+                                                      dependencies = scoring_environment.SCORING_DEPENDENCIES,
+                                                      tags = imageTags)
 
 
+imageBuildStart = time.time()
 containerImageForCHD = Image.create(name=args.image_name, models=[currentlyTrainedModelInRegistry], image_config=containerImageConf, workspace=amlWs)
 
 # Block till completion of image creation and registry entry
 containerImageForCHD.wait_for_creation(show_output=True)
 containerizeStepLogInfo["image_id"] = containerImageForCHD.id
+imageCacheInfo["build_seconds"] = time.time() - imageBuildStart
+containerizeStepLogInfo["image_cache"] = imageCacheInfo
+print('Image cache: ', imageCacheInfo)
 
-print('....7.3. completed')
+print('....7.4. completed')
 print('')
 
-print('....7.4. Persisting output to JSON file')
+print('....7.5. Persisting output to JSON file')
 containerizeStepLogInfo["deploy_model_bool"] = deployModelBool
 with open(containerizeStepFilePath, "w") as f:
     json.dump(containerizeStepLogInfo, f)
     print(logInfoOutputJsonName, ' saved')
-print('....7.4. completed')
+print('....7.5. completed')
 print('')
 
 print('..7. completed')
@@ -0,0 +1,94 @@
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
+import urllib.request
+
+import pandas as pd
+import pyarrow.feather as feather
+
+# Content-addressed cache for the training dataset.
+# The first read of a given CSV content parses it once with an explicit schema and
+# stores it as an uncompressed Feather file named after the content hash; later reads
+# load that columnar file and skip both the download and the CSV parse. URLs are keyed
+# on the Content-MD5 the blob store reports on a HEAD request (no download needed to
+# check for a hit); local files and URLs without an MD5 are keyed on the SHA-256 of the
+# bytes.
+# The cache only pays off when its directory outlives the run: an AML step runs in a
+# fresh container, so the pipeline passes a datastore mount (or, locally, a folder of
+# the local workspace). Without a cache directory the CSV is read directly.
+
+# Same dtypes pandas infers for framingham.csv (float64 wherever values are missing)
+FRAMINGHAM_SCHEMA = {
+    'male': 'int64', 'age': 'int64', 'education': 'float64', 'currentSmoker': 'int64',
+    'cigsPerDay': 'float64', 'BPMeds': 'float64', 'prevalentStroke': 'int64', 'prevalentHyp': 'int64',
+    'diabetes': 'int64', 'totChol': 'float64', 'sysBP': 'float64', 'diaBP': 'float64', 'BMI': 'float64',
+    'heartRate': 'float64', 'glucose': 'float64', 'TenYearCHD': 'int64',
+}
+
+
+def is_url(source):
+    return source.startswith('http://') or source.startswith('https://')
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return 'sha256-' + digest.hexdigest()
+
+
+def _remote_md5(url):
+    request = urllib.request.Request(url, method='HEAD')
+    with urllib.request.urlopen(request) as response:
+        contentMd5 = response.headers.get('Content-MD5')
+    if not contentMd5:
+        return None
+    return 'md5-' + base64.b64decode(contentMd5).hex()
+
+
+def download(url, directory=None):
+    handle, path = tempfile.mkstemp(suffix='.csv', dir=directory)
+    with os.fdopen(handle, 'wb') as f, urllib.request.urlopen(url) as response:
+        shutil.copyfileobj(response, f)
+    return path
+
+
+def _convert(csvPath, cachePath, schema):
+    df = pd.read_csv(csvPath, dtype=schema)
+    # Write to a temporary name first so a concurrent reader never sees a partial file
+    temporaryPath = cachePath + '.%d.tmp' % os.getpid()
+    feather.write_feather(df, temporaryPath, compression='uncompressed')
+    os.replace(temporaryPath, cachePath)
+    return df
+
+
+def load_dataset(source, cache_dir=None, schema=FRAMINGHAM_SCHEMA):
+    if not cache_dir:
+        return pd.read_csv(source, dtype=schema)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    downloaded = None
+    try:
+        if is_url(source):
+            key = _remote_md5(source)
+            if key is None:
+                downloaded = download(source, cache_dir)
+                key = _file_sha256(downloaded)
+        else:
+            key = _file_sha256(source)
+
+        cachePath = os.path.join(cache_dir, key + '.feather')
+        if os.path.exists(cachePath):
+            print("Dataset cache hit: ", cachePath)
+            return feather.read_feather(cachePath)
+
+        print("Dataset cache miss, converting to: ", cachePath)
+        if is_url(source) and downloaded is None:
+            downloaded = download(source, cache_dir)
+        return _convert(downloaded or source, cachePath, schema)
+    finally:
+        if downloaded is not None and os.path.exists(downloaded):
+            os.remove(downloaded)
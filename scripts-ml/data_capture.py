@@ -0,0 +1,168 @@
+import atexit
+import collections
+import gzip
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+# Input/prediction capture for score.py, replacing the per-request ModelDataCollector
+# calls. run() only appends a tuple of references (inputs, predictions, model version,
+# latency) to a bounded deque; deque appends are atomic, so the request path takes no
+# lock and does no I/O. A background thread drains the buffer in batches and hands the
+# rows to a collector: rotating gzip JSONL or Parquet files in a local directory, or
+# the Azure ModelDataCollector (blob storage) in the AKS service.
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    from azureml.monitoring import ModelDataCollector
+except ImportError:
+    ModelDataCollector = None
+
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+
+
+class LocalDirectoryCollector(object):
+    # Rotating files in a directory: gzip JSONL members appended to the current file
+    # until it reaches max_file_bytes, or one Parquet file per batch. At most max_files
+    # files are kept, the oldest are deleted.
+
+    def __init__(self, directory, format='jsonl', max_file_bytes=64 << 20, max_files=100):
+        if format not in ('jsonl', 'parquet'):
+            raise ValueError("unsupported capture format: %s" % format)
+        if format == 'parquet' and pyarrow is None:
+            raise ImportError("pyarrow is required for Parquet capture files")
+        self.directory = directory
+        self.format = format
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self._current = None
+        self._sequence = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _new_path(self, extension):
+        self._sequence += 1
+        name = 'capture-%s-%d-%06d.%s' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid(), self._sequence, extension)
+        return os.path.join(self.directory, name)
+
+    def _prune(self):
+        files = sorted(f for f in os.listdir(self.directory) if f.startswith('capture-'))
+        for name in files[:max(0, len(files) - self.max_files)]:
+            os.remove(os.path.join(self.directory, name))
+
+    def write(self, columns, rows):
+        if self.format == 'parquet':
+            table = pyarrow.Table.from_pydict({name: [row[i] for row in rows] for i, name in enumerate(columns)})
+            parquet.write_table(table, self._new_path('parquet'), compression='snappy')
+        else:
+            if self._current is None or os.path.getsize(self._current) >= self.max_file_bytes:
+                self._current = self._new_path('jsonl.gz')
+            lines = ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+            with gzip.open(self._current, 'at') as f:
+                f.write(lines)
+        self._prune()
+
+
+class AzureModelDataCollector(object):
+    # The Azure ML data collector of the AKS service, fed in batches
+
+    def __init__(self, feature_names, model_name='model_telemetry'):
+        if ModelDataCollector is None:
+            raise ImportError("azureml-monitoring is required for the Azure data collector")
+        self.feature_names = list(feature_names)
+        self.inputs_dc = ModelDataCollector(model_name, identifier="inputs", feature_names=self.feature_names)
+        self.prediction_dc = ModelDataCollector(model_name, identifier="predictions", feature_names=["prediction"])
+
+    def write(self, columns, rows):
+        featureIndex = [columns.index(name) for name in self.feature_names]
+        predictionIndex = columns.index("prediction")
+        self.inputs_dc.collect([[row[i] for i in featureIndex] for row in rows])
+        self.prediction_dc.collect([row[predictionIndex] for row in rows])
+
+
+def make_collector(spec, feature_names, format='jsonl'):
+    # 'azure' for the Azure ML collector, anything else is a local directory
+    if spec == 'azure':
+        return AzureModelDataCollector(feature_names)
+    return LocalDirectoryCollector(spec, format=format)
+
+
+class DataCapture(object):
+
+    def __init__(self, collector, feature_names, capacity=10000, drop_policy=DROP_OLDEST, flush_seconds=5.0,
+                 batch_size=1000):
+        if drop_policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("unsupported drop policy: %s" % drop_policy)
+        self.collector = collector
+        self.feature_names = list(feature_names)
+        self.columns = ["time", "model_version", "latency_ms"] + self.feature_names + ["prediction"]
+        self.capacity = capacity
+        self.drop_policy = drop_policy
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self.captured = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.errors = 0
+        self._buffer = collections.deque(maxlen=capacity if drop_policy == DROP_OLDEST else None)
+        self._wake = threading.Event()
+        self._stopped = False
+        self._worker = threading.Thread(target=self._run, name='data-capture', daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def capture(self, inputs, predictions, model_version, latency_seconds):
+        # Request path: one append, no copy and no I/O
+        if self.drop_policy == DROP_NEWEST and len(self._buffer) >= self.capacity:
+            self.dropped += 1
+            return
+        if len(self._buffer) == self.capacity:
+            self.dropped += 1
+        self._buffer.append((time.time(), model_version, latency_seconds * 1000.0, inputs, predictions))
+        self.captured += 1
+
+    def _rows(self, records):
+        rows = []
+        for timestamp, modelVersion, latencyMs, inputs, predictions in records:
+            inputs = np.asarray(inputs).tolist()
+            predictions = np.asarray(predictions).tolist()
+            for features, prediction in zip(inputs, predictions):
+                rows.append([timestamp, modelVersion, latencyMs] + features + [prediction])
+        return rows
+
+    def flush(self):
+        while self._buffer:
+            records = []
+            while self._buffer and len(records) < self.batch_size:
+                records.append(self._buffer.popleft())
+            try:
+                rows = self._rows(records)
+                self.collector.write(self.columns, rows)
+                self.flushed += len(rows)
+            except Exception as e:
+                self.errors += 1
+                print("Data capture flush failed: ", e)
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            self.flush()
+
+    def close(self):
+        self._stopped = True
+        self._wake.set()
+        self._worker.join(timeout=self.flush_seconds + 5)
+        self.flush()
+
+    def stats(self):
+        return {"captured": self.captured, "dropped": self.dropped, "flushed": self.flushed,
+                "buffered": len(self._buffer), "errors": self.errors}
@@ -0,0 +1,144 @@
+import json
+import threading
+
+import numpy as np
+
+# Constant-memory feature distribution sketches for drift detection in the scoring
+# service. Each feature gets fixed bins whose cut points are the training quantiles,
+# plus counts of missing values and of values outside the training range. train.py
+# stores the sketch of the training data with the model (the reference); score.py
+# keeps a live sketch with the same bins, updated per request with one searchsorted per
+# feature and a single bincount, and compares both with the population stability index (PSI)
+# and a binned Kolmogorov-Smirnov statistic.
+
+DEFAULT_BINS = 20
+# Proportion floor for PSI, so empty bins don't make it infinite
+PSI_EPSILON = 1e-4
+
+
+class DriftSketch(object):
+
+    def __init__(self, columns, cut_points, counts=None, missing=None, below=None, above=None, minimums=None,
+                 maximums=None, rows=0):
+        # cut_points[i] are the interior bin edges of columns[i]: len(cut_points[i]) + 1 bins
+        self.columns = list(columns)
+        self.cut_points = [np.asarray(points, dtype=np.float64) for points in cut_points]
+        n = len(self.columns)
+        # Bin counts of every feature in one flat array, self.counts[i] are views into it
+        self._offsets = np.cumsum([0] + [len(points) + 1 for points in self.cut_points])
+        self._flat = np.zeros(self._offsets[-1], dtype=np.int64)
+        if counts is not None:
+            self._flat[:] = np.concatenate([np.asarray(c, dtype=np.int64) for c in counts] or [self._flat[:0]])
+        self.counts = [self._flat[self._offsets[i]:self._offsets[i + 1]] for i in range(n)]
+        self.missing = np.asarray(missing if missing is not None else np.zeros(n), dtype=np.int64)
+        self.below = np.asarray(below if below is not None else np.zeros(n), dtype=np.int64)
+        self.above = np.asarray(above if above is not None else np.zeros(n), dtype=np.int64)
+        self.minimums = np.asarray(minimums if minimums is not None else np.full(n, -np.inf), dtype=np.float64)
+        self.maximums = np.asarray(maximums if maximums is not None else np.full(n, np.inf), dtype=np.float64)
+        self.rows = rows
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_data(cls, X, columns, n_bins=DEFAULT_BINS):
+        # Reference sketch: quantile cut points and training range, then the counts of X
+        X = np.asarray(X, dtype=np.float64)
+        cutPoints, minimums, maximums = [], [], []
+        for i in range(X.shape[1]):
+            values = X[:, i][~np.isnan(X[:, i])]
+            if len(values) == 0:
+                cutPoints.append([])
+                minimums.append(-np.inf)
+                maximums.append(np.inf)
+                continue
+            cutPoints.append(np.unique(np.percentile(values, np.linspace(0, 100, n_bins + 1)[1:-1])))
+            minimums.append(values.min())
+            maximums.append(values.max())
+        sketch = cls(columns, cutPoints, minimums=minimums, maximums=maximums)
+        sketch.update(X)
+        return sketch
+
+    def empty_like(self):
+        # Live sketch with the bins and range of this one
+        return DriftSketch(self.columns, self.cut_points, minimums=self.minimums, maximums=self.maximums)
+
+    def select(self, columns):
+        index = [self.columns.index(column) for column in columns]
+        return DriftSketch(columns, [self.cut_points[i] for i in index], [self.counts[i] for i in index],
+                           self.missing[index], self.below[index], self.above[index], self.minimums[index],
+                           self.maximums[index], self.rows)
+
+    def update(self, X):
+        # One bincount over all features: bin indices are offset into a flat counter array
+        X = np.asarray(X)
+        if not len(X):
+            return
+        missingMask = np.isnan(X)
+        index = np.concatenate([np.searchsorted(self.cut_points[i], X[:, i], side='right') + self._offsets[i]
+                                for i in range(len(self.columns))])
+        if missingMask.any():
+            index = index[~missingMask.T.ravel()]
+        flatCounts = np.bincount(index, minlength=self._offsets[-1])
+        with np.errstate(invalid='ignore'):
+            below = (X < self.minimums).sum(axis=0)
+            above = (X > self.maximums).sum(axis=0)
+        with self._lock:
+            self._flat += flatCounts
+            self.missing += missingMask.sum(axis=0)
+            self.below += below
+            self.above += above
+            self.rows += len(X)
+
+    def _proportions(self, i):
+        total = self.counts[i].sum()
+        return self.counts[i] / total if total else np.zeros(len(self.counts[i]))
+
+    def psi(self, reference):
+        scores = []
+        for i in range(len(self.columns)):
+            actual = np.maximum(self._proportions(i), PSI_EPSILON)
+            expected = np.maximum(reference._proportions(i), PSI_EPSILON)
+            scores.append(float(np.sum((actual - expected) * np.log(actual / expected))))
+        return scores
+
+    def ks(self, reference):
+        # Largest gap between the binned cumulative distributions
+        return [float(np.max(np.abs(np.cumsum(self._proportions(i)) - np.cumsum(reference._proportions(i)))))
+                for i in range(len(self.columns))]
+
+    def report(self, reference):
+        psi, ks = self.psi(reference), self.ks(reference)
+        rows = max(self.rows, 1)
+        features = {}
+        for i, column in enumerate(self.columns):
+            features[column] = {"psi": psi[i], "ks": ks[i], "missing_rate": float(self.missing[i]) / rows,
+                                "out_of_range_rate": float(self.below[i] + self.above[i]) / rows,
+                                "reference_missing_rate": float(reference.missing[i]) / max(reference.rows, 1)}
+        return {"rows": self.rows, "reference_rows": reference.rows, "max_psi": max(psi or [0.0]),
+                "max_ks": max(ks or [0.0]), "features": features}
+
+    def to_dict(self):
+        return {
+            "columns": self.columns,
+            "cut_points": [points.tolist() for points in self.cut_points],
+            "counts": [counts.tolist() for counts in self.counts],
+            "missing": self.missing.tolist(),
+            "below": self.below.tolist(),
+            "above": self.above.tolist(),
+            "minimums": self.minimums.tolist(),
+            "maximums": self.maximums.tolist(),
+            "rows": self.rows,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["columns"], data["cut_points"], data["counts"], data["missing"], data["below"],
+                   data["above"], data["minimums"], data["maximums"], data["rows"])
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
@@ -0,0 +1,244 @@
+import json
+import os
+import pickle
+import threading
+import numpy as np
+
+import model_bundle
+
+# Array-backed evaluator for a fitted RandomForestClassifier.
+# Every tree of the forest is concatenated into one set of flat node arrays, so a
+# whole request batch is routed through all the trees with a few vectorized numpy
+# operations per depth level instead of one Python call per tree. That wins for small
+# requests; from SKLEARN_MIN_ROWS rows on, scikit-learn's compiled traversal is faster
+# and the fitted model is used instead (loaded on first use when the engine was mapped
+# from the saved arrays).
+
+# Node arrays persisted by save(); load() maps them back read-only, so worker
+# processes share the same page cache instead of each unpickling the forest
+ARRAY_NAMES = ('feature', 'threshold', 'left', 'right', 'value', 'roots')
+FORMAT_VERSION = 1
+
+# Upper bound on (trees x rows) node indices held in memory at once
+MAX_CELLS_PER_CHUNK = 1 << 21
+
+# Batch size from which RandomForestClassifier.predict_proba is faster, about the same
+# for 100 and 1000 trees (benchmark_forest_engine.py)
+SKLEARN_MIN_ROWS = 150
+
+
+class ForestEngine(object):
+
+    def __init__(self, feature, threshold, left, right, value, roots, classes, max_depth):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.roots = roots
+        self.classes = classes
+        self.max_depth = max_depth
+        self.n_trees = len(roots)
+        self.n_features = None
+        self.model = None
+        self.model_path = None
+        # Threads of the fitted model's predict_proba; None keeps the n_jobs it was fitted
+        # with. Processes of a worker pool set 1, so N processes don't run N threads each
+        self.n_jobs = None
+        self._model_lock = threading.Lock()
+
+    @classmethod
+    def from_model(cls, model):
+        features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+        offset = 0
+        maxDepth = 0
+        for estimator in model.estimators_:
+            tree = estimator.tree_
+            nodeCount = tree.node_count
+            nodeIds = np.arange(offset, offset + nodeCount, dtype=np.intp)
+            isLeaf = tree.children_left == -1
+
+            # Leaves point to themselves, so extra traversal steps keep rows in place
+            left = np.where(isLeaf, nodeIds, tree.children_left + offset)
+            right = np.where(isLeaf, nodeIds, tree.children_right + offset)
+            feature = np.where(isLeaf, 0, tree.feature)
+
+            # Same per-node normalisation as DecisionTreeClassifier.predict_proba
+            value = np.array(tree.value[:, 0, :model.n_classes_], dtype=np.float64)
+            normalizer = value.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            value /= normalizer
+
+            features.append(feature)
+            thresholds.append(tree.threshold)
+            lefts.append(left)
+            rights.append(right)
+            values.append(value)
+            roots.append(offset)
+            offset += nodeCount
+            maxDepth = max(maxDepth, tree.max_depth)
+
+        engine = cls(
+            feature=np.ascontiguousarray(np.concatenate(features), dtype=np.intp),
+            threshold=np.ascontiguousarray(np.concatenate(thresholds), dtype=np.float64),
+            left=np.ascontiguousarray(np.concatenate(lefts), dtype=np.intp),
+            right=np.ascontiguousarray(np.concatenate(rights), dtype=np.intp),
+            value=np.ascontiguousarray(np.concatenate(values), dtype=np.float64),
+            roots=np.asarray(roots, dtype=np.intp),
+            classes=np.asarray(model.classes_),
+            max_depth=maxDepth)
+        engine.n_features = getattr(model, 'n_features_in_', getattr(model, 'n_features_', None))
+        engine.model = model
+        return engine
+
+    def save(self, directory):
+        for name in ARRAY_NAMES:
+            np.save(os.path.join(directory, model_bundle.FOREST_ARRAY_FILE % name), getattr(self, name))
+        manifest = {
+            "format_version": FORMAT_VERSION,
+            "n_trees": int(self.n_trees),
+            "n_nodes": int(len(self.feature)),
+            "n_features": None if self.n_features is None else int(self.n_features),
+            "max_depth": int(self.max_depth),
+            "classes": self.classes.tolist(),
+        }
+        with open(os.path.join(directory, model_bundle.FOREST_MANIFEST), "w") as f:
+            json.dump(manifest, f)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        with open(os.path.join(directory, model_bundle.FOREST_MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest["format_version"] != FORMAT_VERSION:
+            raise ValueError("Unsupported forest artifact version: %s" % manifest["format_version"])
+        arrays = {}
+        for name in ARRAY_NAMES:
+            arrays[name] = np.load(os.path.join(directory, model_bundle.FOREST_ARRAY_FILE % name),
+                                   mmap_mode=mmap_mode, allow_pickle=False)
+        engine = cls(classes=np.asarray(manifest["classes"]), max_depth=manifest["max_depth"], **arrays)
+        engine.n_features = manifest["n_features"]
+        engine.model_path = model_bundle.component_path(directory, model_bundle.MODEL_FILE)
+        return engine
+
+    def _sklearn_model(self):
+        # The pickled forest only costs memory in processes that see large batches
+        if self.model is None and self.model_path is not None:
+            with self._model_lock:
+                if self.model is None:
+                    with open(self.model_path, 'rb') as f:
+                        self.model = pickle.load(f)
+        if self.model is not None and self.n_jobs is not None:
+            self.model.n_jobs = self.n_jobs
+        return self.model
+
+    def check_features(self, X):
+        # Rows of the expected width, before any imputation (missing values allowed)
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if X.ndim != 2:
+            raise ValueError("Expected a 2D array of rows, got %d dimensions" % X.ndim)
+        if self.n_features is not None and X.shape[1] != self.n_features:
+            raise ValueError("X has %d features, but the model is expecting %d features as input"
+                             % (X.shape[1], self.n_features))
+        return X
+
+    def _check_input(self, X):
+        # scikit-learn evaluates trees on float32 inputs; do the same so the
+        # threshold comparisons are identical
+        X = self.check_features(X)
+        if not np.isfinite(X).all():
+            raise ValueError("Input contains NaN, infinity or a value too large for dtype('float32').")
+        return X
+
+    def apply(self, X, trees=None):
+        # Leaf node index reached by every (tree, row) pair, shape (n_trees, n_rows)
+        roots = self.roots if trees is None else self.roots[trees]
+        nRows, nFeatures = X.shape
+        leaves = np.repeat(roots, nRows)
+        # Only the cells still inside a tree are stepped: a cell is dropped once it
+        # reaches a leaf (leaves point to themselves), so the work follows the actual
+        # path lengths instead of max_depth for every (tree, row) pair
+        cells = np.arange(leaves.size)
+        nodes = leaves.copy()
+        offsets = np.tile(np.arange(nRows) * nFeatures, len(roots))
+        flatX = np.ascontiguousarray(X).ravel()
+        while cells.size:
+            left = self.left[nodes]
+            inner = left != nodes
+            if not inner.all():
+                leaves[cells[~inner]] = nodes[~inner]
+                cells, nodes, offsets, left = cells[inner], nodes[inner], offsets[inner], left[inner]
+                if not cells.size:
+                    break
+            goLeft = flatX[offsets + self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(goLeft, left, self.right[nodes])
+        return leaves.reshape(len(roots), nRows)
+
+    def _chunks(self, nRows, nTrees=None):
+        nTrees = self.n_trees if nTrees is None else nTrees
+        rowsPerChunk = max(1, MAX_CELLS_PER_CHUNK // max(1, nTrees))
+        for start in range(0, nRows, rowsPerChunk):
+            yield slice(start, min(nRows, start + rowsPerChunk))
+
+    def predict_proba(self, X):
+        X = self._check_input(X)
+        if X.shape[0] >= SKLEARN_MIN_ROWS and self._sklearn_model() is not None:
+            return self.model.predict_proba(X)
+        proba = np.empty((X.shape[0], self.value.shape[1]), dtype=np.float64)
+        for chunk in self._chunks(X.shape[0]):
+            leafValues = self.value[self.apply(X[chunk])]
+            # Reducing over the leading axis adds the trees one after another, in
+            # estimator order, exactly like RandomForestClassifier.predict_proba
+            proba[chunk] = leafValues.sum(axis=0)
+        proba /= self.n_trees
+        return proba
+
+    def predict(self, X):
+        proba = self.predict_proba(X)
+        return self.classes.take(np.argmax(proba, axis=1), axis=0)
+
+    def predict_early_exit(self, X, confidence=None, block_size=100):
+        # Evaluates the trees block by block and retires a row as soon as the class
+        # vote is settled. With confidence=None the rule is exact: the margin between
+        # the leading class and the runner-up exceeds the number of trees left, so the
+        # remaining trees cannot flip the vote. With a z value (e.g. 3.0) a row also
+        # stops once the projected final margin is z standard errors above zero,
+        # treating the per-tree margins seen so far as a sample of the remaining ones.
+        # Returns the predictions and the number of trees used for each row.
+        X = self._check_input(X)
+        nRows, nClasses = X.shape[0], self.value.shape[1]
+        sums = np.zeros((nRows, nClasses), dtype=np.float64)
+        squares = np.zeros((nRows, nClasses, nClasses), dtype=np.float64)
+        treesUsed = np.zeros(nRows, dtype=np.intp)
+        active = np.arange(nRows)
+        for start in range(0, self.n_trees, block_size):
+            trees = np.arange(start, min(self.n_trees, start + block_size))
+            leafValues = self.value[self.apply(X[active], trees=trees)]
+            sums[active] += leafValues.sum(axis=0)
+            if confidence is not None:
+                squares[active] += np.einsum('tri,trj->rij', leafValues, leafValues)
+            treesUsed[active] = trees[-1] + 1
+
+            used = treesUsed[active]
+            remaining = self.n_trees - used
+            activeSums = sums[active]
+            ranked = np.argsort(activeSums, axis=1)
+            leader = ranked[:, -1]
+            runnerUp = ranked[:, -2] if nClasses > 1 else leader
+            index = np.arange(len(active))
+            margin = activeSums[index, leader] - activeSums[index, runnerUp]
+            settled = margin > remaining
+            if confidence is not None:
+                activeSquares = squares[active]
+                meanMargin = margin / used
+                meanSquare = (activeSquares[index, leader, leader] - 2 * activeSquares[index, leader, runnerUp]
+                              + activeSquares[index, runnerUp, runnerUp]) / used
+                std = np.sqrt(np.maximum(meanSquare - meanMargin ** 2, 0.0))
+                spread = confidence * std * np.sqrt(remaining * (1.0 + remaining / used.astype(np.float64)))
+                settled |= self.n_trees * meanMargin > spread
+            active = active[~settled]
+            if len(active) == 0:
+                break
+        predictions = self.classes.take(np.argmax(sums, axis=1), axis=0)
+        return predictions, treesUsed
@@ -0,0 +1,30 @@
+import time
+
+from sklearn.ensemble import RandomForestClassifier
+
+# Grows a random forest in warm_start increments instead of fitting a fixed number of
+# trees, tracking the out-of-bag score after each increment. Growth stops once the
+# OOB score has not improved by more than `tolerance` over the last `patience`
+# increments, or when max_trees is reached.
+
+
+def grow_forest(X, y, step=250, max_trees=10000, tolerance=0.001, patience=3, random_state=0, n_jobs=-1,
+                **forest_params):
+    forest = RandomForestClassifier(n_estimators=0, warm_start=True, oob_score=True,
+                                    random_state=random_state, n_jobs=n_jobs, **forest_params)
+    curve = []
+    while forest.n_estimators < max_trees:
+        forest.n_estimators = min(max_trees, forest.n_estimators + step)
+        start = time.time()
+        forest.fit(X, y)
+        curve.append({"n_estimators": forest.n_estimators, "oob_score": forest.oob_score_,
+                      "fit_seconds": time.time() - start})
+        print("....%d trees: oob score %.5f (%.1f s)" % (forest.n_estimators, forest.oob_score_,
+                                                           curve[-1]["fit_seconds"]))
+        if len(curve) > patience:
+            previousBest = max(point["oob_score"] for point in curve[:-patience])
+            recentBest = max(point["oob_score"] for point in curve[-patience:])
+            if recentBest - previousBest < tolerance:
+                break
+
+    return forest, curve
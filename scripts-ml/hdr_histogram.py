@@ -0,0 +1,83 @@
+import numpy as np
+
+# High dynamic range latency histogram (the HdrHistogram layout): values are integers
+# (microseconds here) counted in buckets that double in width, each split into
+# 2 ** sub_bucket_bits linear sub-buckets, so every recorded value keeps about
+# `significant_digits` digits of precision from 1 us to hours in a few tens of KB.
+# Histograms of the same precision merge by adding counts, and serialize sparsely.
+
+
+class HdrHistogram(object):
+
+    def __init__(self, significant_digits=3, highest_value=3600 * 10 ** 6):
+        self.significant_digits = significant_digits
+        self.highest_value = highest_value
+        # Smallest power of two holding 2 * 10^digits distinct values
+        self.sub_bucket_bits = int(np.ceil(np.log2(2 * 10 ** significant_digits)))
+        self.sub_bucket_half = 1 << (self.sub_bucket_bits - 1)
+        buckets = max(1, int(highest_value).bit_length() - self.sub_bucket_bits + 1)
+        self.counts = np.zeros((buckets + 1) * self.sub_bucket_half, dtype=np.int64)
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, values):
+        bucket = np.maximum(0, _bit_length(values) - self.sub_bucket_bits)
+        subBucket = values >> bucket
+        return ((bucket + 1) << (self.sub_bucket_bits - 1)) + subBucket - self.sub_bucket_half
+
+    def _value(self, index):
+        # Highest value counted at index
+        bucket = np.maximum(0, (index >> (self.sub_bucket_bits - 1)) - 1)
+        subBucket = index - (bucket << (self.sub_bucket_bits - 1))
+        return ((subBucket + 1) << bucket) - 1
+
+    def record(self, values):
+        values = np.clip(np.asarray(values, dtype=np.int64).ravel(), 0, self.highest_value)
+        if not len(values):
+            return
+        self.counts += np.bincount(self._index(values), minlength=len(self.counts))
+        self.total += len(values)
+        self.min = int(values.min()) if self.min is None else min(self.min, int(values.min()))
+        self.max = int(values.max()) if self.max is None else max(self.max, int(values.max()))
+
+    def merge(self, other):
+        if other.sub_bucket_bits != self.sub_bucket_bits or len(other.counts) != len(self.counts):
+            raise ValueError("histograms have different precision or range")
+        self.counts += other.counts
+        self.total += other.total
+        for name, pick in (('min', min), ('max', max)):
+            values = [v for v in (getattr(self, name), getattr(other, name)) if v is not None]
+            setattr(self, name, pick(values) if values else None)
+
+    def value_at_percentile(self, percentile):
+        if not self.total:
+            return None
+        rank = max(1, int(np.ceil(percentile / 100.0 * self.total)))
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        return min(int(self._value(index)), self.max)
+
+    def percentiles(self, percentiles=(50, 90, 99, 99.9, 99.99)):
+        return dict(('p%g' % p, self.value_at_percentile(p)) for p in percentiles)
+
+    def to_dict(self):
+        nonZero = np.flatnonzero(self.counts)
+        return {"significant_digits": self.significant_digits, "highest_value": self.highest_value,
+                "total": self.total, "min": self.min, "max": self.max,
+                "counts": dict((str(int(i)), int(self.counts[i])) for i in nonZero)}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data["significant_digits"], data["highest_value"])
+        for index, count in data["counts"].items():
+            histogram.counts[int(index)] = count
+        histogram.total, histogram.min, histogram.max = data["total"], data["min"], data["max"]
+        return histogram
+
+
+def _bit_length(values):
+    # Vectorized int.bit_length for non-negative int64 values
+    lengths = np.zeros(values.shape, dtype=np.int64)
+    nonZero = values > 0
+    lengths[nonZero] = np.floor(np.log2(values[nonZero])).astype(np.int64) + 1
+    return lengths
@@ -0,0 +1,114 @@
+import itertools
+import os
+import random
+import shutil
+import tempfile
+import time
+from multiprocessing import Pool
+
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.feature_selection import SelectFromModel
+from sklearn.metrics import accuracy_score, roc_auc_score
+from sklearn.model_selection import train_test_split
+
+# Successive-halving search over the train.py forest configuration.
+# Each rung scores the surviving candidates on a growing number of training rows in a
+# process pool, keeps the best 1/eta and multiplies the row budget by eta. The training
+# matrix is written once as .npy files in shared memory (/dev/shm when available) and
+# memory-mapped by every worker, instead of being pickled to each task.
+
+SEARCH_SPACE = {
+    "n_estimators": [100, 300, 1000, 3000, 10000],
+    "max_depth": [None, 8, 16],
+    "min_samples_leaf": [1, 5, 20],
+    "selector_max_depth": [2, 3],
+    "threshold": [0.08, 0.10, 0.12, 0.15],
+}
+
+# Matrices memory-mapped by each worker process, loaded by the pool initializer
+_shared = {}
+
+
+def _init_worker(directory):
+    for name in ("X_train", "y_train", "X_valid", "y_valid"):
+        _shared[name] = np.load(os.path.join(directory, name + ".npy"), mmap_mode='r')
+
+
+def _evaluate(config, rows, seed):
+    X_train, y_train = _shared["X_train"], _shared["y_train"]
+    if rows < len(y_train):
+        index = np.random.RandomState(seed).choice(len(y_train), rows, replace=False)
+        X_train, y_train = X_train[index], y_train[index]
+    trial = dict(config, rows=rows)
+    start = time.time()
+    try:
+        selector = RandomForestClassifier(n_estimators=100, max_depth=config["selector_max_depth"], random_state=0)
+        selector.fit(X_train, y_train)
+        sfm = SelectFromModel(selector, threshold=config["threshold"], prefit=True)
+        X_important_train = sfm.transform(X_train)
+        if X_important_train.shape[1] == 0:
+            raise ValueError("no feature above the selection threshold")
+        forest = RandomForestClassifier(n_estimators=config["n_estimators"], max_depth=config["max_depth"],
+                                        min_samples_leaf=config["min_samples_leaf"], random_state=0, n_jobs=1)
+        forest.fit(X_important_train, y_train)
+        trial["fit_seconds"] = time.time() - start
+
+        X_important_valid = sfm.transform(_shared["X_valid"])
+        start = time.time()
+        proba = forest.predict_proba(X_important_valid)
+        trial["predict_seconds"] = time.time() - start
+        trial["acc"] = accuracy_score(_shared["y_valid"], forest.classes_.take(np.argmax(proba, axis=1)))
+        trial["auc"] = roc_auc_score(_shared["y_valid"], proba[:, 1])
+        trial["n_features"] = int(X_important_train.shape[1])
+    except Exception as e:
+        trial["error"] = str(e)
+        trial["acc"] = None
+    return trial
+
+
+def _rank_key(trial):
+    # Best accuracy first; cheaper forests win ties
+    return (-trial["acc"], trial["n_estimators"]) if trial["acc"] is not None else (float('inf'), 0)
+
+
+def successive_halving(X, y, search_space=SEARCH_SPACE, n_candidates=32, eta=3, min_rows=None,
+                       workers=None, validation_size=0.25, random_state=0):
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    y = np.ascontiguousarray(y)
+    X_train, X_valid, y_train, y_valid = train_test_split(X, y, test_size=validation_size,
+                                                          random_state=random_state, stratify=y)
+    names = sorted(search_space)
+    grid = [dict(zip(names, values)) for values in itertools.product(*(search_space[n] for n in names))]
+    candidates = random.Random(random_state).sample(grid, min(n_candidates, len(grid)))
+    rounds = max(0, int(np.ceil(np.log(len(candidates)) / np.log(eta))))
+    rows = min_rows or max(100, int(len(y_train) / eta ** rounds))
+
+    sharedRoot = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    directory = tempfile.mkdtemp(prefix='chd-search-', dir=sharedRoot)
+    trials = []
+    try:
+        for name, array in (("X_train", X_train), ("y_train", y_train), ("X_valid", X_valid), ("y_valid", y_valid)):
+            np.save(os.path.join(directory, name + ".npy"), array)
+        with Pool(processes=workers, initializer=_init_worker, initargs=(directory,)) as pool:
+            rung = 0
+            while True:
+                rows = min(rows, len(y_train))
+                results = pool.starmap(_evaluate, [(config, rows, random_state + rung) for config in candidates])
+                for trial in results:
+                    trial["rung"] = rung
+                trials.extend(results)
+                results.sort(key=_rank_key)
+                print("....rung %d: %d candidates on %d rows, best acc %s" % (rung, len(candidates), rows,
+                                                                             results[0]["acc"]))
+                if len(candidates) == 1 or rows >= len(y_train):
+                    break
+                keep = max(1, len(candidates) // eta)
+                candidates = [{n: trial[n] for n in names} for trial in results[:keep]]
+                rows *= eta
+                rung += 1
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    best = sorted([t for t in trials if t["rung"] == trials[-1]["rung"]], key=_rank_key)[0]
+    return {n: best[n] for n in names}, trials
@@ -0,0 +1,331 @@
+import argparse
+import concurrent.futures
+import http.client
+import importlib.util
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+
+import scoring_environment
+from baseline_store import load_baseline, save_baseline
+from hdr_histogram import HdrHistogram
+
+# Load test of the scoring service, with results kept as a baseline each build compares
+# against. Targets: score.run in-process (the templated score.py and registered model,
+# like the image), a local_scoring_server.py process started on the same files, or any
+# scoring URI over HTTP. Closed loop: --concurrency virtual users send back to back.
+# Open loop: requests arrive at --rate per second (Poisson or uniform) whether or not
+# earlier ones finished, and latency is measured from the scheduled arrival time, so a
+# saturated service shows up as queueing instead of being hidden (coordinated omission).
+# Request sizes follow --batch_mix, rows are drawn from framingham.csv. Latencies go
+# into HDR histograms, overall and per batch size.
+
+print("*********************************************")
+print("INSIDE load_test.py")
+print("*********************************************")
+
+LOCAL_SCORING_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts-operationalize',
+                                    'local_scoring_server.py')
+
+
+def in_process_sender(score_file):
+    spec = importlib.util.spec_from_file_location('score', score_file)
+    scoreModule = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(scoreModule)
+    scoreModule.init()
+
+    def send(body):
+        result = scoreModule.run(body)
+        # score.run reports failures as the exception text instead of the predictions
+        return not (isinstance(result, str) and not result.startswith('['))
+    return send
+
+
+def http_sender(uri, key=None, timeout=30):
+    # One keep-alive connection per load generator thread
+    url = urlparse(uri)
+    connectionClass = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+    headers = {'Content-Type': 'application/json'}
+    if key:
+        headers['Authorization'] = 'Bearer ' + key
+    local = threading.local()
+
+    def send(body):
+        try:
+            if getattr(local, 'connection', None) is None:
+                local.connection = connectionClass(url.hostname, url.port, timeout=timeout)
+            local.connection.request('POST', url.path or '/', body.encode('utf-8'), headers)
+            response = local.connection.getresponse()
+            data = response.read()
+            return response.status == 200 and not data.startswith(b'"')
+        except (http.client.HTTPException, OSError):
+            local.connection = None
+            return False
+    return send
+
+
+def start_local_server(score_file):
+    # local_scoring_server.py on the templated script; returns the process and its URI
+    process = subprocess.Popen([sys.executable, LOCAL_SCORING_SERVER, '--score_file', score_file, '--port', '0'],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    for line in process.stdout:
+        if line.startswith('Listening on '):
+            uri = line.split()[-1]
+            # Keep draining the output so the server never blocks on a full pipe
+            threading.Thread(target=lambda: [None for _ in process.stdout], daemon=True).start()
+            return process, uri
+    raise RuntimeError("local scoring server exited before listening (exit code %s)" % process.wait())
+
+
+def closed_loop(send, requests, concurrency, duration, warmup):
+    # Virtual users send back to back; returns the (batch size, latency seconds, ok, measured,
+    # completion time) of every request and the start of the measured period
+    results = []
+    start = time.perf_counter()
+    measureFrom, stopAt = start + warmup, start + warmup + duration
+
+    def user(index):
+        i = index
+        while True:
+            begin = time.perf_counter()
+            if begin >= stopAt:
+                return
+            batchSize, body = requests[i % len(requests)]
+            ok = send(body)
+            end = time.perf_counter()
+            results.append((batchSize, end - begin, ok, begin >= measureFrom, end))
+            i += concurrency
+
+    users = [threading.Thread(target=user, args=(index,)) for index in range(concurrency)]
+    for thread in users:
+        thread.start()
+    for thread in users:
+        thread.join()
+    return results, measureFrom
+
+
+def open_loop(send, requests, rate, concurrency, duration, warmup, arrival, seed):
+    # Arrivals are scheduled up front; latency counts from the scheduled time
+    results = []
+    arrivals = random.Random(seed)
+    schedule, t = [], 0.0
+    while t < warmup + duration:
+        schedule.append(t)
+        t += arrivals.expovariate(rate) if arrival == 'poisson' else 1.0 / rate
+
+    def call(index, scheduled):
+        batchSize, body = requests[index % len(requests)]
+        ok = send(body)
+        end = time.perf_counter()
+        results.append((batchSize, end - scheduled, ok, scheduled - start >= warmup, end))
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    start = time.perf_counter()
+    for index, offset in enumerate(schedule):
+        delay = start + offset - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        executor.submit(call, index, start + offset)
+    executor.shutdown(wait=True)
+    return results, start + warmup
+
+
+if __name__ == '__main__':
+    print("1. Parse arguments")
+    print('.............................................')
+    scriptDir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser("load_test")
+    parser.add_argument("--target", type=str, help="in_process, local_http (local_scoring_server.py) or http",
+                        dest="target", choices=["in_process", "local_http", "http"], default="in_process")
+    parser.add_argument("--model_name", type=str, help="registered model name (in_process and local_http)",
+                        dest="model_name", default=None)
+    parser.add_argument("--uri", type=str, help="scoring URI (http)", dest="uri", default=None)
+    parser.add_argument("--key", type=str, help="scoring API key (http)", dest="key", default=None)
+    parser.add_argument("--mode", type=str, help="closed (fixed concurrency) or open (fixed arrival rate)",
+                        dest="mode", choices=["closed", "open"], default="closed")
+    parser.add_argument("--concurrency", type=int, help="virtual users (closed) or maximum in flight (open)",
+                        dest="concurrency", default=4)
+    parser.add_argument("--rate", type=float, help="arrivals per second (open)", dest="rate", default=100.0)
+    parser.add_argument("--arrival", type=str, help="arrival process (open)", dest="arrival",
+                        choices=["poisson", "uniform"], default="poisson")
+    parser.add_argument("--batch_mix", type=str, help="rows per request and weight, e.g. 1:0.7,10:0.2,100:0.1",
+                        dest="batch_mix", default="1:0.7,10:0.2,100:0.1")
+    parser.add_argument("--duration", type=float, help="measured seconds", dest="duration", default=10.0)
+    parser.add_argument("--warmup", type=float, help="seconds run before measuring", dest="warmup", default=2.0)
+    parser.add_argument("--data", type=str, help="framingham csv the request rows are drawn from", dest="data",
+                        default=os.path.join(scriptDir, '..', 'framingham.csv'))
+    parser.add_argument("--features", type=str, help="comma separated model features", dest="features",
+                        default="age,prevalentHyp,sysBP,glucose")
+    parser.add_argument("--seed", type=int, help="seed of the request mix and arrivals", dest="seed", default=14)
+    parser.add_argument("--output", type=str, help="load test results json", dest="output",
+                        default='./outputs/load-test.json')
+    parser.add_argument("--baseline", type=str, help="baseline results: datastore:<path> or a local file",
+                        dest="baseline", default='datastore:baselines/load-test.json')
+    parser.add_argument("--threshold", type=float, help="allowed throughput drop / p99 increase, in percent",
+                        dest="threshold", default=20.0)
+    parser.add_argument("--update_baseline", help="store the results as the new baseline", dest="update_baseline",
+                        action="store_true")
+    args = parser.parse_args()
+    print(vars(args))
+    if args.target == 'http' and not args.uri:
+        parser.error("--uri is required for the http target")
+    if args.target != 'http' and not args.model_name:
+        parser.error("--model_name is required for the in_process and local_http targets")
+    print('..1. completed')
+    print('')
+    print('')
+
+    print("2. Build the request mix")
+    print('.............................................')
+    rows = pd.read_csv(args.data)[args.features.split(',')]
+    rows = rows.astype(object).where(rows.notnull(), None).values.tolist()
+    mix = [(int(size), float(weight)) for size, weight in (item.split(':') for item in args.batch_mix.split(','))]
+    mixRandom = random.Random(args.seed)
+    requests = []
+    for _ in range(2000):
+        batchSize = mixRandom.choices([size for size, _ in mix], [weight for _, weight in mix])[0]
+        offset = mixRandom.randrange(len(rows))
+        batch = [rows[(offset + j) % len(rows)] for j in range(batchSize)]
+        requests.append((batchSize, json.dumps({"data": batch})))
+    print("%d requests, %.1f rows per request on average" % (len(requests),
+                                                               np.mean([size for size, _ in requests])))
+    print('..2. completed')
+    print('')
+    print('')
+
+    print("3. Start the target")
+    print('.............................................')
+    server = None
+    scoringDir = None
+    if args.target == 'http':
+        send = http_sender(args.uri, args.key)
+    else:
+        from azureml.core import Workspace
+        from azureml.core.model import Model
+        # Makes the registered model available where score.init() looks for it
+        print('Model path: ', Model.get_model_path(args.model_name, _workspace=Workspace.from_config()))
+        scoringDir = tempfile.mkdtemp(prefix='chd-load-test-')
+        for dependency in scoring_environment.SCORING_DEPENDENCIES:
+            shutil.copyfile(os.path.join(scriptDir, dependency), os.path.join(scoringDir, dependency))
+        scoreFile = scoring_environment.write_scoring_script(
+            args.model_name, os.path.join(scriptDir, scoring_environment.SCORING_SCRIPT),
+            os.path.join(scoringDir, scoring_environment.SCORING_SCRIPT_FIXED))
+        os.environ.setdefault('CHD_LOG_SAMPLE_RATE', '0')
+        if args.target == 'in_process':
+            sys.path.insert(0, scoringDir)
+            send = in_process_sender(scoreFile)
+        else:
+            server, uri = start_local_server(scoreFile)
+            print("Local scoring server: ", uri)
+            send = http_sender(uri)
+    print('..3. completed')
+    print('')
+    print('')
+
+    print("4. Run the load")
+    print('.............................................')
+    try:
+        if args.mode == 'closed':
+            results, measureFrom = closed_loop(send, requests, args.concurrency, args.duration, args.warmup)
+        else:
+            results, measureFrom = open_loop(send, requests, args.rate, args.concurrency, args.duration, args.warmup,
+                                args.arrival, args.seed)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if scoringDir is not None:
+            shutil.rmtree(scoringDir, ignore_errors=True)
+    measured = [r for r in results if r[3]]
+    overall = HdrHistogram()
+    byBatch = dict((size, HdrHistogram()) for size, _ in mix)
+    for size in byBatch:
+        byBatch[size].record([int(r[1] * 1e6) for r in measured if r[0] == size])
+        overall.merge(byBatch[size])
+    errors = sum(1 for r in measured if not r[2])
+    # Until the last measured request completed: an overloaded open loop takes longer than --duration
+    elapsed = max([args.duration] + [r[4] - measureFrom for r in measured])
+    report = {
+        "config": {"target": args.target, "mode": args.mode, "concurrency": args.concurrency,
+                   "rate": args.rate if args.mode == 'open' else None,
+                   "arrival": args.arrival if args.mode == 'open' else None,
+                   "batch_mix": args.batch_mix, "duration": args.duration, "features": args.features},
+        "requests": len(measured),
+        "errors": errors,
+        "error_rate": float(errors) / max(len(measured), 1),
+        "requests_per_second": len(measured) / elapsed,
+        "rows_per_second": sum(r[0] for r in measured) / elapsed,
+        "elapsed_seconds": elapsed,
+        "latency_us": overall.percentiles(),
+        "latency_us_by_batch_size": dict((str(size), histogram.percentiles()) for size, histogram in byBatch.items()),
+        "histogram": overall.to_dict(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    print("%.1f req/s, %.1f rows/s, %d errors" % (report["requests_per_second"], report["rows_per_second"], errors))
+    print("%-8s %10s %10s %10s %10s %10s" % ("rows", "p50 ms", "p90 ms", "p99 ms", "p99.9 ms", "max ms"))
+    for label, histogram in [('all', overall)] + [(str(size), byBatch[size]) for size, _ in mix]:
+        if histogram.total:
+            values = [histogram.value_at_percentile(p) / 1000.0 for p in (50, 90, 99, 99.9)] + [histogram.max / 1000.0]
+            print("%-8s %10.2f %10.2f %10.2f %10.2f %10.2f" % tuple([label] + values))
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print('Load test results saved! -', args.output)
+    print('..4. completed')
+    print('')
+    print('')
+
+    print("5. Compare with the baseline")
+    print('.............................................')
+    if args.update_baseline:
+        save_baseline(args.baseline, report)
+        print("Baseline saved: ", args.baseline)
+        print("*********************************************")
+        print("EXITING load_test.py")
+        print("*********************************************")
+        sys.exit(0)
+    baseline = load_baseline(args.baseline)
+    # Neither case is a pass: nothing was compared
+    if baseline is None:
+        print("ERROR: no baseline at %s; record one from a reference build with --update_baseline" % args.baseline)
+        sys.exit(2)
+    if baseline["config"] != report["config"]:
+        print("ERROR: the baseline was run with a different configuration, record a new one with --update_baseline: ",
+              baseline["config"])
+        sys.exit(2)
+    regressions = []
+    # Open loop throughput is the offered rate; latency and errors are what can regress
+    checks = [("p99 latency (us)", baseline["latency_us"]["p99"], report["latency_us"]["p99"], 1)]
+    if args.mode == 'closed':
+        checks.append(("throughput (req/s)", baseline["requests_per_second"], report["requests_per_second"], -1))
+    print("%-20s %12s %12s %9s" % ("measure", "baseline", "current", "change"))
+    for name, reference, current, direction in checks:
+        change = 100.0 * (current - reference) / reference if reference else 0.0
+        flag = ''
+        if direction * change > args.threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print("%-20s %12.1f %12.1f %8.1f%%%s" % (name, reference, current, change, flag))
+    if report["error_rate"] > baseline["error_rate"]:
+        regressions.append("error rate")
+        print("error rate %.4f > baseline %.4f  REGRESSION" % (report["error_rate"], baseline["error_rate"]))
+    print('..5. completed')
+    print('')
+    print('')
+
+    print("*********************************************")
+    print("EXITING load_test.py")
+    print("*********************************************")
+    if regressions:
+        print("Regressions over %.0f%%: %s" % (args.threshold, ', '.join(regressions)))
+        sys.exit(1)
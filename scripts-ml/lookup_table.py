@@ -0,0 +1,170 @@
+import json
+import os
+import numpy as np
+
+import model_bundle
+
+# Dense prediction table over the value grid of the features selected at training time.
+# The selected framingham features are bounded and discrete (age, prevalentHyp and
+# glucose are integers, sysBP moves in 0.5 steps), so the table has one cell per
+# combination of the values seen in the training data, from the smallest to the
+# largest one of each feature, and stores the predicted class index (1 byte). Rows with
+# a value outside the grid (out of range or not a multiple of the step, e.g. an imputed
+# mean) are scored by the forest.
+# Each leaf of a tree covers a box of grid cells. The boxes are added to a difference
+# array (one signed value per box corner) whose running sums along every axis give the
+# summed probabilities of all the cells, in slabs along the first feature so memory
+# stays bounded. Cells whose leading classes are within rounding distance of a tie are
+# evaluated with the forest itself, so a lookup returns exactly what the forest would.
+
+# Largest table (in cells) we are willing to build; bigger grids fall back to the forest
+MAX_TABLE_CELLS = 1 << 25
+# Upper bound on the difference array cells (times classes) held at once
+MAX_CELLS_PER_CHUNK = 1 << 22
+# Trees whose leaf boxes are collected before they are added to the difference array
+TREES_PER_BLOCK = 256
+# Grid points evaluated by the forest per call when settling near-ties
+ROWS_PER_FOREST_CALL = 100000
+# Probability margin under which the summation order could change the predicted class
+TIE_MARGIN = 1e-6
+# Value steps tried for every feature, coarsest first
+GRID_STEPS = (1.0, 0.5, 0.25)
+
+
+def grid_from_data(X, steps=GRID_STEPS):
+    # Smallest value, step and number of values of every column of X (missing values
+    # ignored), or None when a column is not on any of the steps
+    X = np.asarray(X, dtype=np.float64)
+    low, step, size = [], [], []
+    for f in range(X.shape[1]):
+        values = X[:, f][~np.isnan(X[:, f])]
+        # Scoring inputs are float32, so the grid values have to be exact float32 values
+        values = values[values == values.astype(np.float32)]
+        if len(values) == 0:
+            return None
+        columnStep = next((s for s in steps if np.all(values / s == np.round(values / s))), None)
+        if columnStep is None:
+            return None
+        low.append(values.min())
+        step.append(columnStep)
+        size.append(int(round((values.max() - values.min()) / columnStep)) + 1)
+    return low, step, size
+
+
+def _add_boxes(diff, lo, hi, values):
+    # Adds values[i] to every cell of the inclusive box lo[i]..hi[i] of the difference
+    # array: + at the low corner, alternating signs at the corners past the box
+    flatDiff = diff.reshape(-1, diff.shape[-1])
+    strides = np.cumprod((diff.shape[:-1] + (1,))[::-1])[::-1][1:]
+    for corner in range(1 << lo.shape[1]):
+        upper = [(corner >> f) & 1 for f in range(lo.shape[1])]
+        index = np.where(upper, hi + 1, lo).dot(strides)
+        sign = -1.0 if sum(upper) % 2 else 1.0
+        for c in range(diff.shape[-1]):
+            flatDiff[:, c] += np.bincount(index, weights=sign * values[:, c], minlength=len(flatDiff))
+
+
+class LookupTable(object):
+
+    def __init__(self, low, step, table, classes):
+        self.low = np.asarray(low, dtype=np.float64)
+        self.step = np.asarray(step, dtype=np.float64)
+        self.table = table
+        self.classes = classes
+        self.n_features = len(self.low)
+
+    @classmethod
+    def build(cls, engine, low, step, size, max_cells=MAX_TABLE_CELLS):
+        shape = tuple(int(s) for s in size)
+        cells = int(np.prod(shape))
+        if cells > max_cells:
+            print("Lookup table not built: %d cells exceeds the %d cell limit" % (cells, max_cells))
+            return None
+
+        # Grid value -> index, per feature: x <= threshold <=> index(x) <= splitIndex
+        grids = [(low[f] + step[f] * np.arange(shape[f])).astype(np.float32)
+                 for f in range(len(shape))]
+        nodeIds = np.arange(len(engine.feature))
+        isSplit = engine.left != nodeIds
+        splitIndex = np.zeros(len(engine.feature), dtype=np.intp)
+        for f in range(len(shape)):
+            mask = isSplit & (engine.feature == f)
+            splitIndex[mask] = np.searchsorted(grids[f].astype(np.float64), engine.threshold[mask], side='right') - 1
+
+        nClasses = engine.value.shape[1]
+        table = np.empty(shape, dtype=np.uint8)
+        diffShape = tuple(s + 1 for s in shape[1:])
+        slabRows = max(1, MAX_CELLS_PER_CHUNK // (int(np.prod(diffShape)) * nClasses) - 1)
+        for start in range(0, shape[0], slabRows):
+            stop = min(shape[0], start + slabRows)
+            diff = np.zeros((stop - start + 1,) + diffShape + (nClasses,), dtype=np.float64)
+            slabOffset = np.array((start,) + (0,) * (len(shape) - 1))
+            for block in range(0, engine.n_trees, TREES_PER_BLOCK):
+                los, his, leaves = [], [], []
+                for root in engine.roots[block:block + TREES_PER_BLOCK]:
+                    stack = [(root, (start,) + (0,) * (len(shape) - 1), (stop - 1,) + tuple(s - 1 for s in shape[1:]))]
+                    while stack:
+                        node, lo, hi = stack.pop()
+                        if not isSplit[node]:
+                            los.append(lo)
+                            his.append(hi)
+                            leaves.append(node)
+                            continue
+                        f = engine.feature[node]
+                        k = splitIndex[node]
+                        if lo[f] <= k:
+                            stack.append((engine.left[node], lo, hi[:f] + (min(hi[f], k),) + hi[f + 1:]))
+                        if hi[f] > k:
+                            stack.append((engine.right[node], lo[:f] + (max(lo[f], k + 1),) + lo[f + 1:], hi))
+                _add_boxes(diff, np.array(los) - slabOffset, np.array(his) - slabOffset, engine.value[np.array(leaves)])
+            for axis in range(len(shape)):
+                np.cumsum(diff, axis=axis, out=diff)
+            proba = diff[tuple(slice(0, -1) for _ in shape)]
+
+            # Settle the near-ties with the forest, in its own summation order
+            ranked = np.sort(proba, axis=-1)
+            margin = ranked[..., -1] - ranked[..., -2] if nClasses > 1 else np.full(proba.shape[:-1], np.inf)
+            slab = np.argmax(proba, axis=-1).astype(np.uint8)
+            ties = np.argwhere(margin <= TIE_MARGIN * engine.n_trees)
+            for first in range(0, len(ties), ROWS_PER_FOREST_CALL):
+                cells = ties[first:first + ROWS_PER_FOREST_CALL]
+                points = np.column_stack([grids[0][cells[:, 0] + start]] +
+                                         [grids[f][cells[:, f]] for f in range(1, len(shape))])
+                slab[tuple(cells.T)] = np.argmax(engine.predict_proba(points), axis=-1)
+            table[start:stop] = slab
+            print("Lookup table rows %d-%d of %d built, %d near-ties evaluated by the forest"
+                  % (start, stop - 1, shape[0], len(ties)))
+        return cls(low, step, table, engine.classes)
+
+    def save(self, directory):
+        np.save(os.path.join(directory, model_bundle.LOOKUP_TABLE_FILE), self.table)
+        manifest = {"low": self.low.tolist(), "step": self.step.tolist(), "classes": self.classes.tolist()}
+        with open(os.path.join(directory, model_bundle.LOOKUP_TABLE_MANIFEST), "w") as f:
+            json.dump(manifest, f)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, model_bundle.LOOKUP_TABLE_MANIFEST)) as f:
+            manifest = json.load(f)
+        table = np.load(os.path.join(directory, model_bundle.LOOKUP_TABLE_FILE), mmap_mode='r')
+        return cls(manifest["low"], manifest["step"], table, np.asarray(manifest["classes"]))
+
+    def predict(self, X, fallback):
+        # fallback(rows) scores the rows that are not on the grid, e.g. engine.predict
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if X.shape[1] != self.n_features:
+            raise ValueError("X has %d features, but the model is expecting %d features as input"
+                             % (X.shape[1], self.n_features))
+        position = (X.astype(np.float64) - self.low) / self.step
+        index = np.rint(position)
+        onGrid = np.all((position == index) & (index >= 0) & (index < self.table.shape), axis=1)
+        if not onGrid.any():
+            return fallback(X)
+        results = np.empty(len(X), dtype=self.classes.dtype)
+        cells = index[onGrid].astype(np.intp)
+        results[onGrid] = self.classes.take(self.table[tuple(cells.T)], axis=0)
+        if not onGrid.all():
+            results[~onGrid] = fallback(X[~onGrid])
+        return results
@@ -0,0 +1,28 @@
+import os
+
+# Layout of the registered model folder (./outputs/chd-rf-model).
+# train.py writes the pickled forest and the artifacts derived from it side by side,
+# and score.py resolves them from the path returned by Model.get_model_path.
+# Models registered before the folder layout are a single pickle file.
+
+MODEL_FILE = 'model.pkl'
+FOREST_MANIFEST = 'forest.json'
+FOREST_ARRAY_FILE = 'forest-%s.npy'
+PREPROCESSING_FILE = 'preprocessing.json'
+LOOKUP_TABLE_FILE = 'lookup-table.npy'
+LOOKUP_TABLE_MANIFEST = 'lookup-table.json'
+DRIFT_REFERENCE_FILE = 'drift-reference.json'
+
+
+def model_file(model_path):
+    if os.path.isdir(model_path):
+        return os.path.join(model_path, MODEL_FILE)
+    return model_path
+
+
+def component_path(model_path, file_name):
+    # Path of an artifact bundled with the model, or None if it wasn't built
+    if not os.path.isdir(model_path):
+        return None
+    path = os.path.join(model_path, file_name)
+    return path if os.path.exists(path) else None
@@ -0,0 +1,84 @@
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+# Bounded LRU (+ optional TTL) cache of per-row predictions.
+# Entries are keyed on the float32 bytes of the feature row and the model version,
+# and the whole cache is dropped when a different model version is loaded.
+
+
+class PredictionCache(object):
+
+    def __init__(self, max_entries=100000, ttl_seconds=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.model_version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set_model_version(self, model_version):
+        with self._lock:
+            if model_version != self.model_version:
+                self._entries.clear()
+                self.model_version = model_version
+
+    def _keys(self, X):
+        # Normalise to contiguous float32 with -0.0 folded into 0.0
+        rows = np.ascontiguousarray(X, dtype=np.float32) + np.float32(0.0)
+        version = self.model_version
+        return [(version, row.tobytes()) for row in rows]
+
+    def predict(self, X, predict):
+        keys = self._keys(X)
+        results = [None] * len(keys)
+        missing = []
+        now = time.time()
+        with self._lock:
+            for i, key in enumerate(keys):
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] is not None and entry[1] < now:
+                    del self._entries[key]
+                    self.expirations += 1
+                    entry = None
+                if entry is None:
+                    missing.append(i)
+                else:
+                    self._entries.move_to_end(key)
+                    results[i] = entry[0]
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+
+        if not missing:
+            return np.asarray(results)
+
+        computed = predict(X[missing] if len(missing) < len(keys) else X)
+        expiresAt = now + self.ttl_seconds if self.ttl_seconds else None
+        with self._lock:
+            for i, value in zip(missing, computed):
+                results[i] = value
+                if keys[i][0] != self.model_version:
+                    continue
+                self._entries[keys[i]] = (value, expiresAt)
+                self._entries.move_to_end(keys[i])
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return np.asarray(results, dtype=np.asarray(computed).dtype)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "model_version": self.model_version,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,127 @@
+import json
+
+import numpy as np
+
+# Missing-value imputation shared by train.py and score.py.
+# The statistics are fitted once on the training frame (pandas is only needed there)
+# and stored as plain JSON next to the model. Applying them is a couple of vectorized
+# numpy operations on the float feature matrix, with no DataFrame at inference time.
+
+# Constant fills used by train.py
+CONSTANT_FILLS = {'BPMeds': 0, 'education': 1}
+# Columns filled with their training mean
+MEAN_FILLS = ['glucose', 'totChol', 'BMI', 'heartRate']
+# cigsPerDay is filled with the mean over smokers, for smokers only
+CONDITIONAL_FILLS = [('cigsPerDay', 'currentSmoker', 1)]
+
+
+class Preprocessor(object):
+
+    def __init__(self, columns, fill_values, conditional_fills=()):
+        # fill_values[i] is the value for missing entries of columns[i] (NaN = no fill);
+        # conditional_fills holds (column, condition column, condition value, fill value)
+        self.columns = list(columns)
+        self.fill_values = np.asarray(fill_values, dtype=np.float64)
+        self.conditional_fills = [tuple(rule) for rule in conditional_fills]
+
+    @classmethod
+    def fit(cls, df, columns=None):
+        # Same statistics as the original fillna calls of train.py. Columns without a
+        # training rule get their mean, so scoring can also accept rows missing them;
+        # it changes nothing for training since those columns have no missing values.
+        columns = list(df.columns) if columns is None else list(columns)
+        fillValues = []
+        for column in columns:
+            if column in CONSTANT_FILLS:
+                fillValues.append(CONSTANT_FILLS[column])
+            elif any(column == rule[0] for rule in CONDITIONAL_FILLS):
+                fillValues.append(np.nan)
+            else:
+                fillValues.append(df[column].mean())
+        conditionalFills = []
+        for column, conditionColumn, conditionValue in CONDITIONAL_FILLS:
+            if column in columns and conditionColumn in columns:
+                condition = df[conditionColumn] == conditionValue
+                conditionalFills.append((column, conditionColumn, conditionValue,
+                                         df.loc[condition, column].mean()))
+        return cls(columns, fillValues, conditionalFills)
+
+    @classmethod
+    def fit_chunks(cls, chunks, columns=None):
+        # Same statistics as fit, accumulated over an iterable of DataFrame chunks so
+        # the dataset never has to be in memory at once
+        sums, counts, conditionalSums, conditionalCounts = None, None, None, None
+        for chunk in chunks:
+            if columns is None:
+                columns = list(chunk.columns)
+            if sums is None:
+                sums, counts = np.zeros(len(columns)), np.zeros(len(columns))
+                conditionalSums, conditionalCounts = np.zeros(len(CONDITIONAL_FILLS)), np.zeros(len(CONDITIONAL_FILLS))
+            values = chunk[columns].values.astype(np.float64)
+            present = ~np.isnan(values)
+            sums += np.where(present, values, 0).sum(axis=0)
+            counts += present.sum(axis=0)
+            for i, (column, conditionColumn, conditionValue) in enumerate(CONDITIONAL_FILLS):
+                if column in chunk and conditionColumn in chunk:
+                    selected = chunk.loc[chunk[conditionColumn] == conditionValue, column].values
+                    conditionalSums[i] += np.nansum(selected)
+                    conditionalCounts[i] += np.count_nonzero(~np.isnan(selected))
+        if sums is None:
+            raise ValueError("no data to fit the preprocessing on")
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / counts
+        fillValues = []
+        for i, column in enumerate(columns):
+            if column in CONSTANT_FILLS:
+                fillValues.append(CONSTANT_FILLS[column])
+            elif any(column == rule[0] for rule in CONDITIONAL_FILLS):
+                fillValues.append(np.nan)
+            else:
+                fillValues.append(means[i])
+        conditionalFills = []
+        for i, (column, conditionColumn, conditionValue) in enumerate(CONDITIONAL_FILLS):
+            if column in columns and conditionColumn in columns:
+                conditionalFills.append((column, conditionColumn, conditionValue,
+                                         conditionalSums[i] / conditionalCounts[i]))
+        return cls(columns, fillValues, conditionalFills)
+
+    def select(self, columns):
+        # Preprocessor restricted to the given (e.g. model selected) columns
+        index = [self.columns.index(column) for column in columns]
+        rules = [rule for rule in self.conditional_fills if rule[0] in columns and rule[1] in columns]
+        return Preprocessor(columns, self.fill_values[index], rules)
+
+    def transform(self, X):
+        missing = np.isnan(X)
+        if not missing.any():
+            return X
+        X = np.array(X, dtype=np.result_type(X.dtype, np.float32))
+        for column, conditionColumn, conditionValue, fillValue in self.conditional_fills:
+            i = self.columns.index(column)
+            rows = missing[:, i] & (X[:, self.columns.index(conditionColumn)] == conditionValue)
+            X[rows, i] = fillValue
+        fill = np.broadcast_to(self.fill_values.astype(X.dtype), X.shape)
+        mask = missing & ~np.isnan(fill)
+        X[mask] = fill[mask]
+        return X
+
+    def to_dict(self):
+        return {
+            "columns": self.columns,
+            "fill_values": [None if np.isnan(v) else float(v) for v in self.fill_values],
+            "conditional_fills": [[c, cc, float(cv), float(v)] for c, cc, cv, v in self.conditional_fills],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        fillValues = [np.nan if v is None else v for v in data["fill_values"]]
+        return cls(data["columns"], fillValues, data["conditional_fills"])
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
@@ -0,0 +1,146 @@
+import gzip
+import io
+import json
+import numpy as np
+
+# Content-negotiated request/response codecs for the scoring service.
+# Binary formats are decoded as numpy views over the request body (np.frombuffer),
+# so large batches reach the model as float32 rows without intermediate Python
+# lists or float64 copies. JSON stays the default for existing clients.
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+NPY = 'application/x-npy'
+RAW = 'application/octet-stream'
+ARROW = 'application/vnd.apache.arrow.stream'
+MSGPACK = 'application/msgpack'
+
+SUPPORTED_TYPES = (JSON, NPY, RAW, ARROW, MSGPACK)
+
+NPY_MAGIC = b'\x93NUMPY'
+
+
+def _media_type(header, default=JSON):
+    # 'application/x-npy; charset=binary' -> 'application/x-npy'
+    if not header:
+        return default
+    mediaType = header.split(',')[0].split(';')[0].strip().lower()
+    if mediaType in ('', '*/*'):
+        return default
+    if mediaType in ('application/x-msgpack', 'application/vnd.msgpack'):
+        return MSGPACK
+    return mediaType
+
+
+def read_request(request):
+    # Returns (body, content type, accepted response type) for either a raw JSON
+    # string (in-process callers) or an AMLRequest coming through @rawhttp
+    if isinstance(request, (str, bytes, bytearray, memoryview)):
+        return request, JSON, JSON
+    body = request.get_data(cache=False)
+    if (request.headers.get('Content-Encoding') or '').strip().lower() == 'gzip':
+        # Large batches from the scoring client are compressed
+        body = gzip.decompress(body)
+    contentType = _media_type(request.headers.get('Content-Type'))
+    accept = _media_type(request.headers.get('Accept'), default=contentType)
+    if accept not in SUPPORTED_TYPES:
+        accept = JSON
+    return body, contentType, accept
+
+
+def _as_rows(array, nFeatures):
+    if array.ndim == 1:
+        array = array.reshape(-1, nFeatures) if nFeatures else array.reshape(1, -1)
+    if array.dtype != np.float32:
+        array = array.astype(np.float32)
+    return array
+
+
+def _decode_npy(body):
+    stream = io.BytesIO(body)
+    version = np.lib.format.read_magic(stream)
+    if version == (1, 0):
+        shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(stream)
+    else:
+        shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(stream)
+    if dtype.hasobject:
+        raise ValueError("Object arrays are not accepted")
+    count = int(np.prod(shape))
+    array = np.frombuffer(body, dtype=dtype, count=count, offset=stream.tell())
+    return array.reshape(shape, order='F' if fortranOrder else 'C')
+
+
+def _decode_raw(body, nFeatures):
+    if nFeatures is None:
+        raise ValueError("Raw float32 input needs the model's feature count")
+    if len(body) % (4 * nFeatures):
+        raise ValueError("Raw float32 input of %d bytes is not a whole number of %d-feature rows"
+                         % (len(body), nFeatures))
+    return np.frombuffer(body, dtype='<f4').reshape(-1, nFeatures)
+
+
+def _decode_arrow(body):
+    if pyarrow is None:
+        raise ValueError("Arrow input requires the pyarrow package")
+    table = pyarrow.ipc.open_stream(pyarrow.py_buffer(body)).read_all()
+    # Each column converts without a copy; only the row-major stacking copies
+    columns = [column.to_numpy() for column in table.itercolumns()]
+    return np.column_stack(columns).astype(np.float32, copy=False)
+
+
+def _decode_msgpack(body):
+    if msgpack is None:
+        raise ValueError("msgpack input requires the msgpack package")
+    payload = msgpack.unpackb(body, raw=False)
+    data = payload["data"]
+    if isinstance(data, bytes):
+        # {"data": <raw bytes>, "shape": [rows, cols], "dtype": "<f4"}
+        dtype = np.dtype(payload.get("dtype", '<f4'))
+        return np.frombuffer(data, dtype=dtype).reshape(payload["shape"])
+    return np.asarray(data, dtype=np.float32)
+
+
+def decode(body, contentType=JSON, nFeatures=None):
+    if contentType == JSON:
+        return _as_rows(np.asarray(json.loads(body)["data"], dtype=np.float32), nFeatures)
+    if contentType == NPY or (contentType == RAW and bytes(body[:6]) == NPY_MAGIC):
+        return _as_rows(_decode_npy(body), nFeatures)
+    if contentType == RAW:
+        return _decode_raw(body, nFeatures)
+    if contentType == ARROW:
+        return _as_rows(_decode_arrow(body), nFeatures)
+    if contentType == MSGPACK:
+        return _as_rows(_decode_msgpack(body), nFeatures)
+    raise ValueError("Unsupported content type: %s" % contentType)
+
+
+def encode(results, accept=JSON):
+    results = np.asarray(results)
+    if accept == JSON:
+        return json.dumps(results.tolist()), JSON
+    if accept == NPY:
+        stream = io.BytesIO()
+        np.save(stream, results, allow_pickle=False)
+        return stream.getvalue(), NPY
+    if accept == RAW:
+        # Class labels are small integers: one byte per row
+        return results.astype(np.int8).tobytes(), RAW
+    if accept == MSGPACK and msgpack is not None:
+        packed = results.astype(np.int8)
+        return msgpack.packb({"data": packed.tobytes(), "shape": list(packed.shape), "dtype": "|i1"}), MSGPACK
+    if accept == ARROW and pyarrow is not None:
+        table = pyarrow.table({"prediction": results})
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes(), ARROW
+    return json.dumps(results.tolist()), JSON
@@ -1,46 +1,248 @@
 import os
 import json
+import time
 import numpy as np
 import pickle
 from azureml.core.model import Model
-from azureml.monitoring import ModelDataCollector
+from azureml.contrib.services.aml_request import AMLRequest, rawhttp
+from azureml.contrib.services.aml_response import AMLResponse
+import model_bundle
+from forest_engine import ForestEngine
+from lookup_table import LookupTable
+from batch_coalescer import BatchCoalescer
+from prediction_cache import PredictionCache
+from preprocessing import Preprocessor
+from scoring_metrics import ScoringMetrics, SampledLogger
+from data_capture import DataCapture, make_collector
+from drift_sketch import DriftSketch
+import request_codecs
+
+# Kept across init() calls, so it can be invalidated when another model version loads
+cache = None
+# Per-stage latency histograms, rows per request and error counts, served by GET /score
+metrics = ScoringMetrics()
+request_log = None
+# Input/prediction capture, flushed to the collector by a background thread
+capture = None
 
 def init():
     global model
-    global inputs_dc
-    global prediction_dc
+    global engine
+    global coalescer
+    global lookup
+    global early_exit
+    global preprocessor
+    global cache
+    global request_log
+    global capture
+    global model_version
+    global drift_reference
+    global drift_live
     
+    coalescer = None
+    lookup = None
+    early_exit = None
+    preprocessor = None
+    drift_reference = None
+    drift_live = None
     try:
+        # Sampled raw-input logging (CHD_LOG_SAMPLE_RATE of the requests, 1% by default),
+        # printed by a background thread instead of on the request path
+        if request_log is None:
+            request_log = SampledLogger(sample_rate=float(os.environ.get('CHD_LOG_SAMPLE_RATE', '0.01')),
+                                        max_chars=int(os.environ.get('CHD_LOG_MAX_CHARS', '1000')))
         model_name = 'MODEL-NAME' # Placeholder model name
         print('Looking for model path for model: ', model_name)
         model_path = Model.get_model_path(model_name = model_name)
         print('Loading model from: ', model_path)
-        model = pickle.load(open(model_path, 'rb'))
-        print("Model loaded from disk.")
-        print(model.summary())
+        # The registry path embeds the model name and version
+        model_version = model_path
+        if model_bundle.component_path(model_path, model_bundle.FOREST_MANIFEST):
+            # Node arrays are memory-mapped: no unpickling, pages shared between workers
+            model = None
+            engine = ForestEngine.load(model_path)
+            print("Forest node arrays mapped: %d trees, %d nodes" % (engine.n_trees, len(engine.feature)))
+        else:
+            model = pickle.load(open(model_bundle.model_file(model_path), 'rb'))
+            print("Model loaded from disk.")
+            # Flatten the forest once, so requests don't pay one Python call per tree
+            engine = ForestEngine.from_model(model)
+            print("Forest flattened: %d trees, %d nodes" % (engine.n_trees, len(engine.feature)))
+
+        # Training imputation, so rows with missing values can be scored
+        preprocessing_path = model_bundle.component_path(model_path, model_bundle.PREPROCESSING_FILE)
+        if preprocessing_path:
+            preprocessor = Preprocessor.load(preprocessing_path)
+            print("Preprocessing loaded for features: ", preprocessor.columns)
+
+        # Training distribution sketch; live traffic is binned the same way for drift scores
+        drift_path = model_bundle.component_path(model_path, model_bundle.DRIFT_REFERENCE_FILE)
+        if drift_path:
+            drift_reference = DriftSketch.load(drift_path)
+            drift_live = drift_reference.empty_like()
+            print("Drift reference loaded: %d training rows" % drift_reference.rows)
+
+        # Precomputed predictions over the selected features' value grid, if built
+        if model_bundle.component_path(model_path, model_bundle.LOOKUP_TABLE_FILE):
+            lookup = LookupTable.load(model_path)
+            print("Lookup table loaded: shape {}".format(lookup.table.shape))
+
+        # Opt-in early-exit voting: CHD_EARLY_EXIT=exact stops a row once the remaining
+        # trees cannot flip its vote, a z value (e.g. 3) stops on a statistical bound
+        if os.environ.get('CHD_EARLY_EXIT'):
+            early_exit = os.environ['CHD_EARLY_EXIT']
+            print("Early-exit voting enabled: ", early_exit)
+
+        # Opt-in micro-batching: concurrent requests are merged into one predict call
+        # of up to CHD_BATCH_MAX_SIZE rows, waiting at most CHD_BATCH_MAX_WAIT_MS
+        if os.environ.get('CHD_BATCH_MAX_SIZE'):
+            coalescer = BatchCoalescer(_forest_predict,
+                                       max_batch_size=int(os.environ['CHD_BATCH_MAX_SIZE']),
+                                       max_wait_ms=float(os.environ.get('CHD_BATCH_MAX_WAIT_MS', '2')),
+                                       n_features=engine.n_features)
+            print("Request coalescing enabled: max batch %d rows, max wait %.1f ms"
+                  % (coalescer.max_batch_size, coalescer.max_wait * 1000))
+
+        # Opt-in LRU cache of per-row predictions (CHD_CACHE_SIZE entries, optional
+        # CHD_CACHE_TTL_SECONDS), keyed on the model version resolved above
+        if os.environ.get('CHD_CACHE_SIZE'):
+            if cache is None:
+                ttl = os.environ.get('CHD_CACHE_TTL_SECONDS')
+                cache = PredictionCache(max_entries=int(os.environ['CHD_CACHE_SIZE']),
+                                        ttl_seconds=float(ttl) if ttl else None)
+            cache.set_model_version(model_version)
+            print("Prediction cache enabled: ", cache.stats())
 
-        #inputs_dc = ModelDataCollector("model_telemetry", identifier="inputs")
-        #prediction_dc = ModelDataCollector("model_telemetry", identifier="predictions", feature_names=["prediction"])
+        # Opt-in data capture: CHD_CAPTURE=azure for the Azure ML data collector (blob
+        # storage) or a directory for rotating CHD_CAPTURE_FORMAT (jsonl/parquet) files.
+        # Up to CHD_CAPTURE_CAPACITY requests are buffered; CHD_CAPTURE_DROP picks which
+        # ones are dropped when the buffer is full (oldest/newest)
+        if os.environ.get('CHD_CAPTURE') and capture is None:
+            feature_names = preprocessor.columns if preprocessor is not None else \
+                ['f%d' % i for i in range(engine.n_features)]
+            capture = DataCapture(make_collector(os.environ['CHD_CAPTURE'], feature_names,
+                                                 format=os.environ.get('CHD_CAPTURE_FORMAT', 'jsonl')),
+                                  feature_names,
+                                  capacity=int(os.environ.get('CHD_CAPTURE_CAPACITY', '10000')),
+                                  drop_policy=os.environ.get('CHD_CAPTURE_DROP', 'oldest'),
+                                  flush_seconds=float(os.environ.get('CHD_CAPTURE_FLUSH_SECONDS', '5')))
+            print("Data capture enabled: ", os.environ['CHD_CAPTURE'])
     except Exception as e:
         print(e)
+
+def _forest_predict(inputs):
+    if early_exit is None:
+        return engine.predict(inputs)
+    confidence = None if early_exit == 'exact' else float(early_exit)
+    results, trees_used = engine.predict_early_exit(inputs, confidence=confidence)
+    if request_log.sampled():
+        request_log.log("Early exit: %.1f trees per row on average (%d rows)" % (trees_used.mean(), len(trees_used)))
+    return results
+
+def _engine_predict(inputs):
+    if coalescer is not None:
+        return coalescer.submit(inputs)
+    return _forest_predict(inputs)
+
+def _predict(inputs):
+    if lookup is not None:
+        return lookup.predict(inputs, _engine_predict)
+    return _engine_predict(inputs)
         
 # note you can pass in multiple rows for scoring
-def run(raw_data):
-    import time
+# The request body can be JSON ({"data": [[...]]}), .npy, raw little-endian float32
+# rows (application/octet-stream), Arrow IPC stream or msgpack, picked from the
+# Content-Type header. The Accept header picks the response format (JSON by default).
+# GET returns the metrics: Prometheus text with ?metrics or Accept: text/plain, JSON otherwise,
+# and GET ?drift the PSI/KS drift report of the traffic received so far.
+@rawhttp
+def run(request):
+    start = time.perf_counter()
     try:
-        print("Received input: ", raw_data)        
-        inputs = json.loads(raw_data)["data"]    
-        inputs = np.array(inputs)
-        results = model.predict(inputs)
+        if isinstance(request, AMLRequest) and request.method == 'GET':
+            return _metrics_response(request)
 
-        #inputs_dc.collect(inputs) #this call is saving our input data into Azure Blob
-        #prediction_dc.collect(results) #this call is saving our output data into Azure Blob
+        raw_data, content_type, accept = request_codecs.read_request(request)
+        if request_log is not None and request_log.sampled():
+            request_log.log_input(raw_data, content_type)
+        parsed = time.perf_counter()
+        # Wrong widths are rejected here, before anything is binned or imputed
+        inputs = engine.check_features(request_codecs.decode(raw_data, content_type, engine.n_features))
+        decoded = time.perf_counter()
+        raw_inputs = inputs
+        if preprocessor is not None:
+            inputs = preprocessor.transform(inputs)
+        converted = time.perf_counter()
+        if cache is not None:
+            results = cache.predict(inputs, _predict)
+        else:
+            results = _predict(inputs)
+        predicted = time.perf_counter()
+        if drift_live is not None:
+            # Only rows the model accepted reach the live drift sketch
+            drift_live.update(raw_inputs)
+        drifted = time.perf_counter()
 
-        print("Prediction created " + time.strftime("%H:%M:%S"))
-        
-        results = results.tolist()
-        return json.dumps(results)
+        if capture is not None:
+            capture.capture(inputs, results, model_version, predicted - start)
+
+        body, response_type = request_codecs.encode(results, accept)
+        if isinstance(request, AMLRequest):
+            body = AMLResponse(body, 200, {'Content-Type': response_type})
+        end = time.perf_counter()
+        metrics.observe('parse', parsed - start)
+        metrics.observe('decode', decoded - parsed)
+        metrics.observe('convert', (converted - decoded) + (drifted - predicted))
+        metrics.observe('predict', predicted - converted)
+        metrics.observe('serialize', end - drifted)
+        metrics.observe('total', end - start)
+        metrics.observe_rows(len(inputs))
+        return body
     except Exception as e:
         error = str(e)
-        print("ERROR: " + error + " " + time.strftime("%H:%M:%S"))
+        metrics.error(type(e).__name__)
+        if request_log is not None:
+            request_log.log("ERROR: " + error)
         return error
+
+def _metrics_response(request):
+    if 'drift' in request.args:
+        if drift_live is None:
+            return AMLResponse("No drift reference bundled with this model", 404)
+        return AMLResponse(json.dumps(drift_live.report(drift_reference)), 200, {'Content-Type': 'application/json'})
+    counters = {}
+    if cache is not None:
+        stats = cache.stats()
+        counters = {"chd_score_cache_hits_total": ("Prediction cache hits.", stats["hits"]),
+                    "chd_score_cache_misses_total": ("Prediction cache misses.", stats["misses"])}
+    if capture is not None:
+        stats = capture.stats()
+        counters["chd_score_capture_dropped_total"] = ("Captured requests dropped from the full buffer.",
+                                                       stats["dropped"])
+        counters["chd_score_capture_flushed_total"] = ("Captured rows written by the collector.", stats["flushed"])
+    if request_log is not None:
+        counters["chd_score_log_dropped_total"] = ("Log lines dropped by the sampled logger.", request_log.dropped)
+    if 'metrics' in request.args or 'text/plain' in (request.headers.get('Accept') or ''):
+        text = metrics.prometheus_text(counters)
+        if drift_live is not None:
+            text += _drift_prometheus_text()
+        return AMLResponse(text, 200,
+                           {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+    summary = metrics.summary()
+    if capture is not None:
+        summary["capture"] = capture.stats()
+    if cache is not None:
+        summary["cache"] = cache.stats()
+    return AMLResponse(json.dumps(summary), 200, {'Content-Type': 'application/json'})
+
+def _drift_prometheus_text():
+    report = drift_live.report(drift_reference)
+    lines = ['# HELP chd_score_drift_psi Population stability index of live traffic against training.',
+             '# TYPE chd_score_drift_psi gauge']
+    lines.extend('chd_score_drift_psi{feature="%s"} %.6g' % (name, feature["psi"])
+                 for name, feature in sorted(report["features"].items()))
+    lines.extend(['# HELP chd_score_drift_ks Binned Kolmogorov-Smirnov statistic against training.',
+                  '# TYPE chd_score_drift_ks gauge'])
+    lines.extend('chd_score_drift_ks{feature="%s"} %.6g' % (name, feature["ks"])
+                 for name, feature in sorted(report["features"].items()))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,40 @@
+import hashlib
+import os
+
+# Environment of the scoring service, shared by containerize.py (container image) and
+# deploy-rest-service.py (inference config of AKS endpoint versions).
+
+CONDA_PACKAGES = ['numpy', 'scikit-learn']
+PIP_PACKAGES = ['azureml-sdk', 'azureml-monitoring', 'azureml-contrib-services', 'pyarrow', 'msgpack']
+
+# Helper modules imported by the scoring script have to ship next to it
+SCORING_DEPENDENCIES = ['forest_engine.py', 'request_codecs.py', 'batch_coalescer.py',
+                        'model_bundle.py', 'lookup_table.py', 'prediction_cache.py',
+                        'preprocessing.py', 'scoring_metrics.py', 'data_capture.py',
+                        'drift_sketch.py']
+
+SCORING_SCRIPT = 'score.py'
+SCORING_SCRIPT_FIXED = 'score_fixed.py'
+MODEL_NAME_PLACEHOLDER = 'MODEL-NAME'
+
+
+def write_scoring_script(model_name, source=SCORING_SCRIPT, destination=SCORING_SCRIPT_FIXED):
+    # The scoring script with the placeholder replaced by the registered model name
+    with open(source) as f:
+        data = f.read()
+    with open(destination, "w") as f:
+        f.write(data.replace(MODEL_NAME_PLACEHOLDER, model_name))
+    return destination
+
+
+def environment_hash(conda_file, scoring_script, dependencies=SCORING_DEPENDENCIES, runtime='python'):
+    # Fingerprint of everything an image holds besides the model: the conda spec, the
+    # templated scoring script and its helper modules. Images with the same hash only
+    # differ by their model, so a new one can be layered on an existing one.
+    digest = hashlib.sha256(runtime.encode('utf-8'))
+    for path in [conda_file, scoring_script] + list(dependencies):
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest.update(('%s:%d:' % (os.path.basename(path), len(data))).encode('utf-8'))
+        digest.update(data)
+    return digest.hexdigest()
@@ -0,0 +1,170 @@
+import bisect
+import queue
+import random
+import sys
+import threading
+import time
+
+# In-process request metrics for score.py and sampled, asynchronous request logging.
+# run() records one duration per stage with time.perf_counter deltas: parse (reading
+# the request body), decode (body to float32 rows), convert (drift update and
+# imputation), predict and serialize. The durations go into fixed-bucket histograms,
+# so a record is a bisect and two additions under a lock. Quantiles are estimated from
+# the buckets and everything is rendered in the Prometheus text exposition format.
+# Raw inputs are no longer printed synchronously: a sample of them is put on a
+# bounded queue and printed by a background thread, dropping lines when it is full.
+
+STAGES = ('parse', 'decode', 'convert', 'predict', 'serialize', 'total')
+
+# 50 us .. ~13 s, doubling
+LATENCY_BUCKETS = tuple(0.00005 * 2 ** i for i in range(19))
+# 1 .. 65536 rows, doubling
+ROW_BUCKETS = tuple(float(2 ** i) for i in range(17))
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        # Linear interpolation inside the bucket holding the q-th observation
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if count == 0:
+            return None
+        rank = q * count
+        cumulative = 0
+        for index, bucketCount in enumerate(counts):
+            if cumulative + bucketCount >= rank and bucketCount:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - cumulative) / bucketCount
+            cumulative += bucketCount
+        return self.buckets[-1]
+
+    def prometheus_lines(self, name, labels=''):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        separator = ',' if labels else ''
+        lines = []
+        cumulative = 0
+        for bound, bucketCount in zip(self.buckets, counts):
+            cumulative += bucketCount
+            lines.append('%s_bucket{%s%sle="%g"} %d' % (name, labels, separator, bound, cumulative))
+        lines.append('%s_bucket{%s%sle="+Inf"} %d' % (name, labels, separator, count))
+        lines.append('%s_sum{%s} %.9g' % (name, labels, total))
+        lines.append('%s_count{%s} %d' % (name, labels, count))
+        return lines
+
+
+class ScoringMetrics(object):
+
+    def __init__(self):
+        self.latency = dict((stage, Histogram(LATENCY_BUCKETS)) for stage in STAGES)
+        self.rows = Histogram(ROW_BUCKETS)
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        self.latency[stage].observe(seconds)
+
+    def observe_rows(self, rows):
+        self.rows.observe(rows)
+
+    def error(self, error_type):
+        with self._lock:
+            self.errors[error_type] = self.errors.get(error_type, 0) + 1
+
+    def summary(self):
+        stages = {}
+        for stage, histogram in self.latency.items():
+            stages[stage] = {"count": histogram.count}
+            for q in QUANTILES:
+                stages[stage]["p%g" % (q * 100)] = histogram.quantile(q)
+        return {
+            "latency_seconds": stages,
+            "rows_per_request": {"count": self.rows.count, "sum": self.rows.sum,
+                                 "p50": self.rows.quantile(0.5), "p99": self.rows.quantile(0.99)},
+            "errors": dict(self.errors),
+        }
+
+    def prometheus_text(self, extra_counters=None):
+        lines = ['# HELP chd_score_stage_seconds Scoring latency per request stage.',
+                 '# TYPE chd_score_stage_seconds histogram']
+        for stage in STAGES:
+            lines.extend(self.latency[stage].prometheus_lines('chd_score_stage_seconds', 'stage="%s"' % stage))
+        lines.extend(['# HELP chd_score_stage_quantile_seconds Latency quantiles estimated in-process.',
+                      '# TYPE chd_score_stage_quantile_seconds gauge'])
+        for stage in STAGES:
+            for q in QUANTILES:
+                value = self.latency[stage].quantile(q)
+                if value is not None:
+                    lines.append('chd_score_stage_quantile_seconds{stage="%s",quantile="%g"} %.9g' % (stage, q, value))
+        lines.extend(['# HELP chd_score_rows_per_request Rows scored per request.',
+                      '# TYPE chd_score_rows_per_request histogram'])
+        lines.extend(self.rows.prometheus_lines('chd_score_rows_per_request'))
+        lines.extend(['# HELP chd_score_errors_total Failed requests by error type.',
+                      '# TYPE chd_score_errors_total counter'])
+        with self._lock:
+            errors = sorted(self.errors.items())
+        for errorType, count in errors:
+            lines.append('chd_score_errors_total{type="%s"} %d' % (errorType, count))
+        for name, (help_, value) in sorted((extra_counters or {}).items()):
+            lines.extend(['# HELP %s %s' % (name, help_), '# TYPE %s counter' % name, '%s %d' % (name, value)])
+        return '\n'.join(lines) + '\n'
+
+
+class SampledLogger(object):
+
+    def __init__(self, sample_rate=0.01, max_chars=1000, max_queue=1000, stream=None):
+        self.sample_rate = sample_rate
+        self.max_chars = max_chars
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stream = stream or sys.stdout
+        self._random = random.Random()
+        self._worker = threading.Thread(target=self._run, name='score-log', daemon=True)
+        self._worker.start()
+
+    def sampled(self):
+        # Cheap check callers use before formatting anything
+        return self.sample_rate > 0 and (self.sample_rate >= 1 or self._random.random() < self.sample_rate)
+
+    def log(self, message):
+        # Never blocks the caller: the line is dropped when the queue is full
+        try:
+            self._queue.put_nowait((time.strftime("%H:%M:%S"), message))
+        except queue.Full:
+            self.dropped += 1
+
+    def log_input(self, raw_data, content_type):
+        if isinstance(raw_data, (bytes, bytearray)) and content_type.endswith('json'):
+            raw_data = bytes(raw_data).decode('utf-8', 'replace')
+        if isinstance(raw_data, str):
+            text = raw_data[:self.max_chars]
+            self.log("Received input: " + text + ('...' if len(raw_data) > self.max_chars else ''))
+        else:
+            self.log("Received input: %d bytes of %s" % (len(raw_data), content_type))
+
+    def _run(self):
+        while True:
+            timestamp, message = self._queue.get()
+            try:
+                self._stream.write("%s %s\n" % (timestamp, message))
+                self._stream.flush()
+            except Exception:
+                pass
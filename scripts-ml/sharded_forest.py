@@ -0,0 +1,118 @@
+import copy
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from multiprocessing import Pool
+
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+
+# Data-parallel forest training. The forest is split into disjoint sub-forests, each
+# grown with its own seed over the same training matrix, and merged back into one
+# RandomForestClassifier by concatenating the fitted trees. Shards run either as
+# processes of a local pool, or one per node of an MPI run on the AML compute cluster
+# (rank/size read from the Open MPI / Intel MPI environment), where every rank writes
+# its sub-forest to a shared directory and rank 0 merges them.
+
+SHARD_FILE = 'forest-shard-%d.pkl'
+
+# Matrices memory-mapped by each worker process, loaded by the pool initializer
+_shared = {}
+
+
+def mpi_rank():
+    # (rank, size) of this process in the MPI job, (0, 1) outside of one
+    for rankName, sizeName in (("OMPI_COMM_WORLD_RANK", "OMPI_COMM_WORLD_SIZE"), ("PMI_RANK", "PMI_SIZE")):
+        if rankName in os.environ and sizeName in os.environ:
+            return int(os.environ[rankName]), int(os.environ[sizeName])
+    return 0, 1
+
+
+def shard_plan(n_estimators, n_shards, random_state=0):
+    # Trees and seed of every shard; the plan only depends on its arguments, so local
+    # and multi-node runs with the same shard count grow the same forest
+    if n_shards < 1 or n_shards > n_estimators:
+        raise ValueError("n_shards must be between 1 and n_estimators, got %d" % n_shards)
+    sizes = [n_estimators // n_shards + (1 if i < n_estimators % n_shards else 0) for i in range(n_shards)]
+    seeds = np.random.RandomState(random_state).randint(np.iinfo(np.int32).max, size=n_shards)
+    return [{"shard": i, "n_estimators": sizes[i], "random_state": int(seeds[i])} for i in range(n_shards)]
+
+
+def fit_shard(X, y, shard, n_jobs=1, **forest_params):
+    forest = RandomForestClassifier(n_estimators=shard["n_estimators"], random_state=shard["random_state"],
+                                    n_jobs=n_jobs, **forest_params)
+    start = time.time()
+    forest.fit(X, y)
+    print("....shard %d: %d trees (%.1f s)" % (shard["shard"], shard["n_estimators"], time.time() - start))
+    return forest
+
+
+def merge_forests(forests):
+    # One estimator holding the trees of every sub-forest, in shard order
+    merged = copy.copy(forests[0])
+    for forest in forests[1:]:
+        if not np.array_equal(forest.classes_, merged.classes_):
+            raise ValueError("sub-forests were fitted on different classes")
+        if forest.estimators_[0].tree_.n_features != merged.estimators_[0].tree_.n_features:
+            raise ValueError("sub-forests were fitted on different features")
+    merged.estimators_ = [tree for forest in forests for tree in forest.estimators_]
+    merged.n_estimators = len(merged.estimators_)
+    # The seed no longer describes the merged forest; every tree keeps its own
+    merged.random_state = None
+    return merged
+
+
+def _init_worker(directory):
+    for name in ("X", "y"):
+        _shared[name] = np.load(os.path.join(directory, name + ".npy"), mmap_mode='r')
+
+
+def _fit_shard_worker(shard, forest_params):
+    return fit_shard(_shared["X"], _shared["y"], shard, **forest_params)
+
+
+def fit_sharded(X, y, n_estimators, n_shards, workers=None, random_state=0, **forest_params):
+    # Local multi-process mode: one pool task per shard over a matrix shared through
+    # /dev/shm, standing in for one node per shard
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    y = np.ascontiguousarray(y)
+    plan = shard_plan(n_estimators, n_shards, random_state)
+    sharedRoot = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    directory = tempfile.mkdtemp(prefix='chd-shards-', dir=sharedRoot)
+    try:
+        np.save(os.path.join(directory, "X.npy"), X)
+        np.save(os.path.join(directory, "y.npy"), y)
+        with Pool(processes=workers or min(n_shards, os.cpu_count()), initializer=_init_worker,
+                  initargs=(directory,)) as pool:
+            forests = pool.starmap(_fit_shard_worker, [(shard, forest_params) for shard in plan])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return merge_forests(forests)
+
+
+def save_shard(forest, directory, shard):
+    # Written under a temporary name and renamed, so the merging rank never reads a partial file
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, SHARD_FILE % shard)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(forest, f)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def collect_shards(directory, n_shards, timeout=3600, poll_seconds=5):
+    # Waits for the sub-forest of every rank in the shared directory and merges them
+    paths = [os.path.join(directory, SHARD_FILE % shard) for shard in range(n_shards)]
+    deadline = time.time() + timeout
+    while not all(os.path.exists(path) for path in paths):
+        if time.time() > deadline:
+            missing = [path for path in paths if not os.path.exists(path)]
+            raise RuntimeError("timed out waiting for forest shards: %s" % missing)
+        time.sleep(poll_seconds)
+    forests = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            forests.append(pickle.load(f))
+    return merge_forests(forests)
@@ -0,0 +1,87 @@
+import json
+import os
+import resource
+import time
+
+# Per-stage profiling for train.py: wall time, CPU time (this process plus finished
+# worker processes) and peak RSS of every stage. On Linux the peak RSS watermark is
+# reset at the start of each stage through /proc/self/clear_refs, so each stage reports
+# its own peak; elsewhere the value is the process peak reached by the end of the stage.
+
+
+def peak_rss_mb():
+    # Peak resident set size of this process and of its (largest) child process, in MB
+    selfMb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    childrenMb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    return selfMb, childrenMb
+
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _stage_peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    return peak_rss_mb()[0]
+
+
+def _cpu_seconds():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class StageProfiler(object):
+
+    def __init__(self):
+        self.stages = []
+        self._current = None
+
+    def start(self, name):
+        # Ends the running stage, if any, and starts timing the next one
+        self.stop()
+        self._current = {"stage": name, "wall": time.perf_counter(), "cpu": _cpu_seconds(),
+                         "rss_reset": _reset_peak_rss()}
+
+    def stop(self):
+        if self._current is None:
+            return
+        current, self._current = self._current, None
+        self.stages.append({
+            "stage": current["stage"],
+            "wall_seconds": time.perf_counter() - current["wall"],
+            "cpu_seconds": _cpu_seconds() - current["cpu"],
+            "peak_rss_mb": _stage_peak_rss_mb(),
+            "peak_rss_scope": "stage" if current["rss_reset"] else "process",
+        })
+
+    def to_dict(self):
+        return {
+            "stages": self.stages,
+            "total_wall_seconds": sum(stage["wall_seconds"] for stage in self.stages),
+            "total_cpu_seconds": sum(stage["cpu_seconds"] for stage in self.stages),
+            "peak_rss_mb": max([stage["peak_rss_mb"] for stage in self.stages] or [0.0]),
+        }
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def log(self, run):
+        # One metric per stage and measure, plus the whole profile as a table
+        for stage in self.stages:
+            for measure in ("wall_seconds", "cpu_seconds", "peak_rss_mb"):
+                run.log("%s_%s" % (stage["stage"], measure), stage[measure])
+        run.log_table("stage_profile", {
+            column: [stage[column] for stage in self.stages]
+            for column in ("stage", "wall_seconds", "cpu_seconds", "peak_rss_mb")})
@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+
+from data_cache import FRAMINGHAM_SCHEMA, download, is_url
+from preprocessing import Preprocessor
+from sharded_forest import merge_forests, shard_plan
+
+# Out-of-core training path of train.py for datasets larger than memory.
+# Pass 1 streams the CSV in chunks to fit the imputation statistics and to keep a
+# bounded uniform sample (for the feature selector). Pass 2 streams it again and grows
+# one sub-forest per chunk, merged into a single forest. Peak memory is set by the
+# chunk and sample sizes, not by the size of the input.
+
+
+def local_copy(source, directory=None):
+    # pandas buffers a whole http(s) response in memory before chunking it, and the data
+    # is read twice: a URL is streamed once to a local temporary file both passes read
+    if not is_url(source):
+        return source
+    return download(source, directory)
+
+
+def read_chunks(source, chunk_rows=100000, schema=FRAMINGHAM_SCHEMA):
+    return pd.read_csv(source, dtype=schema, chunksize=chunk_rows)
+
+
+def read_columns(source):
+    return list(pd.read_csv(source, nrows=0).columns)
+
+
+def _holdout(chunk, test_size, random_state, index):
+    # Per-chunk seeded test mask, the streaming counterpart of train_test_split
+    return np.random.RandomState([random_state, index]).rand(len(chunk)) < test_size
+
+
+class DatasetScan(object):
+    # Result of the first pass: fitted preprocessing, a uniform sample of the training
+    # rows and the row/chunk counts the second pass plans the trees with
+
+    def __init__(self, preprocessor, sample, n_rows, n_train_rows, n_chunks):
+        self.preprocessor = preprocessor
+        self.sample = sample
+        self.n_rows = n_rows
+        self.n_train_rows = n_train_rows
+        self.n_chunks = n_chunks
+
+
+def scan(source, feature_columns=None, chunk_rows=100000, sample_rows=100000, test_size=0.2, random_state=14):
+    counts = {"rows": 0, "train_rows": 0, "chunks": 0}
+    reservoir = {"rows": None, "keys": None}
+    randomState = np.random.RandomState(random_state)
+
+    def trainingChunks():
+        for index, chunk in enumerate(read_chunks(source, chunk_rows)):
+            counts["rows"] += len(chunk)
+            counts["chunks"] += 1
+            chunk = chunk[~_holdout(chunk, test_size, random_state, index)]
+            counts["train_rows"] += len(chunk)
+            # Reservoir sample: keep the sample_rows rows with the smallest random keys
+            keys = randomState.rand(len(chunk))
+            if reservoir["rows"] is not None:
+                candidates = pd.concat([reservoir["rows"], chunk], ignore_index=True)
+                keys = np.concatenate([reservoir["keys"], keys])
+            else:
+                candidates = chunk.reset_index(drop=True)
+            keep = np.sort(np.argsort(keys, kind='stable')[:sample_rows])
+            reservoir["rows"], reservoir["keys"] = candidates.iloc[keep].reset_index(drop=True), keys[keep]
+            yield chunk
+
+    preprocessor = Preprocessor.fit_chunks(trainingChunks(), feature_columns)
+    return DatasetScan(preprocessor, reservoir["rows"], counts["rows"], counts["train_rows"], counts["chunks"])
+
+
+def fit_chunked_forest(source, dataset_scan, selected_columns, label_column, n_estimators, chunk_rows=100000,
+                       test_size=0.2, random_state=14, n_jobs=-1, **forest_params):
+    # One sub-forest per chunk over the selected columns; chunks share the trees of a
+    # shard plan, so the merged forest has exactly n_estimators trees
+    preprocessor = dataset_scan.preprocessor
+    plan = shard_plan(n_estimators, dataset_scan.n_chunks)
+    selectedIndex = [preprocessor.columns.index(column) for column in selected_columns]
+    forests = []
+    for index, chunk in enumerate(read_chunks(source, chunk_rows)):
+        chunk = chunk[~_holdout(chunk, test_size, random_state, index)]
+        X = preprocessor.transform(chunk[preprocessor.columns].values.astype(np.float64))[:, selectedIndex]
+        forest = RandomForestClassifier(n_estimators=plan[index]["n_estimators"],
+                                        random_state=plan[index]["random_state"], n_jobs=n_jobs, **forest_params)
+        forest.fit(X, chunk[label_column].values)
+        forests.append(forest)
+        print("....chunk %d: %d rows, %d trees" % (index, len(chunk), plan[index]["n_estimators"]))
+    return merge_forests(forests)
+
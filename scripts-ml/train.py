@@ -1,9 +1,11 @@
 import argparse
 import os
+import sys
 import pandas as pd
 import numpy as np
 import pickle
 import json
+import time
 
 import sklearn
 from sklearn.model_selection import train_test_split
@@ -18,6 +20,18 @@ import azureml.core
 from azureml.core import Run
 from azureml.core.model import Model
 
+import model_bundle
+from data_cache import load_dataset
+from drift_sketch import DriftSketch
+from forest_engine import ForestEngine
+from forest_growth import grow_forest
+from hyperparameter_search import successive_halving
+from lookup_table import LookupTable, grid_from_data
+from preprocessing import Preprocessor
+from stage_profiler import StageProfiler, peak_rss_mb
+from streaming_training import fit_chunked_forest, local_copy, read_columns, scan
+from sharded_forest import collect_shards, fit_shard, fit_sharded, mpi_rank, save_shard, shard_plan
+
 print("**********************************************")
 print("INSIDE train.py")
 print("**********************************************")
@@ -27,35 +41,97 @@ print('.............................................')
 parser = argparse.ArgumentParser("train")
 parser.add_argument("--model_name", type=str, help="model name", dest="model_name", required=True)
 parser.add_argument("--build_number", type=str, help="build number", dest="build_number", required=True)
+parser.add_argument("--artifact_format", type=str, help="model artifact format", dest="artifact_format",
+                    choices=["pickle", "arrays", "both"], default="both")
+parser.add_argument("--search", help="successive-halving hyperparameter search before the final fit",
+                    dest="search", action="store_true")
+parser.add_argument("--search_candidates", type=int, help="configurations sampled for the search",
+                    dest="search_candidates", default=32)
+parser.add_argument("--search_workers", type=int, help="search worker processes (default: all cores)",
+                    dest="search_workers", default=None)
+parser.add_argument("--data", type=str, help="training data url or local csv path", dest="data",
+                    default='https://mlopssa.blob.core.windows.net/chd-dataset/framingham.csv')
+parser.add_argument("--data_cache_dir", type=str, help="persistent dataset cache directory, e.g. a datastore mount "
+                    "(default: no cache)", dest="data_cache_dir", default=None)
+parser.add_argument("--n_estimators", type=int, help="trees in the final forest (maximum when growing)",
+                    dest="n_estimators", default=10000)
+parser.add_argument("--growth_step", type=int, help="grow the forest by this many trees until the OOB score plateaus (0 = fixed size)",
+                    dest="growth_step", default=0)
+parser.add_argument("--oob_tolerance", type=float, help="minimum OOB score gain that counts as improvement",
+                    dest="oob_tolerance", default=0.001)
+parser.add_argument("--oob_patience", type=int, help="increments without improvement before growth stops",
+                    dest="oob_patience", default=3)
+parser.add_argument("--shards", type=int, help="sub-forests grown in parallel and merged (local worker processes, or one per MPI node)",
+                    dest="shards", default=1)
+parser.add_argument("--shard_dir", type=str, help="directory shared by the MPI nodes for the sub-forests",
+                    dest="shard_dir", default='./outputs/forest-shards')
+parser.add_argument("--streaming", help="out-of-core training: stream the data in chunks instead of loading it",
+                    dest="streaming", action="store_true")
+parser.add_argument("--chunk_rows", type=int, help="rows per chunk when streaming", dest="chunk_rows", default=100000)
+parser.add_argument("--sample_rows", type=int, help="rows sampled for the feature selector when streaming",
+                    dest="sample_rows", default=100000)
+parser.add_argument("--lookup_table", help="bundle a prediction lookup table over the selected features "
+                    "(build time grows with the tree count)", dest="lookup_table", action="store_true")
 
 args = parser.parse_args()
 
 print("Argument 1: %s" % args.model_name)
 print("Argument 2: %s" % args.build_number)
+print("Argument 3: %s" % args.artifact_format)
+print("Argument 4: %s" % args.n_estimators)
+print("Argument 5: %s" % args.growth_step)
+print("Argument 6: %s" % args.oob_tolerance)
+print("Argument 7: %s" % args.oob_patience)
+print("Argument 8: %s" % args.data)
+print("Argument 9: %s" % args.data_cache_dir)
+print("Argument 10: %s" % args.search)
+print("Argument 11: %s" % args.search_candidates)
+print("Argument 12: %s" % args.search_workers)
+print("Argument 13: %s" % args.shards)
+print("Argument 14: %s" % args.shard_dir)
+print("Argument 15: %s" % args.streaming)
+print("Argument 16: %s" % args.chunk_rows)
+print("Argument 17: %s" % args.sample_rows)
+print("Argument 18: %s" % args.lookup_table)
 print('')
 print('')
 
 print("2. Read training data from remote storage")
 print('.............................................')
-# Pandas dataframe
-df = pd.read_csv('https://mlopssa.blob.core.windows.net/chd-dataset/framingham.csv')
+# Wall/CPU time and peak RSS of every stage, saved next to the model and logged to the run
+profiler = StageProfiler()
+profiler.start("data_load")
+trainingStart = time.time()
+if args.streaming:
+    # Both passes chunk from a local file: a url is downloaded once, straight to disk
+    streamingSource = local_copy(args.data)
+    # First pass over the chunks: imputation statistics and a bounded sample of the training rows
+    featureColumns = read_columns(streamingSource)[:-1]
+    datasetScan = scan(streamingSource, featureColumns, chunk_rows=args.chunk_rows, sample_rows=args.sample_rows)
+    df = datasetScan.sample
+    print("Scanned {} rows in {} chunks, {} training rows sampled".format(datasetScan.n_rows, datasetScan.n_chunks,
+                                                                         len(df)))
+else:
+    # Pandas dataframe, served from the content-addressed cache when the data is unchanged
+    df = load_dataset(args.data, cache_dir=args.data_cache_dir)
 print('')
 print('')
 
 print("3. Cleanse/transform data")
 print('.............................................')
-# create a boolean array of smokers
-smoke = (df['currentSmoker']==1)
-# Apply mean to NaNs in cigsPerDay but using a set of smokers only
-df.loc[smoke,'cigsPerDay'] = df.loc[smoke,'cigsPerDay'].fillna(df.loc[smoke,'cigsPerDay'].mean())
-
-# Fill out missing values
-df['BPMeds'].fillna(0, inplace = True)
-df['glucose'].fillna(df.glucose.mean(), inplace = True)
-df['totChol'].fillna(df.totChol.mean(), inplace = True)
-df['education'].fillna(1, inplace = True)
-df['BMI'].fillna(df.BMI.mean(), inplace = True)
-df['heartRate'].fillna(df.heartRate.mean(), inplace = True)
+# Fit the imputation statistics once and apply them with numpy: mean of cigsPerDay
+# over smokers (for smokers), means of glucose/totChol/BMI/heartRate, BPMeds=0 and
+# education=1. The same fitted object is bundled with the model for scoring.
+profiler.start("imputation")
+if args.streaming:
+    preprocessor = datasetScan.preprocessor
+else:
+    featureColumns = list(df.columns[:-1])
+    preprocessor = Preprocessor.fit(df, featureColumns)
+# Feature values before imputation: the lookup table grid and the drift reference are
+# built from the values seen in the training rows
+rawFeatures = df[featureColumns].copy()
+df[featureColumns] = preprocessor.transform(df[featureColumns].values)
 print('..3. completed')
 print('')
 print('')
@@ -66,22 +142,53 @@ print('.............................................')
 features = df.iloc[:,:-1]
 result = df.iloc[:,-1] # the last column is what we are about to forecast
 
-# Train & Test split
-X_train, X_test, y_train, y_test = train_test_split(features, result, test_size = 0.2, random_state = 14)
+# Train & Test split (the streamed sample holds training rows only)
+if args.streaming:
+    X_train, y_train = features, result
+else:
+    X_train, X_test, y_train, y_test = train_test_split(features, result, test_size = 0.2, random_state = 14)
+
+# Training distribution before imputation (missing values included), the drift reference;
+# the held-out test rows are left out like they are from the model
+referenceSketch = DriftSketch.from_data(rawFeatures.loc[X_train.index, featureColumns].values, featureColumns)
+
+# Forest configuration: the fixed defaults, or the best one found by the search
+forestConfig = {"n_estimators": args.n_estimators, "max_depth": None, "min_samples_leaf": 1,
+                "selector_max_depth": 2, "threshold": 0.12}
+if args.search:
+    profiler.start("hyperparameter_search")
+    print("Hyperparameter search (successive halving)...")
+    forestConfig, searchTrials = successive_halving(X_train.values, y_train.values,
+                                                    n_candidates=args.search_candidates,
+                                                    workers=args.search_workers)
+    print("Best configuration: ", forestConfig)
+    os.makedirs('./outputs', exist_ok=True)
+    with open('./outputs/hyperparameter-search.json', "w") as f:
+        json.dump({"best": forestConfig, "trials": searchTrials}, f)
+    searchRun = Run.get_context()
+    for name, value in forestConfig.items():
+        searchRun.log("best_" + name, str(value))
+    searchRun.log_table("hyperparameter_search", {
+        column: [str(trial.get(column)) for trial in searchTrials]
+        for column in ["rung", "rows", "n_estimators", "max_depth", "min_samples_leaf",
+                       "selector_max_depth", "threshold", "acc", "auc", "fit_seconds", "predict_seconds"]})
 
 # RandomForest classifier
-clf = RandomForestClassifier(n_estimators=100, max_depth=2, random_state=0)
+clf = RandomForestClassifier(n_estimators=100, max_depth=forestConfig["selector_max_depth"], random_state=0)
+profiler.start("selector_fit")
 clf.fit(X_train, y_train)
 
 # Create a selector object that will use the random forest classifier to identify
-# features that have an importance of more than 0.12
-sfm = SelectFromModel(clf, threshold=0.12)
+# features that have an importance of more than the threshold (0.12 by default)
+sfm = SelectFromModel(clf, threshold=forestConfig["threshold"])
 
 # Train the selector
+profiler.start("select_from_model_fit")
 sfm.fit(X_train, y_train)
 
 # Features selected
 featureNames = list(features.columns.values) # creating a list with features' names
+selectedFeatureNames = [featureNames[i] for i in sfm.get_support(indices=True)]
 print("Feature names:")
 for featureNameListindex in sfm.get_support(indices=True):
     print(featureNames[featureNameListindex])
@@ -98,27 +205,136 @@ for f in range(X_train.shape[1]):
 
 # With only imporant features. Can check X_important_train.shape[1]
 X_important_train = sfm.transform(X_train)
-X_important_test = sfm.transform(X_test)
+if not args.streaming:
+    X_important_test = sfm.transform(X_test)
 
-clfModel = RandomForestClassifier(n_estimators=10000, random_state=0, n_jobs=-1)
-clfModel.fit(X_important_train, y_train)
+profiler.start("forest_fit")
+if args.streaming:
+    # Second pass: one sub-forest per chunk over the selected features, merged
+    clfModel = fit_chunked_forest(args.data, datasetScan, selectedFeatureNames, df.columns[-1],
+                                  forestConfig["n_estimators"], chunk_rows=args.chunk_rows,
+                                  max_depth=forestConfig["max_depth"],
+                                  min_samples_leaf=forestConfig["min_samples_leaf"])
+    if streamingSource != args.data:
+        os.remove(streamingSource)
+    trainingRows = datasetScan.n_train_rows
+elif args.growth_step > 0:
+    # Grow in warm_start increments and stop once the OOB score plateaus
+    clfModel, growthCurve = grow_forest(X_important_train, y_train, step=args.growth_step,
+                                        max_trees=forestConfig["n_estimators"], tolerance=args.oob_tolerance,
+                                        patience=args.oob_patience, max_depth=forestConfig["max_depth"],
+                                        min_samples_leaf=forestConfig["min_samples_leaf"])
+    print("Forest grown to %d trees (oob score %.5f)" % (clfModel.n_estimators, clfModel.oob_score_))
+    os.makedirs('./outputs', exist_ok=True)
+    with open('./outputs/forest-growth.json', "w") as f:
+        json.dump({"n_estimators": clfModel.n_estimators, "curve": growthCurve}, f)
+    growthRun = Run.get_context()
+    growthRun.log("n_estimators", clfModel.n_estimators)
+    growthRun.log("oob_score", clfModel.oob_score_)
+    growthRun.log_table("forest_growth", {
+        "n_estimators": [point["n_estimators"] for point in growthCurve],
+        "oob_score": [point["oob_score"] for point in growthCurve],
+        "fit_seconds": [point["fit_seconds"] for point in growthCurve]})
+elif mpi_rank()[1] > 1:
+    # One sub-forest per MPI node; the other ranks stop once their shard is written
+    shardRank, shardCount = mpi_rank()
+    shardStart = time.time()
+    shard = shard_plan(forestConfig["n_estimators"], shardCount)[shardRank]
+    save_shard(fit_shard(X_important_train, y_train, shard, n_jobs=-1, max_depth=forestConfig["max_depth"],
+                         min_samples_leaf=forestConfig["min_samples_leaf"]), args.shard_dir, shardRank)
+    if shardRank != 0:
+        print("Shard %d of %d written to %s" % (shardRank, shardCount, args.shard_dir))
+        sys.exit(0)
+    clfModel = collect_shards(args.shard_dir, shardCount)
+    print("Merged %d shards into %d trees (%.1f s)" % (shardCount, clfModel.n_estimators, time.time() - shardStart))
+    Run.get_context().log("shard_fit_seconds", time.time() - shardStart)
+elif args.shards > 1:
+    # Local multi-process stand-in for the multi-node mode, same shard plan
+    shardStart = time.time()
+    clfModel = fit_sharded(X_important_train, y_train, forestConfig["n_estimators"], args.shards,
+                           max_depth=forestConfig["max_depth"], min_samples_leaf=forestConfig["min_samples_leaf"])
+    print("Merged %d shards into %d trees (%.1f s)" % (args.shards, clfModel.n_estimators, time.time() - shardStart))
+    Run.get_context().log("shard_fit_seconds", time.time() - shardStart)
+else:
+    clfModel = RandomForestClassifier(n_estimators=forestConfig["n_estimators"], max_depth=forestConfig["max_depth"],
+                                      min_samples_leaf=forestConfig["min_samples_leaf"], random_state=0, n_jobs=-1)
+    clfModel.fit(X_important_train, y_train)
+profiler.stop()
+if not args.streaming:
+    trainingRows = len(y_train)
+trainingSeconds = time.time() - trainingStart
+peakRssMb, peakChildRssMb = peak_rss_mb()
+print("Training throughput: %.0f rows/s (%d rows in %.1f s), peak RSS %.0f MB (workers %.0f MB)" % (
+    trainingRows / trainingSeconds, trainingRows, trainingSeconds, peakRssMb, peakChildRssMb))
+memoryRun = Run.get_context()
+memoryRun.log("training_rows_per_second", trainingRows / trainingSeconds)
+memoryRun.log("peak_rss_mb", peakRssMb)
+memoryRun.log("peak_worker_rss_mb", peakChildRssMb)
 print("..4. completed")
 print('')
 print('')
 
 print("5. Save model to disk")
 print('.............................................')
-os.makedirs('./outputs', exist_ok=True)
-modelFilename = './outputs/chd-rf-model'
-pickle.dump(clfModel, open(modelFilename, 'wb'))
+# The registered model is a folder: the pickled forest plus the artifacts built from it
+modelDirectory = './outputs/chd-rf-model'
+os.makedirs(modelDirectory, exist_ok=True)
+profiler.start("forest_engine")
+modelEngine = ForestEngine.from_model(clfModel)
+if args.artifact_format in ("pickle", "both"):
+    profiler.start("pickle")
+    modelFilename = os.path.join(modelDirectory, model_bundle.MODEL_FILE)
+    pickle.dump(clfModel, open(modelFilename, 'wb'))
+    print("Pickled model saved: ", modelFilename)
+if args.artifact_format in ("arrays", "both"):
+    profiler.start("forest_arrays")
+    # Flat node arrays + JSON manifest, memory-mapped by score.py at start-up
+    modelEngine.save(modelDirectory)
+    print("Forest node arrays saved: {} trees, {} nodes".format(modelEngine.n_trees, len(modelEngine.feature)))
+# Imputation for the columns the model actually takes, applied by score.py
+preprocessor.select(selectedFeatureNames).save(os.path.join(modelDirectory, model_bundle.PREPROCESSING_FILE))
+print("Preprocessing saved for features: ", selectedFeatureNames)
+# Reference sketch the scoring service compares live traffic against
+referenceSketch.select(selectedFeatureNames).save(os.path.join(modelDirectory, model_bundle.DRIFT_REFERENCE_FILE))
+print("Drift reference sketch saved")
 print("..5. completed")
+print('')
+print('')
 
-print("6. Register model into model registry")
+print("6. Build prediction lookup table over the selected features")
+print('.............................................')
+# One cell per combination of the selected features' values (from the smallest to the
+# largest training value, in the feature's step), so scoring can answer with one array
+# index instead of walking all the trees; other rows are still scored by the forest.
+# Opt-in: the build takes several times the forest fit, and score.py scores with the
+# forest alone when the bundle has no table
+profiler.start("lookup_table")
+lookupTable = None
+if not args.lookup_table:
+    print("Lookup table not built: pass --lookup_table to bundle one")
+else:
+    lookupGrid = grid_from_data(rawFeatures.loc[X_train.index, selectedFeatureNames].values)
+    if lookupGrid is None:
+        print("Lookup table not built: the selected features are not on a value grid")
+    else:
+        print("Lookup grid: ", {name: {"low": low, "step": step, "size": size}
+                                for name, low, step, size in zip(selectedFeatureNames, *lookupGrid)})
+        lookupTable = LookupTable.build(modelEngine, *lookupGrid)
+if lookupTable is not None:
+    lookupTable.save(modelDirectory)
+    print("Lookup table saved: shape {}, {} bytes".format(lookupTable.table.shape, lookupTable.table.nbytes))
+profiler.stop()
+print("..6. completed")
+print('')
+print('')
+
+print("7. Register model into model registry")
 print('.............................................')
 os.chdir("./outputs")
 run = Run.get_context()
 
 # Register model to Azure ML Model Registry
+profiler.start("register")
 modelDescription = 'Model to predict coronary heart disease'
 model = Model.register(
     model_path='chd-rf-model',  # this points to a local file
@@ -128,11 +344,26 @@ model = Model.register(
     workspace=run.experiment.workspace
 )
 os.chdir("..")
+profiler.stop()
 
 print("Model registered: {} \nModel Description: {} \nModel Version: {}".format(model.name, 
                                                                                 model.description, model.version))
 
-print("..6. completed")
+print("..7. completed")
+print('')
+print('')
+
+print("8. Save stage profile")
+print('.............................................')
+profileFilename = './outputs/train-profile.json'
+profiler.save(profileFilename)
+profiler.log(run)
+print("%-24s %10s %10s %12s" % ("stage", "wall s", "cpu s", "peak RSS MB"))
+for stage in profiler.stages:
+    print("%-24s %10.2f %10.2f %12.0f" % (stage["stage"], stage["wall_seconds"], stage["cpu_seconds"],
+                                          stage["peak_rss_mb"]))
+print("Stage profile saved: ", profileFilename)
+print("..8. completed")
 
 print("*********************************************")
 print("EXITING train.py")
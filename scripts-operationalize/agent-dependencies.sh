@@ -1,3 +1,5 @@
 python --version
 pip install azure-cli==2.12.1
 pip install --upgrade azureml-sdk[cli]
+# capacity_planner.py benchmarks the scoring script on the agent
+pip install numpy pandas scikit-learn pyarrow msgpack
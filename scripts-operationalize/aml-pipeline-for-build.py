@@ -1,16 +1,20 @@
 import argparse
+import json
+import os
 import azureml.core
 from azureml.core import Workspace, Experiment, Run, Datastore
 from azureml.data.azure_storage_datastore import AzureBlobDatastore
 from azureml.core.compute import AmlCompute
 from azureml.core.compute import ComputeTarget
-from azureml.core.runconfig import RunConfiguration
+from azureml.core.runconfig import RunConfiguration, MpiConfiguration
 from azureml.core.conda_dependencies import CondaDependencies
 from azureml.core.runconfig import DEFAULT_CPU_IMAGE
 from azureml.data.data_reference import DataReference
 from azureml.pipeline.core import Pipeline, PipelineData
 from azureml.pipeline.steps import PythonScriptStep
 from azureml.core.authentication import AzureCliAuthentication
+from step_cache import DatastoreStepCache, LocalStepCache, data_fingerprint, deployment_fingerprint, hash_sources, \
+    step_key
 
 print("*********************************************")
 print("INSIDE aml-pipeline-for-build.py")
@@ -26,6 +30,12 @@ parser.add_argument("--model_name", type=str, help="model name", dest="model_nam
 parser.add_argument("--build_number", type=str, help="build number", dest="build_number", required=True)
 parser.add_argument("--image_name", type=str, help="image name", dest="image_name", required=True)
 parser.add_argument("--path", type=str, help="path", dest="path", required=True)
+parser.add_argument("--data", type=str, help="training data url or path, fingerprinted for the step cache", dest="data",
+                    default='https://mlopssa.blob.core.windows.net/chd-dataset/framingham.csv')
+parser.add_argument("--step_cache", type=str, help="'datastore', a local cache directory, or 'none'", dest="step_cache",
+                    default='datastore')
+parser.add_argument("--train_nodes", type=int, help="compute nodes growing sub-forests in parallel (1 = single node)",
+                    dest="train_nodes", default=1)
 args = parser.parse_args()
 
 print("Azure ML SDK version:", azureml.core.VERSION)
@@ -34,6 +44,9 @@ print("Argument 2 (model name): %s" % args.model_name)
 print("Argument 3 (build number): %s" % args.build_number)
 print("Argument 4 (container image name): %s" % args.image_name)
 print("Argument 5 (path): %s" % args.path)
+print("Argument 6 (data): %s" % args.data)
+print("Argument 7 (step cache): %s" % args.step_cache)
+print("Argument 8 (train nodes): %s" % args.train_nodes)
 print('..1. completed')
 print('')
 print('')
@@ -76,23 +89,73 @@ amlComputeRunConf.environment.python.conda_dependencies = CondaDependencies.crea
     'numpy',
     'pandas',
     'scikit-learn',
+    'pyarrow',
     'azureml-sdk'
 ])
+# Training runs as an MPI job with one process per node when sharded: every node grows
+# a disjoint sub-forest and rank 0 merges them (see sharded_forest.py)
+trainRunConf = amlComputeRunConf
+trainArguments = ["--model_name", args.model_name, "--data", args.data]
+if args.train_nodes > 1:
+    trainRunConf = RunConfiguration()
+    trainRunConf.target = args.aml_compute_target
+    trainRunConf.environment = amlComputeRunConf.environment
+    trainRunConf.auto_prepare_environment = True
+    trainRunConf.framework = 'Python'
+    trainRunConf.communicator = 'IntelMpi'
+    trainRunConf.node_count = args.train_nodes
+    trainRunConf.mpi = MpiConfiguration()
+    trainRunConf.mpi.process_count_per_node = 1
+    trainArguments += ["--shards", str(args.train_nodes)]
 print("..5. completed")
 print('')
 print('')
+print("5.1. Look up step results in the build step cache...")
+print('.............................................')
+# A step is keyed on its sources, arguments, conda spec and input data. The build number
+# is left out: it only tags the registered model and does not change what gets built.
+# containerize also evaluates the model against the deployed one, so the current
+# deployment is one of its inputs.
+trainCacheHit = None
+containerizeCacheHit = None
+stepCache = None
+if args.step_cache == 'datastore':
+    stepCache = DatastoreStepCache(amlWsStorageRef)
+elif args.step_cache != 'none':
+    stepCache = LocalStepCache(args.step_cache)
+if stepCache is not None:
+    mlScriptsHash = hash_sources(mlScriptsDir)
+    condaSpec = amlComputeRunConf.environment.python.conda_dependencies.serialize_to_string()
+    trainKey = step_key('train', mlScriptsHash, trainArguments, condaSpec, [data_fingerprint(args.data)])
+    containerizeKey = step_key('containerize', mlScriptsHash,
+                               ["--model_name", args.model_name, "--image_name", args.image_name],
+                               condaSpec, [trainKey, deployment_fingerprint(amlWs, args.model_name)])
+    trainCacheHit = stepCache.get('train', trainKey)
+    containerizeCacheHit = stepCache.get('containerize', containerizeKey)
+    print("train step key: %s (%s)" % (trainKey, 'hit' if trainCacheHit else 'miss'))
+    print("containerize step key: %s (%s)" % (containerizeKey, 'hit' if containerizeCacheHit else 'miss'))
+print("..5.1. completed")
+print('')
+print('')
+
 
 print("6. Define pipeline stage - training...")
 print('.............................................')
 training_output = PipelineData('train_output', datastore=amlWsStorageRef)
+# The dataset cache lives on the default datastore, mounted into the step, so the parsed
+# dataset outlives the step container and is reused by the next builds
+datasetCacheRef = DataReference(datastore=amlWsStorageRef, data_reference_name='dataset_cache',
+                                path_on_datastore='dataset-cache', mode='mount')
 trainPipelineStep = PythonScriptStep(
     name="train",
     script_name="train.py", 
-    arguments=["--model_name", args.model_name,
-              "--build_number", args.build_number],
+    arguments=trainArguments + ["--build_number", args.build_number,
+                                "--shard_dir", training_output,
+                                "--data_cache_dir", datasetCacheRef],
+    inputs=[datasetCacheRef],
     outputs=[training_output],
     compute_target=amlTrainingComputeRef,
-    runconfig=amlComputeRunConf,
+    runconfig=trainRunConf,
     source_directory=mlScriptsDir,
     allow_reuse=False
 )
@@ -103,12 +166,17 @@ print('')
 print("7. Define pipeline stage - containerize...")
 print('.............................................')
 containerize_output = PipelineData('containerize_output', datastore=amlWsStorageRef)
+containerizeArguments = ["--model_name", args.model_name,
+                         "--image_name", args.image_name,
+                         "--output", containerize_output]
+if trainCacheHit:
+    # Training is skipped: pin the model version the cached train step registered, the
+    # newest one in the registry may come from another build
+    containerizeArguments += ["--model_version", str(trainCacheHit["model_version"])]
 containerizePipelineStep = PythonScriptStep(
     name="containerize",
     script_name="containerize.py", 
-    arguments=["--model_name", args.model_name,  
-               "--image_name", args.image_name, 
-               "--output", containerize_output],
+    arguments=containerizeArguments,
     outputs=[containerize_output],
     compute_target=amlTrainingComputeRef,
     runconfig=amlComputeRunConf,
@@ -121,7 +189,11 @@ print('')
 
 print("8. Define pipeline stages sequence, and pipeline itself...")
 print('.............................................')
-containerizePipelineStep.run_after(trainPipelineStep)
+if trainCacheHit:
+    # The model this code and data produce is already registered: only containerize
+    print("Reusing registered model {} version {}".format(trainCacheHit["model_name"], trainCacheHit["model_version"]))
+else:
+    containerizePipelineStep.run_after(trainPipelineStep)
 pipeLineSteps = [containerizePipelineStep]
 pipeline = Pipeline(workspace=amlWs, steps=pipeLineSteps)
 pipeline.validate()
@@ -129,43 +201,57 @@ print("..8. completed")
 print('')
 print('')
 
-print("9. Create run object for the experiment...")
-print('.............................................')
-run = Run.get_context()
-experimentName = run.experiment.name
-print("..9. completed")
-print('')
-print('')
+if containerizeCacheHit:
+    print("9-12. Build step cache hit, reusing the containerize output of a previous build...")
+    print('.............................................')
+    buildPipelineOutputVarsJson = dict(containerizeCacheHit["containerize_info"], step_cache_hit=True)
+    print(buildPipelineOutputVarsJson)
+    print("..9-12. completed")
+    print('')
+    print('')
+else:
+    print("9. Create run object for the experiment...")
+    print('.............................................')
+    run = Run.get_context()
+    experimentName = run.experiment.name
+    print("..9. completed")
+    print('')
+    print('')
 
-print("10. Submit build pipeline run, synchronously/blocking...")
-print('.............................................')
-pipelineRun = Experiment(amlWs, experimentName).submit(pipeline)
-pipelineRun.wait_for_completion(show_output=True)
-print("..10. completed")
-print('')
-print('')
+    print("10. Submit build pipeline run, synchronously/blocking...")
+    print('.............................................')
+    pipelineRun = Experiment(amlWs, experimentName).submit(pipeline)
+    pipelineRun.wait_for_completion(show_output=True)
+    print("..10. completed")
+    print('')
+    print('')
 
-print("11. Download pipeline output...")
-print('.............................................')
-# Get a handle to the output of containerize pipeline stage
-pipelineStagesLog = pipelineRun.find_step_run('containerize')[0].get_output_data('containerize_output')
-# Download locally
-pipelineStagesLog.download('.', show_progress=True)
-print("..11. completed")
-print('')
-print('')
+    print("11. Download pipeline output...")
+    print('.............................................')
+    # Get a handle to the output of containerize pipeline stage
+    pipelineStagesLog = pipelineRun.find_step_run('containerize')[0].get_output_data('containerize_output')
+    # Download locally
+    pipelineStagesLog.download('.', show_progress=True)
+    print("..11. completed")
+    print('')
+    print('')
 
-print("12. Parse pipeline stages log into JSON...")
-print('.............................................')
-import json
-# load the pipeline output json
-with open(os.path.join('./', pipelineStagesLog.path_on_datastore, 'containerize_info.json')) as f:
-    buildPipelineOutputVarsJson = json.load(f)
+    print("12. Parse pipeline stages log into JSON...")
+    print('.............................................')
+    # load the pipeline output json
+    with open(os.path.join('./', pipelineStagesLog.path_on_datastore, 'containerize_info.json')) as f:
+        buildPipelineOutputVarsJson = json.load(f)
 
-print(buildPipelineOutputVarsJson)
-print("..12. completed")
-print('')
-print('')
+    print(buildPipelineOutputVarsJson)
+    print("..12. completed")
+    print('')
+    print('')
+
+    if stepCache is not None and pipelineRun.get_status() == 'Finished':
+        stepCache.put('train', trainKey, {"model_name": buildPipelineOutputVarsJson["model_name"],
+                                          "model_version": buildPipelineOutputVarsJson["model_version"]})
+        stepCache.put('containerize', containerizeKey, {"containerize_info": buildPipelineOutputVarsJson})
+        print("Step results recorded in the build step cache")
 
 print("13. Persist pipeline stages output json for use by the release pipeline...")
 print('.............................................')
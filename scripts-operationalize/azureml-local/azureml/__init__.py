@@ -0,0 +1,3 @@
+# Local stand-in for the parts of the Azure ML SDK used by the build, scoring and
+# release scripts. Put the azureml-local directory first on PYTHONPATH (the local
+# pipeline executor does this) to run those scripts without an Azure workspace.
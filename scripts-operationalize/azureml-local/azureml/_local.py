@@ -0,0 +1,59 @@
+import json
+import os
+import threading
+import uuid
+
+# Shared state of the local Azure ML stand-in.
+# Everything the build scripts register or log (models, run metrics, images, services)
+# is kept as plain files under the directory named by CHD_LOCAL_WORKSPACE, so several
+# step processes of one local build see the same "workspace".
+
+WORKSPACE_ENV = 'CHD_LOCAL_WORKSPACE'
+RUN_ID_ENV = 'CHD_LOCAL_RUN_ID'
+EXPERIMENT_ENV = 'CHD_LOCAL_EXPERIMENT'
+
+_lock = threading.Lock()
+
+
+def workspace_dir():
+    directory = os.environ.get(WORKSPACE_ENV, os.path.join(os.getcwd(), 'local-workspace'))
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def path(*parts):
+    return os.path.join(workspace_dir(), *parts)
+
+
+def read_json(file_path, default=None):
+    if not os.path.exists(file_path):
+        return default
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def write_json(file_path, data):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    temporaryPath = '%s.%s.tmp' % (file_path, uuid.uuid4().hex)
+    with open(temporaryPath, 'w') as f:
+        json.dump(data, f, indent=2, default=str)
+    os.replace(temporaryPath, file_path)
+
+
+def next_version(directory):
+    # Versions are allocated by creating the version directory, which is atomic
+    os.makedirs(directory, exist_ok=True)
+    with _lock:
+        version = 1
+        while True:
+            try:
+                os.mkdir(os.path.join(directory, str(version)))
+                return version
+            except FileExistsError:
+                version += 1
+
+
+def versions(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(v) for v in os.listdir(directory) if v.isdigit())
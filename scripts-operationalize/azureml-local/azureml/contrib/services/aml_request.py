@@ -0,0 +1,35 @@
+class _Headers(dict):
+    # Case-insensitive header lookup, like the Flask request headers
+
+    def __init__(self, headers=None):
+        dict.__init__(self, ((k.lower(), v) for k, v in (headers or {}).items()))
+
+    def get(self, key, default=None):
+        return dict.get(self, key.lower(), default)
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, key.lower())
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key.lower())
+
+
+class AMLRequest(object):
+    # Minimal request object with the attributes score.run reads
+
+    def __init__(self, method='POST', headers=None, data=b'', args=None, path='/score'):
+        self.method = method
+        self.headers = _Headers(headers)
+        self.args = dict(args or {})
+        self.path = path
+        self._data = data
+
+    def get_data(self, cache=True, as_text=False):
+        if as_text and isinstance(self._data, bytes):
+            return self._data.decode('utf-8')
+        return self._data
+
+
+def rawhttp(func):
+    func._wrapped_request = True
+    return func
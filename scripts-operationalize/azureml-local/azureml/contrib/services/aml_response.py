@@ -0,0 +1,6 @@
+class AMLResponse(object):
+
+    def __init__(self, message, status_code, response_headers=None, json_str=False):
+        self.data = message
+        self.status_code = status_code
+        self.headers = dict(response_headers or {})
@@ -0,0 +1,102 @@
+import os
+import time
+
+from azureml import _local
+
+VERSION = 'local'
+
+
+class Workspace(object):
+
+    def __init__(self, name='local', directory=None):
+        self.name = name
+        self.directory = directory or _local.workspace_dir()
+        self.compute_targets = {}
+
+    @classmethod
+    def from_config(cls, path=None, auth=None):
+        return cls()
+
+    def get_default_datastore(self):
+        return Datastore(self, 'workspaceblobstore')
+
+
+class Datastore(object):
+
+    def __init__(self, workspace, name):
+        self.workspace = workspace
+        self.name = name
+
+    def _root(self):
+        return _local.path('datastores', self.name)
+
+    def upload_files(self, files, target_path=None, overwrite=False, show_progress=True):
+        import shutil
+        directory = os.path.join(self._root(), target_path or '')
+        os.makedirs(directory, exist_ok=True)
+        for file_path in files:
+            destination = os.path.join(directory, os.path.basename(file_path))
+            if overwrite or not os.path.exists(destination):
+                shutil.copyfile(file_path, destination)
+
+    def download(self, target_path, prefix=None, overwrite=False, show_progress=True):
+        import shutil
+        source = os.path.join(self._root(), prefix or '')
+        if os.path.isfile(source):
+            destination = os.path.join(target_path, prefix)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.copyfile(source, destination)
+            return 1
+        return 0
+
+
+class Experiment(object):
+
+    def __init__(self, workspace, name):
+        self.workspace = workspace
+        self.name = name
+
+
+class Run(object):
+
+    def __init__(self, experiment, run_id):
+        self.experiment = experiment
+        self.id = run_id
+
+    @classmethod
+    def get_context(cls):
+        experiment = Experiment(Workspace(), os.environ.get(_local.EXPERIMENT_ENV, 'local'))
+        runId = os.environ.get(_local.RUN_ID_ENV) or 'local_%d_%d' % (int(time.time() * 1000), os.getpid())
+        return cls(experiment, runId)
+
+    def _metrics_path(self):
+        return _local.path('runs', self.id, 'metrics.json')
+
+    def _append(self, name, value):
+        metrics = _local.read_json(self._metrics_path(), {})
+        if name in metrics and not isinstance(metrics[name], list):
+            metrics[name] = [metrics[name]]
+        if name in metrics:
+            metrics[name].append(value)
+        else:
+            metrics[name] = value
+        _local.write_json(self._metrics_path(), metrics)
+
+    def log(self, name, value, description=''):
+        self._append(name, value)
+
+    def log_list(self, name, value, description=''):
+        self._append(name, list(value))
+
+    def log_table(self, name, value, description=''):
+        self._append(name, dict(value))
+
+    def get_metrics(self, name=None):
+        metrics = _local.read_json(self._metrics_path(), {})
+        return metrics if name is None else {name: metrics.get(name)}
+
+    def get_status(self):
+        return 'Finished'
+
+
+from azureml.core.image import Image  # noqa: E402  (same export as the real azureml.core)
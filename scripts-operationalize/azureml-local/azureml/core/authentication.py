@@ -0,0 +1,3 @@
+class AzureCliAuthentication(object):
+    # The local workspace needs no credentials
+    pass
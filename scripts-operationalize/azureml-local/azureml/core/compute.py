@@ -0,0 +1,18 @@
+class ComputeTarget(object):
+    # The local stand-in runs everything on this machine; no compute is provisioned
+    # (deploy-rest-service.py skips the cluster creation with --backend local)
+    pass
+
+
+class AksCompute(ComputeTarget):
+
+    @staticmethod
+    def provisioning_configuration(**kwargs):
+        return kwargs
+
+
+class AmlCompute(ComputeTarget):
+
+    def __init__(self, workspace=None, name=None):
+        self.workspace = workspace
+        self.name = name
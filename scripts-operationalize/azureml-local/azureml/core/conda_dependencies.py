@@ -0,0 +1,15 @@
+class CondaDependencies(object):
+
+    def __init__(self, conda_packages=None, pip_packages=None):
+        self.conda_packages = list(conda_packages or [])
+        self.pip_packages = list(pip_packages or [])
+
+    @classmethod
+    def create(cls, conda_packages=None, pip_packages=None, **kwargs):
+        return cls(conda_packages, pip_packages)
+
+    def serialize_to_string(self):
+        lines = ['name: project_environment', 'dependencies:']
+        lines += ['- %s' % package for package in self.conda_packages]
+        lines += ['- pip:'] + ['  - %s' % package for package in self.pip_packages]
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,91 @@
+import datetime
+import os
+import shutil
+
+from azureml import _local
+
+
+class ContainerImage(object):
+
+    @staticmethod
+    def image_configuration(execution_script=None, runtime='python', conda_file=None, dependencies=None, tags=None,
+                            base_image=None, **kwargs):
+        return {"execution_script": execution_script, "runtime": runtime, "conda_file": conda_file,
+                "dependencies": list(dependencies or []), "tags": tags, "base_image": base_image}
+
+
+class Image(object):
+    # A local "image" is a folder holding the scoring script, its dependencies and
+    # conda file, plus an image.json naming the models baked into it. An image built on
+    # a base image (local/<name>:<version>) starts from a copy of the base image's files.
+
+    def __init__(self, workspace=None, id=None, name=None, version=None):
+        if id is not None:
+            name, version = id.split(':')
+        version = version or (_local.versions(_local.path('images', name)) or [None])[-1]
+        if version is None:
+            raise Exception("Image %s not found" % (id or name))
+        record = _local.read_json(_local.path('images', name, str(version), 'image.json'))
+        self.workspace = workspace
+        self.name = name
+        self.version = int(version)
+        self.id = '%s:%d' % (name, self.version)
+        self.tags = record.get("tags") or {}
+        self.created_time = datetime.datetime.fromtimestamp(record.get("created_time", 0))
+        self.base_image = record.get("base_image")
+        self.image_location = 'local/%s' % self.id
+        self.directory = _local.path('images', name, str(version))
+        self.execution_script = record["execution_script"]
+        self.conda_file = record.get("conda_file")
+        self.model_ids = record["models"]
+        self.creation_state = 'Succeeded'
+
+    @property
+    def models(self):
+        from azureml.core.model import Model
+        return [Model(self.workspace, *model_id.split(':')) for model_id in self.model_ids]
+
+    @staticmethod
+    def list(workspace=None, image_name=None, tags=None, **kwargs):
+        if not os.path.isdir(_local.path('images')):
+            return []
+        names = [image_name] if image_name else sorted(os.listdir(_local.path('images')))
+        images = [Image(workspace, name=n, version=v) for n in names for v in _local.versions(_local.path('images', n))]
+        # tags: keys or [key, value] pairs, like the real filter
+        for tag in tags or []:
+            if isinstance(tag, (list, tuple)):
+                images = [i for i in images if i.tags.get(tag[0]) == tag[1]]
+            else:
+                images = [i for i in images if tag in i.tags]
+        return images
+
+    @staticmethod
+    def create(name=None, models=None, image_config=None, workspace=None, tags=None, **kwargs):
+        directory = _local.path('images', name)
+        version = _local.next_version(directory)
+        imageDirectory = os.path.join(directory, str(version))
+        baseImage = image_config.get("base_image")
+        if baseImage:
+            base = Image(workspace, id=baseImage[len('local/'):])
+            for file_name in os.listdir(base.directory):
+                if file_name != 'image.json':
+                    shutil.copyfile(os.path.join(base.directory, file_name), os.path.join(imageDirectory, file_name))
+        for file_path in [image_config["execution_script"], image_config["conda_file"]] + image_config["dependencies"]:
+            if file_path:
+                shutil.copyfile(file_path, os.path.join(imageDirectory, os.path.basename(file_path)))
+        _local.write_json(os.path.join(imageDirectory, 'image.json'), {
+            "name": name,
+            "version": version,
+            "tags": dict(image_config.get("tags") or {}, **(tags or {})),
+            "created_time": datetime.datetime.now().timestamp(),
+            "base_image": baseImage,
+            "execution_script": os.path.basename(image_config["execution_script"]),
+            "conda_file": (image_config["conda_file"] and os.path.basename(image_config["conda_file"])) or
+                          (baseImage and base.conda_file),
+            "models": [model.id for model in models or []],
+        })
+        return Image(workspace, name=name, version=version)
+
+    def wait_for_creation(self, show_output=False):
+        if show_output:
+            print("Local image %s created in %s" % (self.id, self.directory))
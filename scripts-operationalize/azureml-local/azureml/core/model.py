@@ -0,0 +1,56 @@
+import datetime
+import os
+import shutil
+
+from azureml import _local
+
+IMAGE_MODELS_ENV = 'CHD_LOCAL_IMAGE_MODELS'
+
+
+class Model(object):
+    # Registered models live in <workspace>/models/<name>/<version>/, with the
+    # registered file or folder copied under its own base name
+
+    def __init__(self, workspace=None, name=None, version=None):
+        version = version or (_local.versions(_local.path('models', name)) or [None])[-1]
+        if version is None:
+            raise Exception("Model %s not found" % name)
+        record = _local.read_json(_local.path('models', name, str(version), 'model.json'))
+        self.workspace = workspace
+        self.name = name
+        self.version = int(version)
+        self.id = '%s:%d' % (name, self.version)
+        self.tags = record.get("tags") or {}
+        self.description = record.get("description")
+        self.created_time = datetime.datetime.fromtimestamp(record["created_time"])
+        self.path = record["path"]
+
+    @staticmethod
+    def register(workspace=None, model_path=None, model_name=None, tags=None, description=None, **kwargs):
+        directory = _local.path('models', model_name)
+        version = _local.next_version(directory)
+        destination = os.path.join(directory, str(version), os.path.basename(os.path.normpath(model_path)))
+        if os.path.isdir(model_path):
+            shutil.copytree(model_path, destination)
+        else:
+            shutil.copyfile(model_path, destination)
+        _local.write_json(os.path.join(directory, str(version), 'model.json'), {
+            "name": model_name,
+            "version": version,
+            "tags": tags or {},
+            "description": description,
+            "created_time": datetime.datetime.now().timestamp(),
+            "path": destination,
+        })
+        return Model(workspace, model_name, version)
+
+    @staticmethod
+    def list(workspace=None, name=None, **kwargs):
+        names = [name] if name else sorted(os.listdir(_local.path('models')))
+        return [Model(workspace, n, v) for n in names for v in _local.versions(_local.path('models', n))]
+
+    @staticmethod
+    def get_model_path(model_name, version=None, _workspace=None):
+        # Inside a local scoring server only the models baked into its image are visible
+        imageModels = dict(m.split(':') for m in os.environ.get(IMAGE_MODELS_ENV, '').split(',') if m)
+        return Model(_workspace, model_name, version or imageModels.get(model_name)).path
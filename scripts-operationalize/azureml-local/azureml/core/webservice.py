@@ -0,0 +1,42 @@
+import os
+
+from azureml import _local
+from azureml.exceptions import WebserviceException
+
+
+class Webservice(object):
+    # Deployed services are recorded in <workspace>/services/<name>.json
+
+    def __init__(self, workspace=None, name=None):
+        record = _local.read_json(_local.path('services', '%s.json' % name))
+        if record is None:
+            raise WebserviceException("WebserviceNotFound: %s" % name)
+        self.workspace = workspace
+        self.name = name
+        self.tags = record.get("tags") or {}
+        self.image_id = record.get("image_id")
+        self.model_ids = record.get("models") or []
+        self.scoring_uri = record.get("scoring_uri")
+        self.state = record.get("state", 'Healthy')
+
+    @staticmethod
+    def list(workspace=None, model_name=None, **kwargs):
+        directory = _local.path('services')
+        if not os.path.isdir(directory):
+            return []
+        services = [Webservice(workspace, name[:-len('.json')])
+                    for name in sorted(os.listdir(directory)) if name.endswith('.json')]
+        if model_name:
+            services = [s for s in services if any(m.split(':')[0] == model_name for m in s.model_ids)]
+        return services
+
+    def delete(self):
+        os.remove(_local.path('services', '%s.json' % self.name))
+
+
+class AciWebservice(Webservice):
+    pass
+
+
+class AksWebservice(Webservice):
+    pass
@@ -0,0 +1,2 @@
+class WebserviceException(Exception):
+    pass
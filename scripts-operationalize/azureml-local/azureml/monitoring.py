@@ -0,0 +1,10 @@
+class ModelDataCollector(object):
+    # Accepts and drops collected data; the local stand-in has no blob storage
+
+    def __init__(self, model_name, identifier=None, feature_names=None, **kwargs):
+        self.model_name = model_name
+        self.identifier = identifier
+        self.feature_names = feature_names
+
+    def collect(self, input_data, user_correlation_id=None):
+        return None
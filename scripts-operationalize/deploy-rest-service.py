@@ -7,6 +7,13 @@ from azureml.core import Image
 from azureml.core.authentication import AzureCliAuthentication
 import json
 import os, sys
+import shutil
+import tempfile
+import pandas as pd
+from rollout import AksEndpointBackend, LocalProcessBackend, blue_green_rollout
+
+# Scoring worker processes of the AML inference image when WORKER_COUNT is not set
+IMAGE_WORKER_COUNT = 1
 
 print("*********************************************")
 print("INSIDE deploy-rest-service.py")
@@ -62,12 +69,66 @@ parser.add_argument("--service_name", type=str, help="service name", dest="servi
 parser.add_argument("--aks_name", type=str, help="aks name", dest="aks_name", required=True)
 parser.add_argument("--aks_region", type=str, help="aks region", dest="aks_region", required=True)
 parser.add_argument("--description", type=str, help="description", dest="description", required=True)
+parser.add_argument("--rollout", type=str, help="'replace' deletes the live service first, 'blue_green' swaps without downtime",
+                    dest="rollout", choices=["replace", "blue_green"], default="replace")
+parser.add_argument("--migrate_service", help="one-time switch to blue_green on AKS: delete the service deployed by 'replace' so the endpoint can take its name",
+                    dest="migrate_service", action="store_true")
+parser.add_argument("--backend", type=str, help="blue/green service backend: AKS endpoint or local processes",
+                    dest="backend", choices=["aks", "local"], default="aks")
+parser.add_argument("--warmup_data", type=str, help="csv the warm-up and probe requests are drawn from",
+                    dest="warmup_data", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'framingham.csv'))
+parser.add_argument("--warmup_features", type=str, help="comma separated model features", dest="warmup_features",
+                    default="age,prevalentHyp,sysBP,glucose")
+parser.add_argument("--traffic_steps", type=str, help="comma separated traffic percentages for the new version",
+                    dest="traffic_steps", default="10,50,100")
+parser.add_argument("--probe_requests", type=int, help="requests sent through the endpoint at each traffic step",
+                    dest="probe_requests", default=200)
+parser.add_argument("--max_error_rate", type=float, help="error rate that rolls the new version back",
+                    dest="max_error_rate", default=0.01)
+parser.add_argument("--max_p99_ratio", type=float, help="p99 latency, relative to warm-up/baseline, that rolls back",
+                    dest="max_p99_ratio", default=2.0)
+parser.add_argument("--p99_tolerance", type=float, help="relative p99 change under which warm-up has settled",
+                    dest="p99_tolerance", default=0.1)
+parser.add_argument("--capacity_plan", type=str, help="capacity plan of the build artifact (outputs/capacity-plan.json), AKS defaults if omitted",
+                    dest="capacity_plan", default=None)
 args = parser.parse_args()
 
 print("Argument 1: %s" % args.service_name)
 print("Argument 2: %s" % args.aks_name)
 print("Argument 3: %s" % args.aks_region)
 print("Argument 4: %s" % args.description)
+print("Argument 5: %s" % args.rollout)
+print("Argument 6: %s" % args.backend)
+print("Argument 7: %s" % args.traffic_steps)
+print("Argument 8: %s" % args.capacity_plan)
+print("Argument 9: %s" % args.migrate_service)
+
+# Replica resources and autoscale bounds measured by capacity_planner.py, AKS defaults otherwise
+deployConfiguration = {}
+workerCount = None
+if args.capacity_plan:
+    if not os.path.exists(args.capacity_plan):
+        print("..4.Capacity plan not found: ", args.capacity_plan)
+        sys.exit(1)
+    with open(args.capacity_plan) as f:
+        capacityPlan = json.load(f)
+    deployConfiguration = capacityPlan["deploy_configuration"]
+    workerCount = capacityPlan["worker_count"]
+    print("....Capacity plan for {} req/s at p99 {} ms (SLO met: {}): {}".format(
+        capacityPlan["target_qps"], capacityPlan["p99_slo_ms"], capacityPlan["slo_met"], deployConfiguration))
+    if capacityPlan.get("model_version") not in (None, model_version):
+        print("....WARNING: the plan was measured with model version {}, deploying version {}".format(
+            capacityPlan["model_version"], model_version))
+    if args.rollout == 'replace' and workerCount != IMAGE_WORKER_COUNT:
+        # The image of the build runs its default worker count; only endpoint versions
+        # get WORKER_COUNT, so resources sized for other worker counts would not match
+        print("....WARNING: the plan needs {} workers per replica but the image runs {}; AKS defaults are used. "
+              "Deploy with --rollout blue_green or plan with --workers {}".format(workerCount, IMAGE_WORKER_COUNT,
+                                                                                   IMAGE_WORKER_COUNT))
+        deployConfiguration = {}
+        workerCount = None
+else:
+    print("....No capacity plan given, AKS defaults are used")
 print('..4.completed')
 print('')
 print('')
@@ -101,12 +162,16 @@ print('aksName=', aksName)
 print('aksRegion=', aksRegion)
 print('aksServiceName=', aksServiceName)
 
-try:
-    mlRestService = Webservice(name=aksServiceName, workspace=amlWs)
-    print(".... Deleting AKS service {}".format(aksServiceName))
-    mlRestService.delete()
-except:
-    print(".... No existing webservice found: ", aksServiceName)
+if args.rollout == 'blue_green':
+    # The live version keeps serving until the new one takes all the traffic (step 10)
+    print(".... Blue/green rollout: existing service {} is kept".format(aksServiceName))
+else:
+    try:
+        mlRestService = Webservice(name=aksServiceName, workspace=amlWs)
+        print(".... Deleting AKS service {}".format(aksServiceName))
+        mlRestService.delete()
+    except:
+        print(".... No existing webservice found: ", aksServiceName)
 
 print('..8.completed')
 print('')
@@ -119,7 +184,9 @@ aksTarget = None
 if aksName in computeList:
     aksTarget = computeList[aksName]
     
-if aksTarget == None:
+if args.backend == 'local':
+    print("..... Local backend, no AKS inference cluster needed")
+elif aksTarget == None:
     print("..... No AKS inference cluster found. Creating new Aks inference cluster: {} and AKS REST service: {}".format(aksName, aksServiceName))
     provisioningConfig = AksCompute.provisioning_configuration(location=aksRegion)
     # Create the cluster
@@ -135,17 +202,75 @@ print('')
 
 print('10. REST service creation on AKS cluster')
 
-# Create the service configuration (using defaults)
-aksConfig = AksWebservice.deploy_configuration(description = args.description, 
-                                                tags = {'name': aksName, 'image_id': containerImage.id})
-aksRestService = Webservice.deploy_from_image(
-    workspace=amlWs,
-    name=aksServiceName,
-    image=containerImage,
-    deployment_config=aksConfig,
-    deployment_target=aksTarget
-)
-aksRestService.wait_for_deployment(show_output=True)
+
+if args.rollout == 'blue_green':
+    # Warm-up and probe requests: batches of 1, 10 and 100 rows of the model features
+    warmupRows = pd.read_csv(args.warmup_data)[args.warmup_features.split(',')]
+    warmupRows = warmupRows.astype(object).where(warmupRows.notnull(), None).values.tolist()
+    warmupPayloads = [{"data": warmupRows[i:i + size]} for i in range(0, 1000, 10) for size in (1, 1, 10, 100)]
+    versionName = "{}-{}".format(image_name, containerImage.version).replace(':', '-')
+
+    if args.backend == 'local':
+        rolloutBackend = LocalProcessBackend(aksServiceName)
+    else:
+        # Endpoint versions are created from the registered model and the scoring
+        # script/environment, the same files containerize.py bakes into the image
+        from azureml.core import Environment
+        from azureml.core.conda_dependencies import CondaDependencies
+        from azureml.core.model import InferenceConfig
+        scriptsMlDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts-ml')
+        sys.path.insert(0, scriptsMlDir)
+        import scoring_environment
+        scoringDir = tempfile.mkdtemp(prefix='chd-scoring-')
+        for dependency in scoring_environment.SCORING_DEPENDENCIES:
+            shutil.copyfile(os.path.join(scriptsMlDir, dependency), os.path.join(scoringDir, dependency))
+        scoring_environment.write_scoring_script(model_name, os.path.join(scriptsMlDir, scoring_environment.SCORING_SCRIPT),
+                                                 os.path.join(scoringDir, scoring_environment.SCORING_SCRIPT_FIXED))
+        scoringEnv = Environment('chd-scoring')
+        scoringEnv.python.conda_dependencies = CondaDependencies.create(
+            conda_packages=scoring_environment.CONDA_PACKAGES, pip_packages=scoring_environment.PIP_PACKAGES)
+        if workerCount:
+            # Scoring worker processes per replica the plan was measured with
+            scoringEnv.environment_variables = {'WORKER_COUNT': str(workerCount)}
+        inferenceConfig = InferenceConfig(entry_script=scoring_environment.SCORING_SCRIPT_FIXED,
+                                          source_directory=scoringDir, environment=scoringEnv)
+        rolloutBackend = AksEndpointBackend(amlWs, aksServiceName, aksTarget, inferenceConfig,
+                                            description=args.description,
+                                            tags={'name': aksName, 'image_id': containerImage.id},
+                                            **deployConfiguration)
+        if args.migrate_service:
+            rolloutBackend.migrate_service()
+
+    rolloutReport = blue_green_rollout(rolloutBackend, versionName, containerImage, warmupPayloads,
+                                       traffic_steps=[int(step) for step in args.traffic_steps.split(',')],
+                                       probe_requests=args.probe_requests, max_error_rate=args.max_error_rate,
+                                       max_p99_ratio=args.max_p99_ratio, p99_tolerance=args.p99_tolerance)
+    rolloutReportFilePath = os.path.join('./outputs', 'rollout-report.json')
+    with open(rolloutReportFilePath, "w") as f:
+        json.dump(rolloutReport, f, indent=2)
+    print('Rollout report saved! -', rolloutReportFilePath)
+    if rolloutReport.get("error"):
+        rolloutBackend.close()
+        print("..10.Rollout failed: {}".format(rolloutReport["error"]))
+        sys.exit(1)
+    aksRestService = rolloutBackend.service()
+    aksScoringUri = rolloutBackend.scoring_uri()
+    api_key, _ = rolloutBackend.get_keys()
+else:
+    # Create the service configuration (capacity plan or defaults)
+    aksConfig = AksWebservice.deploy_configuration(description = args.description, 
+                                                    tags = {'name': aksName, 'image_id': containerImage.id},
+                                                    **deployConfiguration)
+    aksRestService = Webservice.deploy_from_image(
+        workspace=amlWs,
+        name=aksServiceName,
+        image=containerImage,
+        deployment_config=aksConfig,
+        deployment_target=aksTarget
+    )
+    aksRestService.wait_for_deployment(show_output=True)
+    aksScoringUri = aksRestService.scoring_uri
+    api_key, _ = aksRestService.get_keys()
 print(aksRestService.state)
 
 print('..10.completed')
@@ -154,13 +279,12 @@ print('')
 
 print('11. Create output Json with Rest service details')
 
-api_key, _ = aksRestService.get_keys()
 print("....Deployed AKS REST service: {} \nREST service Uri: {} \nREST service API Key: {}".
-      format(aksRestService.name, aksRestService.scoring_uri, api_key))
+      format(aksRestService.name, aksScoringUri, api_key))
 
 aksRestServiceJson = {}
 aksRestServiceJson["aksServiceName"] = aksRestService.name
-aksRestServiceJson["aks_service_url"] = aksRestService.scoring_uri
+aksRestServiceJson["aks_service_url"] = aksScoringUri
 aksRestServiceJson["aks_service_api_key"] = api_key
 print("....AKS REST service Info")
 print(aksRestServiceJson)
@@ -170,7 +294,14 @@ print('')
 print('')
 
 print('12. Enable model metrics logging')
-aksRestService.update(enable_app_insights=True, collect_model_data=True)
+if args.backend == 'local' and args.rollout == 'blue_green':
+    print('....Local backend: app insights not available')
+    rolloutBackend.close()
+elif args.rollout == 'blue_green':
+    # AksEndpoint.update has no collect_model_data: the backend set both on every version
+    print('....App insights and model data collection enabled on every endpoint version')
+else:
+    aksRestService.update(enable_app_insights=True, collect_model_data=True)
 print('..12.completed')
 print('')
 print('')
@@ -0,0 +1,194 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from local_pipeline import LOCAL_AZUREML_DIR, LocalPipeline, LocalPipelineData, LocalStep
+from step_cache import LocalStepCache, data_fingerprint, deployment_fingerprint, hash_sources, step_key
+
+print("*********************************************")
+print("INSIDE local-pipeline-for-build.py")
+print("*********************************************")
+mlScriptsDir = 'scripts-ml'
+
+
+print('1. Parse arguments...')
+print('.............................................')
+parser = argparse.ArgumentParser("local-pipeline-for-build")
+parser.add_argument("--model_name", type=str, help="model name", dest="model_name", required=True)
+parser.add_argument("--build_number", type=str, help="build number", dest="build_number", required=True)
+parser.add_argument("--image_name", type=str, help="image name", dest="image_name", required=True)
+parser.add_argument("--path", type=str, help="path", dest="path", required=True)
+parser.add_argument("--data", type=str, help="training data url or path (default: framingham.csv under --path)",
+                    dest="data", default=None)
+parser.add_argument("--workspace_dir", type=str, help="local workspace folder (default: <path>/local-workspace)",
+                    dest="workspace_dir", default=None)
+parser.add_argument("--max_workers", type=int, help="steps run concurrently (default: all ready steps)",
+                    dest="max_workers", default=None)
+parser.add_argument("--train_arguments", type=str, help="extra train.py arguments, space separated",
+                    dest="train_arguments", default='')
+parser.add_argument("--target_qps", type=float, help="plan AKS capacity for this request rate (default: no plan)",
+                    dest="target_qps", default=None)
+parser.add_argument("--p99_slo_ms", type=float, help="p99 latency objective of the capacity plan, in ms",
+                    dest="p99_slo_ms", default=100.0)
+parser.add_argument("--step_cache", type=str, help="step cache directory (default: <workspace dir>/step-cache), "
+                    "or 'none'", dest="step_cache", default=None)
+args = parser.parse_args()
+
+path = os.path.abspath(args.path)
+data = args.data or os.path.join(path, 'framingham.csv')
+workspaceDir = args.workspace_dir or os.path.join(path, 'local-workspace')
+runDir = os.path.join(path, 'local-runs', args.build_number)
+print("Argument 1 (model name): %s" % args.model_name)
+print("Argument 2 (build number): %s" % args.build_number)
+print("Argument 3 (container image name): %s" % args.image_name)
+print("Argument 4 (path): %s" % path)
+print("Argument 5 (data): %s" % data)
+print("Argument 6 (workspace dir): %s" % workspaceDir)
+print("Argument 7 (capacity plan target qps): %s" % args.target_qps)
+print("Argument 8 (step cache): %s" % args.step_cache)
+print('..1. completed')
+print('')
+print('')
+
+print("1.1. Look up step results in the build step cache...")
+print('.............................................')
+# Same keys as aml-pipeline-for-build.py; the steps run with this interpreter, so its
+# installed packages take the place of the conda spec
+trainArguments = ["--model_name", args.model_name, "--data", data] + args.train_arguments.split()
+trainCacheHit = None
+containerizeCacheHit = None
+stepCache = None
+if args.step_cache != 'none':
+    stepCache = LocalStepCache(args.step_cache or os.path.join(workspaceDir, 'step-cache'))
+    # The local Azure ML stand-in, pointed at the workspace the steps use
+    sys.path.insert(0, LOCAL_AZUREML_DIR)
+    os.environ['CHD_LOCAL_WORKSPACE'] = workspaceDir
+    from azureml.core import Workspace
+    mlScriptsHash = hash_sources(os.path.join(path, mlScriptsDir))
+    environmentSpec = subprocess.check_output([sys.executable, '-m', 'pip', 'freeze']).decode('utf-8')
+    trainKey = step_key('train', mlScriptsHash, trainArguments, environmentSpec, [data_fingerprint(data)])
+    containerizeKey = step_key('containerize', mlScriptsHash,
+                               ["--model_name", args.model_name, "--image_name", args.image_name],
+                               environmentSpec, [trainKey, deployment_fingerprint(Workspace(), args.model_name)])
+    trainCacheHit = stepCache.get('train', trainKey)
+    containerizeCacheHit = stepCache.get('containerize', containerizeKey)
+    print("train step key: %s (%s)" % (trainKey, 'hit' if trainCacheHit else 'miss'))
+    print("containerize step key: %s (%s)" % (containerizeKey, 'hit' if containerizeCacheHit else 'miss'))
+print("..1.1. completed")
+print('')
+print('')
+
+print("2. Define pipeline stage - training...")
+print('.............................................')
+training_output = LocalPipelineData('train_output')
+trainPipelineStep = LocalStep(
+    name="train",
+    script_name="train.py",
+    arguments=trainArguments + ["--build_number", args.build_number,
+                                # Kept in the local workspace so later builds reuse the parsed dataset
+                                "--data_cache_dir", os.path.join(workspaceDir, 'dataset-cache')],
+    outputs=[training_output],
+    source_directory=os.path.join(path, mlScriptsDir)
+)
+print("..2. completed")
+print('')
+print('')
+
+print("3. Define pipeline stage - containerize...")
+print('.............................................')
+containerize_output = LocalPipelineData('containerize_output')
+containerizeArguments = ["--model_name", args.model_name,
+                         "--image_name", args.image_name,
+                         "--output", containerize_output]
+if trainCacheHit:
+    # Training is skipped: containerize the model version the cached train step registered
+    containerizeArguments += ["--model_version", str(trainCacheHit["model_version"])]
+containerizePipelineStep = LocalStep(
+    name="containerize",
+    script_name="containerize.py",
+    arguments=containerizeArguments,
+    outputs=[containerize_output],
+    source_directory=os.path.join(path, mlScriptsDir)
+)
+print("..3. completed")
+print('')
+print('')
+
+print("4. Run pipeline locally...")
+print('.............................................')
+pipelineSteps = []
+if containerizeCacheHit:
+    print("Build step cache hit, reusing the containerize output of a previous build")
+    buildPipelineOutputVarsJson = dict(containerizeCacheHit["containerize_info"], step_cache_hit=True)
+else:
+    if trainCacheHit:
+        print("Reusing registered model {} version {}".format(trainCacheHit["model_name"],
+                                                               trainCacheHit["model_version"]))
+    else:
+        containerizePipelineStep.run_after(trainPipelineStep)
+    pipelineSteps.append(containerizePipelineStep)
+if args.target_qps is not None:
+    # Same capacity plan as build step 7 of build-master-pipeline.yml, for the model just
+    # registered; it runs last so the benchmark has the machine to itself
+    capacityPlanArguments = ["--model_name", args.model_name,
+                             "--data", data,
+                             "--target_qps", args.target_qps,
+                             "--p99_slo_ms", args.p99_slo_ms,
+                             # One worker, like the image, so the plan holds for --rollout replace too
+                             "--workers", "1",
+                             "--output", os.path.join(path, 'outputs', 'capacity-plan.json')]
+    if containerizeCacheHit:
+        capacityPlanArguments += ["--model_version", str(buildPipelineOutputVarsJson["model_version"])]
+    capacityPlanStep = LocalStep(
+        name="capacity_plan",
+        script_name="capacity_planner.py",
+        arguments=capacityPlanArguments,
+        source_directory=os.path.join(path, mlScriptsDir)
+    )
+    if not containerizeCacheHit:
+        capacityPlanStep.run_after(containerizePipelineStep)
+    pipelineSteps.append(capacityPlanStep)
+pipeline = LocalPipeline(pipelineSteps, workspace_dir=workspaceDir, run_dir=runDir,
+                         experiment_name='chd-prediction-local', max_workers=args.max_workers)
+stepResults = pipeline.run()
+print("..4. completed")
+print('')
+print('')
+
+print("5. Persist step timings and pipeline output json...")
+print('.............................................')
+outputDir = os.path.join(path, 'outputs')
+os.makedirs(outputDir, exist_ok=True)
+timingsFilePath = os.path.join(outputDir, 'local-pipeline-timings.json')
+with open(timingsFilePath, "w") as f:
+    json.dump({"wall_seconds": pipeline.wall_seconds, "steps": stepResults}, f, indent=2)
+print('Step timings saved! -', timingsFilePath)
+for stepName, stepResult in stepResults.items():
+    print("%-15s %-10s %8.1f s" % (stepName, stepResult["status"], stepResult.get("seconds", 0.0)))
+print("%-15s %-10s %8.1f s" % ('total', pipeline.get_status(), pipeline.wall_seconds))
+
+if pipeline.get_status() != 'Finished':
+    print("Local pipeline failed, see the step logs above")
+    sys.exit(1)
+
+if not containerizeCacheHit:
+    with open(os.path.join(containerize_output.path, 'containerize_info.json')) as f:
+        buildPipelineOutputVarsJson = json.load(f)
+    if stepCache is not None:
+        stepCache.put('train', trainKey, {"model_name": buildPipelineOutputVarsJson["model_name"],
+                                          "model_version": buildPipelineOutputVarsJson["model_version"]})
+        stepCache.put('containerize', containerizeKey, {"containerize_info": buildPipelineOutputVarsJson})
+        print("Step results recorded in the build step cache")
+print(buildPipelineOutputVarsJson)
+buildOutputFilePath = os.path.join(outputDir, "build-pipeline-output-vars.json")
+with open(buildOutputFilePath, "w") as f:
+    json.dump(buildPipelineOutputVarsJson, f)
+    print('Output file saved! -', buildOutputFilePath)
+print("..5. completed")
+print('')
+print('')
+print('************************************************')
+print("EXITING local-pipeline-for-build.py")
+print('************************************************')
@@ -0,0 +1,141 @@
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Local executor for the build pipeline steps.
+# Mirrors the PythonScriptStep / PipelineData contract of aml-pipeline-for-build.py:
+# every step runs its script as a subprocess inside a snapshot of its source directory,
+# PipelineData arguments become local directories, and steps whose dependencies are
+# done run concurrently. Azure ML calls made by the scripts go to the local stand-in
+# in azureml-local/, which keeps models, metrics and images under one workspace folder.
+
+LOCAL_AZUREML_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'azureml-local')
+
+
+class LocalPipelineData(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.path = None
+        self.producer = None
+
+    def __str__(self):
+        return self.path or self.name
+
+
+class LocalStep(object):
+
+    def __init__(self, name, script_name, arguments=(), inputs=(), outputs=(), source_directory='.'):
+        self.name = name
+        self.script_name = script_name
+        self.arguments = list(arguments)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.source_directory = source_directory
+        self.after = []
+        for data in self.outputs:
+            data.producer = self
+
+    def run_after(self, step):
+        self.after.append(step)
+
+
+class LocalPipeline(object):
+
+    def __init__(self, steps, workspace_dir, run_dir, experiment_name='local', max_workers=None):
+        self.steps = self._with_dependencies(steps)
+        self.workspace_dir = os.path.abspath(workspace_dir)
+        self.run_dir = os.path.abspath(run_dir)
+        self.experiment_name = experiment_name
+        self.max_workers = max_workers or max(1, len(self.steps))
+        self.results = {}
+
+    @staticmethod
+    def _with_dependencies(steps):
+        # Like Pipeline(steps=...), steps reached through run_after or inputs are part of the run
+        ordered, pending = [], list(steps)
+        while pending:
+            step = pending.pop(0)
+            if step not in ordered:
+                ordered.append(step)
+                pending.extend(step.after)
+                pending.extend(data.producer for data in step.inputs if data.producer is not None)
+        return ordered
+
+    def _dependencies(self, step):
+        producers = [s for s in self.steps if any(data in s.outputs for data in step.inputs)]
+        return set(step.after) | set(producers)
+
+    def _run_step(self, step, started):
+        stepDir = os.path.join(self.run_dir, step.name)
+        snapshotDir = os.path.join(stepDir, 'snapshot')
+        if os.path.exists(stepDir):
+            shutil.rmtree(stepDir)
+        shutil.copytree(step.source_directory, snapshotDir,
+                        ignore=shutil.ignore_patterns('__pycache__', 'outputs', '*.pyc'))
+        for data in step.outputs:
+            os.makedirs(data.path, exist_ok=True)
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([LOCAL_AZUREML_DIR, snapshotDir, env.get('PYTHONPATH', '')])
+        env['CHD_LOCAL_WORKSPACE'] = self.workspace_dir
+        env['CHD_LOCAL_EXPERIMENT'] = self.experiment_name
+        env['CHD_LOCAL_RUN_ID'] = '%s_%s_%d' % (self.experiment_name, step.name, int(time.time() * 1000))
+        command = [sys.executable, step.script_name] + [str(a) for a in step.arguments]
+
+        start = time.time()
+        logPath = os.path.join(stepDir, 'log.txt')
+        with open(logPath, 'w') as log:
+            returnCode = subprocess.call(command, cwd=snapshotDir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        end = time.time()
+        return {
+            "status": 'Finished' if returnCode == 0 else 'Failed',
+            "return_code": returnCode,
+            "run_id": env['CHD_LOCAL_RUN_ID'],
+            "start_offset_seconds": start - started,
+            "seconds": end - start,
+            "log": logPath,
+        }
+
+    def run(self):
+        os.makedirs(self.run_dir, exist_ok=True)
+        for step in self.steps:
+            for data in step.outputs:
+                data.path = os.path.join(self.run_dir, 'data', data.name)
+
+        started = time.time()
+        waiting = list(self.steps)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while waiting or running:
+                for step in list(waiting):
+                    dependencies = self._dependencies(step)
+                    if any(self.results.get(d.name, {}).get("status") in ('Failed', 'Skipped') for d in dependencies):
+                        self.results[step.name] = {"status": 'Skipped'}
+                        waiting.remove(step)
+                    elif all(self.results.get(d.name, {}).get("status") == 'Finished' for d in dependencies):
+                        print("....starting step: %s" % step.name)
+                        running[pool.submit(self._run_step, step, started)] = step
+                        waiting.remove(step)
+                if not running:
+                    # Nothing left that can start (dependency cycle)
+                    for step in waiting:
+                        self.results[step.name] = {"status": 'Skipped'}
+                    break
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    self.results[step.name] = future.result()
+                    print("....step %s %s in %.1f s (log: %s)" % (step.name, self.results[step.name]["status"],
+                                                                 self.results[step.name]["seconds"],
+                                                                 self.results[step.name]["log"]))
+        self.wall_seconds = time.time() - started
+        return self.results
+
+    def get_status(self):
+        if all(r.get("status") == 'Finished' for r in self.results.values()):
+            return 'Finished'
+        return 'Failed'
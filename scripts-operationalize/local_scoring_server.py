@@ -0,0 +1,116 @@
+import argparse
+import importlib.util
+import json
+import os
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+# Local stand-in for the Azure ML inference server of the AKS service.
+# Loads a scoring script (score.py, or the score_fixed.py of a local image), calls its
+# init() before accepting connections and routes every request to run(): the request
+# is wrapped as an AMLRequest for @rawhttp scripts and AMLResponse results are turned
+# back into HTTP responses. GET / answers the liveness probe.
+# The azureml-local stand-in has to be importable (on PYTHONPATH) for the scoring script.
+
+LOCAL_AZUREML_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'azureml-local')
+
+
+def load_scoring_module(script_path):
+    # Helper modules of the scoring script are imported from its own folder
+    directory = os.path.dirname(os.path.abspath(script_path))
+    for path in (directory, LOCAL_AZUREML_DIR):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    spec = importlib.util.spec_from_file_location('score', script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(score_module, host='127.0.0.1', port=0):
+    from azureml.contrib.services.aml_request import AMLRequest
+    from azureml.contrib.services.aml_response import AMLResponse
+
+    class ScoringHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and body are separate writes; with Nagle on, keep-alive clients wait for the delayed ACK
+        disable_nagle_algorithm = True
+
+        def _respond(self, status, body, headers=None):
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _score(self, method):
+            url = urlparse(self.path)
+            if method == 'GET' and url.path in ('', '/'):
+                self._respond(200, 'Healthy', {'Content-Type': 'text/plain'})
+                return
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            args = dict((k, v[0]) for k, v in parse_qs(url.query, keep_blank_values=True).items())
+            request = AMLRequest(method, dict(self.headers.items()), body, args, url.path)
+            try:
+                result = score_module.run(request)
+            except Exception as e:
+                self._respond(500, str(e), {'Content-Type': 'text/plain'})
+                return
+            if isinstance(result, AMLResponse):
+                data = result.data
+                if not isinstance(data, (bytes, str)):
+                    data = json.dumps(data)
+                self._respond(result.status_code, data, result.headers)
+            else:
+                self._respond(200, json.dumps(result), {'Content-Type': 'application/json'})
+
+        def do_GET(self):
+            self._score('GET')
+
+        def do_POST(self):
+            self._score('POST')
+
+        def log_message(self, format, *args):
+            # Access logs would put a synchronous write on every request
+            pass
+
+    return _ThreadingHTTPServer((host, port), ScoringHandler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("local_scoring_server")
+    parser.add_argument("--score_file", type=str, help="scoring script; defaults to the one of --image_dir",
+                        dest="score_file", default=None)
+    parser.add_argument("--image_dir", type=str, help="local image folder (image.json, scoring script, helpers)",
+                        dest="image_dir", default=None)
+    parser.add_argument("--host", type=str, help="interface to listen on", dest="host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, help="port to listen on (0 = any free port)", dest="port", default=0)
+    args = parser.parse_args()
+
+    scoreFile = args.score_file
+    if scoreFile is None:
+        with open(os.path.join(args.image_dir, 'image.json')) as f:
+            image = json.load(f)
+        scoreFile = os.path.join(args.image_dir, image["execution_script"])
+        # Like a container, the server only sees the models baked into its image
+        os.environ.setdefault('CHD_LOCAL_IMAGE_MODELS', ','.join(image["models"]))
+
+    scoreModule = load_scoring_module(scoreFile)
+    scoreModule.init()
+    server = make_server(scoreModule, args.host, args.port)
+    # The port line is what process-based callers wait for
+    print("Listening on http://%s:%d/score" % server.server_address, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,447 @@
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse
+
+# Zero-downtime blue/green rollout of the scoring service for deploy-rest-service.py.
+# The new version (green) is deployed next to the live one (blue) with no traffic,
+# warmed up with replayed requests until its p99 latency settles, then given a growing
+# share of the traffic. Every traffic step is probed through the public endpoint and
+# rolled back if errors or p99 latency exceed the limits; blue is deleted only once
+# green takes all the traffic. Backends:
+#   AksEndpointBackend   versions of an Azure ML AksEndpoint with traffic percentiles
+#   LocalProcessBackend  one local_scoring_server.py process per version behind a
+#                        weighted local router, recorded in the azureml-local workspace
+#
+# Moving a service from --rollout replace to blue_green is a one-time migration: replace
+# deploys a single-version AksWebservice, and an AksEndpoint cannot take over its name.
+# AksEndpointBackend stops with an error when it finds such a service. Run the first
+# blue/green deployment with --migrate_service; it deletes the old service and creates
+# the endpoint, so the service is down until that first version is healthy. Later
+# deployments swap versions without downtime.
+
+LOCAL_SCORING_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'local_scoring_server.py')
+LOCAL_AZUREML_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'azureml-local')
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100.0 * (len(ordered) - 1))))]
+
+
+class HttpSender(object):
+    # Keep-alive JSON client for one scoring URI; send() returns (ok, seconds)
+
+    def __init__(self, uri, key=None, timeout=30):
+        url = urlparse(uri)
+        self.host, self.port = url.hostname, url.port
+        self.https = url.scheme == 'https'
+        self.path = url.path or '/'
+        self.headers = {'Content-Type': 'application/json'}
+        if key:
+            self.headers['Authorization'] = 'Bearer ' + key
+        self.timeout = timeout
+        self._connection = None
+
+    def _connect(self):
+        connectionClass = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return connectionClass(self.host, self.port, timeout=self.timeout)
+
+    def send(self, payload):
+        body = payload if isinstance(payload, (bytes, str)) else json.dumps(payload)
+        if isinstance(body, str):
+            # http.client only sends bytes bodies in the same packet as the headers
+            body = body.encode('utf-8')
+        start = time.perf_counter()
+        try:
+            if self._connection is None:
+                self._connection = self._connect()
+            self._connection.request('POST', self.path, body, self.headers)
+            response = self._connection.getresponse()
+            data = response.read()
+            # score.run reports failures as a JSON string instead of the predictions
+            ok = response.status == 200 and not data.startswith(b'"')
+        except (http.client.HTTPException, OSError):
+            self._connection = None
+            ok = False
+        return ok, time.perf_counter() - start
+
+
+def warm_up(send, payloads, round_size=50, tolerance=0.1, stable_rounds=2, max_rounds=40):
+    # Replays payloads in rounds until the p99 of stable_rounds consecutive rounds moves
+    # by less than tolerance (relative); returns the last p99 and the per-round history
+    history = []
+    stable = 0
+    for roundIndex in range(max_rounds):
+        latencies, errors = [], 0
+        for i in range(round_size):
+            ok, seconds = send(payloads[(roundIndex * round_size + i) % len(payloads)])
+            latencies.append(seconds)
+            errors += 0 if ok else 1
+        p99 = percentile(latencies, 99)
+        history.append({"round": roundIndex, "p99_seconds": p99, "p50_seconds": percentile(latencies, 50),
+                        "errors": errors})
+        print("....warm-up round %d: p50 %.1f ms, p99 %.1f ms, %d errors" % (
+            roundIndex, history[-1]["p50_seconds"] * 1000, p99 * 1000, errors))
+        if errors == 0 and len(history) > 1 and history[-2]["errors"] == 0:
+            previous = history[-2]["p99_seconds"]
+            stable = stable + 1 if abs(p99 - previous) <= tolerance * previous else 0
+            if stable >= stable_rounds:
+                return p99, history
+    raise RuntimeError("p99 latency did not settle after %d warm-up rounds (%d errors in the last one)" % (
+        max_rounds, history[-1]["errors"]))
+
+
+def probe(send, payloads, requests):
+    latencies, errors = [], 0
+    for i in range(requests):
+        ok, seconds = send(payloads[i % len(payloads)])
+        latencies.append(seconds)
+        errors += 0 if ok else 1
+    return {"requests": requests, "errors": errors, "error_rate": float(errors) / max(requests, 1),
+            "p50_seconds": percentile(latencies, 50), "p99_seconds": percentile(latencies, 99)}
+
+
+def blue_green_rollout(backend, version_name, image, payloads, traffic_steps=(10, 50, 100), probe_requests=200,
+                       max_error_rate=0.01, max_p99_ratio=2.0, p99_tolerance=0.1):
+    # Returns the rollout report; "rolled_back" is set when green was removed again
+    report = {"version": version_name, "steps": []}
+    liveVersions = backend.live_versions()
+    blue = [name for name in liveVersions if name != version_name]
+    print("....live versions: %s" % liveVersions)
+    if version_name in liveVersions:
+        print("....%s is already deployed, nothing to roll out" % version_name)
+        report["rolled_back"] = False
+        return report
+
+    if blue:
+        baseline = probe(backend.endpoint_sender().send, payloads, probe_requests)
+        report["baseline"] = baseline
+        print("....baseline through the endpoint: p99 %.1f ms, error rate %.3f" % (
+            baseline["p99_seconds"] * 1000, baseline["error_rate"]))
+
+    if blue:
+        print("....deploying %s next to %s with no traffic" % (version_name, blue))
+    else:
+        print("....deploying %s, no live version to shift traffic from" % version_name)
+    backend.deploy_version(version_name, image, traffic=0 if blue else 100)
+    try:
+        warmP99, report["warm_up"] = warm_up(backend.version_sender(version_name).send, payloads,
+                                             tolerance=p99_tolerance)
+    except RuntimeError as e:
+        report.update(rolled_back=bool(blue), error=str(e))
+        if blue:
+            print("....%s, removing %s" % (e, version_name))
+            backend.delete_version(version_name)
+        return report
+    print("....%s warm: p99 %.1f ms" % (version_name, warmP99 * 1000))
+    report["rolled_back"] = False
+    if not blue:
+        return report
+
+    p99Limit = max_p99_ratio * max(warmP99, report["baseline"]["p99_seconds"])
+    for share in traffic_steps:
+        weights = dict((name, 0) for name in blue)
+        weights[blue[0]] = 100 - share
+        weights[version_name] = share
+        backend.set_traffic(weights)
+        result = probe(backend.endpoint_sender().send, payloads, probe_requests)
+        result["traffic"] = weights
+        report["steps"].append(result)
+        print("....%d%% to %s: p99 %.1f ms, error rate %.3f" % (share, version_name, result["p99_seconds"] * 1000,
+                                                               result["error_rate"]))
+        if result["error_rate"] > max_error_rate or result["p99_seconds"] > p99Limit:
+            print("....unhealthy at %d%%, rolling back to %s" % (share, blue[0]))
+            backend.set_traffic(dict([(blue[0], 100), (version_name, 0)]))
+            backend.delete_version(version_name)
+            report.update(rolled_back=True, error="unhealthy at %d%% traffic" % share)
+            return report
+
+    for name in blue:
+        print("....deleting previous version %s" % name)
+        backend.delete_version(name)
+    return report
+
+
+class AksEndpointBackend(object):
+    # Versions of one AksEndpoint; each version is created from the registered models
+    # of the image and the scoring inference config. App insights and model data
+    # collection are settings of every version, not of the endpoint, so they are set
+    # whenever a version is created or updated.
+
+    def __init__(self, workspace, endpoint_name, aks_target, inference_config, description=None, tags=None,
+                 enable_app_insights=True, collect_model_data=True, **deployment_options):
+        self.workspace = workspace
+        self.endpoint_name = endpoint_name
+        self.aks_target = aks_target
+        self.inference_config = inference_config
+        self.description = description
+        self.tags = tags
+        self.monitoring_options = {"enable_app_insights": enable_app_insights,
+                                   "collect_model_data": collect_model_data}
+        self.deployment_options = deployment_options
+
+    def _single_service(self):
+        # A service of that name that is not an endpoint, e.g. deployed by --rollout replace
+        from azureml.core.webservice import AksEndpoint, Webservice
+        from azureml.exceptions import WebserviceException
+        try:
+            service = Webservice(self.workspace, self.endpoint_name)
+        except WebserviceException:
+            return None
+        return None if isinstance(service, AksEndpoint) else service
+
+    def _endpoint(self):
+        from azureml.core.webservice import AksEndpoint
+        from azureml.exceptions import WebserviceException
+        try:
+            return AksEndpoint(self.workspace, self.endpoint_name)
+        except WebserviceException:
+            if self._single_service() is not None:
+                raise RuntimeError("%s is a single-version service, not an AksEndpoint; run this deployment once "
+                                   "with --migrate_service to replace it with an endpoint (the service is down "
+                                   "until the new version is deployed)" % self.endpoint_name)
+            return None
+
+    def migrate_service(self):
+        # One-time switch from the service deployed by --rollout replace to an endpoint
+        service = self._single_service()
+        if service is None:
+            print("....%s is not a single-version service, nothing to migrate" % self.endpoint_name)
+            return
+        print("....deleting single-version service %s, the endpoint replaces it" % self.endpoint_name)
+        service.delete()
+
+    def live_versions(self):
+        endpoint = self._endpoint()
+        if endpoint is None:
+            return {}
+        return dict((name, version.traffic_percentile) for name, version in endpoint.versions.items())
+
+    def deploy_version(self, version_name, image, traffic=0):
+        from azureml.core.model import Model
+        from azureml.core.webservice import AksEndpoint
+        endpoint = self._endpoint()
+        if endpoint is None:
+            deploymentConfig = AksEndpoint.deploy_configuration(version_name=version_name, traffic_percentile=traffic,
+                                                                description=self.description, tags=self.tags,
+                                                                **dict(self.deployment_options,
+                                                                       **self.monitoring_options))
+            endpoint = Model.deploy(self.workspace, self.endpoint_name, image.models, self.inference_config,
+                                    deploymentConfig, self.aks_target)
+        else:
+            endpoint.create_version(version_name, models=image.models, inference_config=self.inference_config,
+                                    traffic_percentile=traffic, tags=self.tags,
+                                    **dict(self.deployment_options, **self.monitoring_options))
+        endpoint.wait_for_deployment(show_output=True)
+
+    def set_traffic(self, weights):
+        endpoint = self._endpoint()
+        # Lower shares first, so the percentiles never add up to more than 100
+        for name, share in sorted(weights.items(), key=lambda item: item[1]):
+            endpoint.update_version(name, traffic_percentile=share, **self.monitoring_options)
+            endpoint.wait_for_deployment(show_output=False)
+
+    def delete_version(self, version_name):
+        endpoint = self._endpoint()
+        endpoint.delete_version(version_name)
+        endpoint.wait_for_deployment(show_output=False)
+
+    def version_sender(self, version_name):
+        endpoint = self._endpoint()
+        return HttpSender(endpoint.versions[version_name].scoring_uri, endpoint.get_keys()[0])
+
+    def endpoint_sender(self):
+        endpoint = self._endpoint()
+        return HttpSender(endpoint.scoring_uri, endpoint.get_keys()[0])
+
+    def scoring_uri(self):
+        return self._endpoint().scoring_uri
+
+    def get_keys(self):
+        return self._endpoint().get_keys()
+
+    def service(self):
+        return self._endpoint()
+
+    def close(self):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class LocalProcessBackend(object):
+    # Each version is a local_scoring_server.py process serving a local image; a router
+    # thread spreads requests over them by traffic weight. The service record (router
+    # URI, versions, images and weights) is kept in the azureml-local workspace, and the
+    # versions of a previous run are restarted from it, standing in for the live service.
+
+    def __init__(self, service_name, port=0, start_timeout=300):
+        from azureml import _local
+        self._local = _local
+        self.service_name = service_name
+        self.start_timeout = start_timeout
+        self.versions = {}
+        self.traffic = {}
+        self._lock = threading.Lock()
+        self._router = self._start_router(port)
+        record = _local.read_json(self._record_path()) or {}
+        for name, image_id in sorted((record.get("versions") or {}).items()):
+            self._start_version(name, image_id)
+            self.traffic[name] = record["traffic"].get(name, 0)
+        if self.versions:
+            self._save()
+
+    def _record_path(self):
+        return self._local.path('services', '%s.json' % self.service_name)
+
+    def _save(self):
+        live = max(self.traffic.items(), key=lambda item: item[1])[0] if self.traffic else None
+        from azureml.core import Image
+        image = Image(id=self.versions[live]["image_id"]) if live else None
+        self._local.write_json(self._record_path(), {
+            "name": self.service_name,
+            "scoring_uri": self.scoring_uri(),
+            "image_id": image.id if image else None,
+            "models": image.model_ids if image else [],
+            "versions": dict((name, version["image_id"]) for name, version in self.versions.items()),
+            "traffic": dict(self.traffic),
+            "tags": {},
+            "state": 'Healthy',
+        })
+
+    def _start_router(self, port):
+        backend = self
+
+        class RouterHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def _forward(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else None
+                with backend._lock:
+                    names = [name for name, share in backend.traffic.items() if share > 0]
+                    weights = [backend.traffic[name] for name in names]
+                    ports = dict((name, backend.versions[name]["port"]) for name in names)
+                if not names:
+                    self._reply(503, {}, b'No version takes traffic')
+                    return
+                port = ports[random.choices(names, weights)[0]]
+                try:
+                    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                    headers = dict((k, v) for k, v in self.headers.items() if k.lower() != 'host')
+                    connection.request(method, self.path, body, headers)
+                    response = connection.getresponse()
+                    data = response.read()
+                    connection.close()
+                    self._reply(response.status, dict(response.getheaders()), data)
+                except (http.client.HTTPException, OSError) as e:
+                    self._reply(502, {}, str(e).encode('utf-8'))
+
+            def _reply(self, status, headers, data):
+                self.send_response(status)
+                for name, value in headers.items():
+                    if name.lower() not in ('content-length', 'connection', 'transfer-encoding', 'server', 'date'):
+                        self.send_header(name, value)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._forward('GET')
+
+            def do_POST(self):
+                self._forward('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        server = _ThreadingHTTPServer(('127.0.0.1', port), RouterHandler)
+        threading.Thread(target=server.serve_forever, name='local-router', daemon=True).start()
+        return server
+
+    def _start_version(self, version_name, image_id):
+        from azureml.core import Image
+        image = Image(id=image_id)
+        logPath = self._local.path('services', '%s-%s.log' % (self.service_name, version_name))
+        os.makedirs(os.path.dirname(logPath), exist_ok=True)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([LOCAL_AZUREML_DIR, image.directory, env.get('PYTHONPATH', '')])
+        env['CHD_LOCAL_WORKSPACE'] = self._local.workspace_dir()
+        log = open(logPath, 'w')
+        process = subprocess.Popen([sys.executable, LOCAL_SCORING_SERVER, '--image_dir', image.directory,
+                                    '--port', '0'], stdout=log, stderr=subprocess.STDOUT, env=env,
+                                   cwd=image.directory)
+        deadline = time.time() + self.start_timeout
+        port = None
+        while port is None:
+            if process.poll() is not None:
+                raise RuntimeError("scoring server for %s exited, see %s" % (version_name, logPath))
+            if time.time() > deadline:
+                process.kill()
+                raise RuntimeError("scoring server for %s did not start, see %s" % (version_name, logPath))
+            with open(logPath) as f:
+                for line in f:
+                    if line.startswith('Listening on '):
+                        port = urlparse(line.split()[-1]).port
+            time.sleep(0.1)
+        with self._lock:
+            self.versions[version_name] = {"process": process, "port": port, "image_id": image.id, "log": logPath}
+        print("....%s serving image %s on port %d" % (version_name, image.id, port))
+
+    def live_versions(self):
+        return dict(self.traffic)
+
+    def deploy_version(self, version_name, image, traffic=0):
+        self._start_version(version_name, image.id)
+        with self._lock:
+            self.traffic[version_name] = traffic
+        self._save()
+
+    def set_traffic(self, weights):
+        with self._lock:
+            self.traffic.update(weights)
+        self._save()
+
+    def delete_version(self, version_name):
+        with self._lock:
+            version = self.versions.pop(version_name)
+            self.traffic.pop(version_name, None)
+        version["process"].terminate()
+        version["process"].wait()
+        self._save()
+
+    def version_sender(self, version_name):
+        return HttpSender('http://127.0.0.1:%d/score' % self.versions[version_name]["port"])
+
+    def endpoint_sender(self):
+        return HttpSender(self.scoring_uri())
+
+    def scoring_uri(self):
+        return 'http://127.0.0.1:%d/score' % self._router.server_address[1]
+
+    def get_keys(self):
+        return None, None
+
+    def service(self):
+        from azureml.core.webservice import Webservice
+        return Webservice(name=self.service_name)
+
+    def close(self):
+        # Local versions live as long as the deploying process; their record stays
+        for version in self.versions.values():
+            version["process"].terminate()
+            version["process"].wait()
+        self._router.shutdown()
@@ -0,0 +1,419 @@
+import asyncio
+import concurrent.futures
+import gzip
+import http.client
+import json
+import random
+import ssl
+import threading
+import time
+from urllib.parse import urlparse
+
+# Client for the chd-predictor-service scoring URI, replacing one requests.post per row.
+# Connections are kept alive in a pool (TCP and TLS setup is paid once per connection,
+# not per call), single-row predict() calls are buffered into batched requests that are
+# sent when batch_max_rows rows are waiting or the oldest one has waited batch_max_delay_ms,
+# bodies above compress_min_bytes are gzip-compressed, and failed requests are retried
+# with exponential backoff and jitter. ScoringClient is the thread-safe sync API,
+# AsyncScoringClient the asyncio one; both only use the standard library.
+#
+#   with ScoringClient(uri, key) as client:
+#       client.score([[61, 1, 150, 80], [67, 1, 138, None]])   # one request, all rows
+#       client.predict([43, 1, 180, 90])                      # batched with other callers
+#
+# Scoring errors reported by score.run (a JSON string instead of predictions) raise
+# ScoringError and are not retried. When such an error comes back for a batch of
+# predict() rows, the batch is split in halves and re-sent until the failing rows are
+# isolated, so only their callers get the error.
+
+# Responses worth retrying: throttled or a replica not (yet) available
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class ScoringError(Exception):
+    pass
+
+
+class _RunError(ScoringError):
+    # The service answered, but score.run failed on the rows of the request
+    pass
+
+
+class _RetryableError(Exception):
+
+    def __init__(self, message, retry_after=None):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+
+
+def _encode_rows(rows, compress_min_bytes):
+    body = json.dumps({"data": rows}).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+    if compress_min_bytes is not None and len(body) >= compress_min_bytes:
+        body = gzip.compress(body, compresslevel=5)
+        headers['Content-Encoding'] = 'gzip'
+    return body, headers
+
+
+def _decode_response(status, headers, data):
+    if status in RETRY_STATUSES:
+        retryAfter = headers.get('retry-after')
+        raise _RetryableError("HTTP %d" % status, float(retryAfter) if retryAfter and retryAfter.isdigit() else None)
+    if status != 200:
+        raise ScoringError("HTTP %d: %s" % (status, data[:200].decode('utf-8', 'replace')))
+    if headers.get('content-encoding') == 'gzip':
+        data = gzip.decompress(data)
+    result = json.loads(data.decode('utf-8'))
+    if isinstance(result, str):
+        # score.run returns the exception text when scoring fails
+        raise _RunError(result)
+    return result
+
+
+class _Endpoint(object):
+    # Parsed scoring URI, request headers and retry policy shared by both clients
+
+    def __init__(self, uri, key=None, timeout=30, max_retries=3, backoff=0.05, max_backoff=2.0,
+                 compress_min_bytes=16384, ssl_context=None):
+        url = urlparse(uri)
+        self.https = url.scheme == 'https'
+        self.host = url.hostname
+        self.port = url.port or (443 if self.https else 80)
+        self.path = url.path + ('?' + url.query if url.query else '') or '/'
+        self.headers = {'Accept': 'application/json', 'Accept-Encoding': 'gzip'}
+        if key:
+            self.headers['Authorization'] = 'Bearer ' + key
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.compress_min_bytes = compress_min_bytes
+        # One context for all connections, so TLS sessions can be resumed
+        self.ssl_context = ssl_context or (ssl.create_default_context() if self.https else None)
+
+    def request(self, rows):
+        body, headers = _encode_rows(rows, self.compress_min_bytes)
+        headers.update(self.headers)
+        headers['Content-Length'] = str(len(body))
+        return body, headers
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        # Full jitter: spreads the retries of many callers hit by the same outage
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class _Batcher(object):
+    # Buffers single rows; flush(rows, futures) is called with up to max_rows rows once the
+    # batch is full or its oldest row has waited max_delay_seconds
+
+    def __init__(self, flush, max_rows=100, max_delay_ms=5.0):
+        self.flush = flush
+        self.max_rows = max_rows
+        self.max_delay_seconds = max_delay_ms / 1000.0
+        self._rows = []
+        self._futures = []
+        self._deadline = None
+        self._condition = threading.Condition()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name='scoring-batcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, row):
+        future = concurrent.futures.Future()
+        with self._condition:
+            if self._closed:
+                raise ScoringError("client is closed")
+            if not self._rows:
+                self._deadline = time.perf_counter() + self.max_delay_seconds
+            self._rows.append(row)
+            self._futures.append(future)
+            if len(self._rows) == 1 or len(self._rows) >= self.max_rows:
+                self._condition.notify()
+        return future
+
+    def _take(self):
+        rows, futures = self._rows[:self.max_rows], self._futures[:self.max_rows]
+        del self._rows[:self.max_rows]
+        del self._futures[:self.max_rows]
+        self._deadline = time.perf_counter() + self.max_delay_seconds if self._rows else None
+        return rows, futures
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed:
+                    if self._rows and (len(self._rows) >= self.max_rows or time.perf_counter() >= self._deadline):
+                        break
+                    self._condition.wait(None if not self._rows else max(0, self._deadline - time.perf_counter()))
+                if self._closed and not self._rows:
+                    return
+                rows, futures = self._take()
+            self.flush(rows, futures)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._worker.join()
+
+
+class ScoringClient(object):
+
+    def __init__(self, uri, key=None, max_connections=10, batch_max_rows=100, batch_max_delay_ms=5.0,
+                 max_request_rows=1000, **options):
+        self.endpoint = _Endpoint(uri, key, **options)
+        self.max_request_rows = max_request_rows
+        self._idle = []
+        self._idleLock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        # Batches are sent from a small pool, so a slow request doesn't hold up the next batch
+        self._senders = concurrent.futures.ThreadPoolExecutor(max_workers=max_connections)
+        self._batcher = _Batcher(self._flush, batch_max_rows, batch_max_delay_ms)
+
+    def _connect(self):
+        endpoint = self.endpoint
+        if endpoint.https:
+            return http.client.HTTPSConnection(endpoint.host, endpoint.port, timeout=endpoint.timeout,
+                                               context=endpoint.ssl_context)
+        return http.client.HTTPConnection(endpoint.host, endpoint.port, timeout=endpoint.timeout)
+
+    def _send(self, body, headers):
+        with self._slots:
+            with self._idleLock:
+                connection = self._idle.pop() if self._idle else None
+            try:
+                if connection is None:
+                    connection = self._connect()
+                connection.request('POST', self.endpoint.path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                if connection is not None:
+                    connection.close()
+                raise _RetryableError(str(e) or type(e).__name__)
+            responseHeaders = dict((k.lower(), v) for k, v in response.getheaders())
+            if response.will_close:
+                connection.close()
+            else:
+                with self._idleLock:
+                    self._idle.append(connection)
+            return response.status, responseHeaders, data
+
+    def _score(self, rows):
+        body, headers = self.endpoint.request(rows)
+        attempt = 0
+        while True:
+            try:
+                return _decode_response(*self._send(body, headers))
+            except _RetryableError as e:
+                if attempt >= self.endpoint.max_retries:
+                    raise ScoringError("scoring failed after %d attempts: %s" % (attempt + 1, e))
+                time.sleep(self.endpoint.delay(attempt, e.retry_after))
+                attempt += 1
+
+    def score(self, rows):
+        # Predictions for a list of rows, sent as requests of at most max_request_rows rows
+        results = []
+        for start in range(0, len(rows), self.max_request_rows):
+            results.extend(self._score(rows[start:start + self.max_request_rows]))
+        return results
+
+    def predict_future(self, row):
+        return self._batcher.submit(row)
+
+    def predict(self, row, timeout=None):
+        # One row, scored in a batch with the rows of concurrent callers
+        return self.predict_future(row).result(timeout)
+
+    def _score_split(self, rows, futures):
+        # Halves a batch rejected by score.run until the rows that fail are on their own
+        try:
+            results = self._score(rows)
+        except _RunError as e:
+            if len(rows) == 1:
+                futures[0].set_exception(e)
+                return
+            middle = len(rows) // 2
+            self._score_split(rows[:middle], futures[:middle])
+            self._score_split(rows[middle:], futures[middle:])
+            return
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+    def _flush(self, rows, futures):
+        def send():
+            try:
+                self._score_split(rows, futures)
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+        self._senders.submit(send)
+
+    def close(self):
+        self._batcher.close()
+        self._senders.shutdown(wait=True)
+        with self._idleLock:
+            for connection in self._idle:
+                connection.close()
+            self._idle = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncScoringClient(object):
+    # asyncio API on asyncio streams; create and use it inside the running event loop
+
+    def __init__(self, uri, key=None, max_connections=10, batch_max_rows=100, batch_max_delay_ms=5.0,
+                 max_request_rows=1000, **options):
+        self.endpoint = _Endpoint(uri, key, **options)
+        self.max_request_rows = max_request_rows
+        self.batch_max_rows = batch_max_rows
+        self.batch_max_delay_seconds = batch_max_delay_ms / 1000.0
+        self._loop = asyncio.get_event_loop()
+        self._idle = []
+        self._slots = asyncio.Semaphore(max_connections)
+        self._rows = []
+        self._futures = []
+        self._timer = None
+        self._pending = set()
+
+    async def _connect(self):
+        endpoint = self.endpoint
+        return await asyncio.open_connection(endpoint.host, endpoint.port, ssl=endpoint.ssl_context,
+                                             server_hostname=endpoint.host if endpoint.https else None)
+
+    async def _read_response(self, reader):
+        statusLine = await reader.readline()
+        if not statusLine:
+            raise ConnectionError("connection closed by the server")
+        status = int(statusLine.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            data = b''.join(chunks)
+        else:
+            data = await reader.readexactly(int(headers.get('content-length', 0)))
+        return status, headers, data
+
+    async def _send(self, body, headers):
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else None
+            try:
+                if connection is None:
+                    connection = await self._connect()
+                reader, writer = connection
+                head = 'POST %s HTTP/1.1\r\nHost: %s\r\n' % (self.endpoint.path, self.endpoint.host)
+                head += ''.join('%s: %s\r\n' % item for item in headers.items()) + '\r\n'
+                writer.write(head.encode('latin-1') + body)
+                status, responseHeaders, data = await asyncio.wait_for(self._read_response(reader),
+                                                                       self.endpoint.timeout)
+            except (OSError, ValueError, IndexError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                if connection is not None:
+                    connection[1].close()
+                raise _RetryableError(str(e) or type(e).__name__)
+            if responseHeaders.get('connection', '').lower() == 'close':
+                writer.close()
+            else:
+                self._idle.append(connection)
+            return status, responseHeaders, data
+
+    async def _score(self, rows):
+        body, headers = self.endpoint.request(rows)
+        attempt = 0
+        while True:
+            try:
+                return _decode_response(*(await self._send(body, headers)))
+            except _RetryableError as e:
+                if attempt >= self.endpoint.max_retries:
+                    raise ScoringError("scoring failed after %d attempts: %s" % (attempt + 1, e))
+                await asyncio.sleep(self.endpoint.delay(attempt, e.retry_after))
+                attempt += 1
+
+    async def score(self, rows):
+        results = []
+        for start in range(0, len(rows), self.max_request_rows):
+            results.extend(await self._score(rows[start:start + self.max_request_rows]))
+        return results
+
+    def predict(self, row):
+        # Awaitable prediction of one row, scored in a batch with concurrent calls
+        future = self._loop.create_future()
+        self._rows.append(row)
+        self._futures.append(future)
+        if len(self._rows) >= self.batch_max_rows:
+            self._flush()
+        elif self._timer is None:
+            self._timer = self._loop.call_later(self.batch_max_delay_seconds, self._flush)
+        return future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        rows, futures = self._rows[:self.batch_max_rows], self._futures[:self.batch_max_rows]
+        del self._rows[:self.batch_max_rows]
+        del self._futures[:self.batch_max_rows]
+        if self._rows:
+            self._timer = self._loop.call_later(self.batch_max_delay_seconds, self._flush)
+        task = asyncio.ensure_future(self._send_batch(rows, futures))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _score_split(self, rows, futures):
+        try:
+            results = await self._score(rows)
+        except _RunError as e:
+            if len(rows) == 1:
+                if not futures[0].done():
+                    futures[0].set_exception(e)
+                return
+            middle = len(rows) // 2
+            await self._score_split(rows[:middle], futures[:middle])
+            await self._score_split(rows[middle:], futures[middle:])
+            return
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _send_batch(self, rows, futures):
+        try:
+            await self._score_split(rows, futures)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def close(self):
+        while self._rows:
+            self._flush()
+        if self._pending:
+            await asyncio.wait(list(self._pending))
+        for _, writer in self._idle:
+            writer.close()
+        self._idle = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import urllib.request
+
+# Deterministic result cache for the build pipeline steps.
+# A step's key is the SHA-256 of its source files, its arguments, its dependency spec
+# and a fingerprint of its input data (plus the keys of the steps it depends on). When
+# a key was recorded by an earlier build, the recorded outputs are reused instead of
+# running the step. Records are small JSON documents, kept either in a local directory
+# (LocalStepCache, handy for tests) or in the workspace datastore (DatastoreStepCache).
+
+# Files created while a step runs, which must not change its key
+GENERATED_FILES = ('score_fixed.py', 'scoring_dependencies.yml')
+
+
+def hash_sources(directory, extensions=('.py', '.yml', '.json')):
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if d not in ('__pycache__', 'outputs'))
+        for name in sorted(files):
+            if not name.endswith(extensions) or name in GENERATED_FILES:
+                continue
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, directory).replace(os.sep, '/').encode('utf-8'))
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def data_fingerprint(source):
+    # Blob URLs: the Content-MD5 / ETag reported on a HEAD request; local files: SHA-256
+    if source.startswith('http://') or source.startswith('https://'):
+        request = urllib.request.Request(source, method='HEAD')
+        with urllib.request.urlopen(request) as response:
+            headers = response.headers
+            return 'md5:%s etag:%s length:%s' % (headers.get('Content-MD5'), headers.get('ETag'),
+                                                  headers.get('Content-Length'))
+    digest = hashlib.sha256()
+    with open(source, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return 'sha256:' + digest.hexdigest()
+
+
+def deployment_fingerprint(workspace, model_name):
+    # containerize decides whether to deploy by comparing the trained model with the one
+    # being served, so the services of the model and the images they run are part of its
+    # key: a recorded deploy decision is not replayed once the deployment has changed
+    from azureml.core.webservice import Webservice
+    services = Webservice.list(workspace, model_name=model_name)
+    return 'services:' + json.dumps(sorted([service.name, (service.tags or {}).get('image_id')]
+                                           for service in services))
+
+
+def step_key(step_name, sources, arguments, dependencies, inputs=()):
+    payload = json.dumps({
+        "step": step_name,
+        "sources": sources,
+        "arguments": [str(a) for a in arguments],
+        "dependencies": dependencies,
+        "inputs": list(inputs),
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LocalStepCache(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, step_name, key):
+        return os.path.join(self.directory, '%s-%s.json' % (step_name, key))
+
+    def get(self, step_name, key):
+        path = self._path(step_name, key)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def put(self, step_name, key, record):
+        path = self._path(step_name, key)
+        temporaryPath = path + '.tmp'
+        with open(temporaryPath, 'w') as f:
+            json.dump(record, f)
+        os.replace(temporaryPath, path)
+
+
+class DatastoreStepCache(object):
+    # Same records, stored under `prefix` in an Azure ML datastore so that every
+    # build agent sees them
+
+    def __init__(self, datastore, prefix='build-step-cache'):
+        self.datastore = datastore
+        self.prefix = prefix
+
+    def get(self, step_name, key):
+        directory = tempfile.mkdtemp()
+        try:
+            name = '%s-%s.json' % (step_name, key)
+            self.datastore.download(directory, prefix='%s/%s' % (self.prefix, name), show_progress=False)
+            path = os.path.join(directory, self.prefix, name)
+            if not os.path.exists(path):
+                return None
+            with open(path) as f:
+                return json.load(f)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def put(self, step_name, key, record):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, '%s-%s.json' % (step_name, key))
+            with open(path, 'w') as f:
+                json.dump(record, f)
+            self.datastore.upload_files([path], target_path=self.prefix, overwrite=True, show_progress=False)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)